@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import traceback
+from pathlib import Path
+
+from capacity import sizeof_fmt
+from main import build, build_parser, check_rootpassword, needs_root
+from metrics import Metrics
+from scheduler import Resources
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Build many discs with stages scheduled on shared resources')
+    parser.add_argument('manifest', type=Path,
+                        help='json list of builds. Every build is an object keyed by the main.py option names, '
+                             'e.g. {"data_dir": "...", "output": "a.iso", "volid": "A", "disc_type": "BD-XL TL", '
+                             '"save_pass": true}')
+    parser.add_argument('--cpus', type=int, help='cores shared by all builds (default: all cores)')
+    parser.add_argument('--mem', type=float, metavar='GiB', help='memory budget (default: available memory)')
+    parser.add_argument('--io', type=int, default=1,
+                        help='builds allowed to stream data through the disk at the same time')
+    parser.add_argument('--scratch', type=float, metavar='GiB',
+                        help='estimated intermediate file space of the builds in flight')
+    parser.add_argument('--metrics-json', type=Path, metavar='FILE', help='write the metrics of every build')
+    return parser.parse_args()
+
+
+def entry_args(parser: argparse.ArgumentParser, entry: dict) -> argparse.Namespace:
+    entry = dict(entry)
+    entry.setdefault('fec_roots', 'auto')
+    argv = [str(entry.pop('data_dir'))]
+    actions = {a.dest: a for a in parser._actions if a.option_strings}
+    for k, v in entry.items():
+        if k not in actions:
+            parser.error(f'unknown manifest key {k}')
+        flag = actions[k].option_strings[-1]
+        if actions[k].nargs == 0:
+            if v:
+                argv.append(flag)
+        elif v is not None:
+            argv += [flag, str(v)]
+    opt = parser.parse_args(argv)
+    if opt.fec_roots.s in ('ask', 'preview'):
+        parser.error(f'{opt.output}: fec roots {opt.fec_roots} needs a prompt, use auto, max or N in a batch')
+    return opt
+
+
+def scratch_estimate(opt: argparse.Namespace) -> int:
+    size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(opt.data_dir) for f in files)
+    # squashfs image and the ISO, plus the dm-crypt copy unless encrypting in place
+    copies = 2 + (bool(opt.compress or opt.save_pass) and opt.crypt_engine == 'dm-crypt' and not opt.pipeline)
+    return size * copies * 11 // 10
+
+
+async def run_one(opt: argparse.Namespace, root_password, resources: Resources, metrics: Metrics) -> int:
+    async with resources.hold(scratch=scratch_estimate(opt)):
+        print('Starting', opt.output)
+        return await build(opt, root_password, metrics, resources)
+
+
+async def main(opt: argparse.Namespace) -> int:
+    parser = build_parser()
+    with opt.manifest.open() as f:
+        builds = [entry_args(parser, e) for e in json.load(f)]
+    outputs = [b.output.resolve() for b in builds]
+    if len(set(outputs)) != len(outputs):
+        print('Every build needs its own output file')
+        return 2
+
+    root_password = await check_rootpassword() if any(needs_root(b) for b in builds) else None
+    gib = 1024 * 1024 * 1024
+    resources = Resources(cpu=opt.cpus, mem=int(opt.mem * gib) if opt.mem else None, io=opt.io,
+                          scratch=int(opt.scratch * gib) if opt.scratch else None)
+    metrics = [Metrics() for _ in builds]
+    rets = await asyncio.gather(*(run_one(b, root_password, resources, m) for b, m in zip(builds, metrics)),
+                                return_exceptions=True)
+
+    failed = 0
+    for b, m, r in zip(builds, metrics, rets):
+        if isinstance(r, BaseException):
+            traceback.print_exception(type(r), r, r.__traceback__)
+        if r != 0:
+            failed += 1
+        print(b.output, 'failed' if r != 0 else 'done', sizeof_fmt(os.path.getsize(b.output)) if r == 0 else '',
+              f'{m.to_dict()["wall"]:.0f}s')
+        if b.metrics_json:
+            m.write_json(b.metrics_json)
+    if opt.metrics_json:
+        with opt.metrics_json.open('w') as f:
+            json.dump({str(b.output): m.to_dict() for b, m in zip(builds, metrics)}, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
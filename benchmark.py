@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import filecmp
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from bootsh import BootSh
+from capacity import CompProfile, FecRoots, VolID, sizeof_fmt
+from estimate import SquashfsEstimate, walk_files
+from fecsetup import FECSetup
+from imagecreate import ImageCreate, acall
+from metrics import Metrics
+from rsfec import FecEncoder, FecLayout, accumulate_blocks
+from verity import HashTree
+
+_BLK_SZ = 2048
+_BENCHES = ('hashtree', 'fec', 'preflight', 'compress', 'sparse', 'fecsetup', 'pipeline', 'micro')
+_CORPORA = ('mixed', 'text', 'random', 'small', 'sparse')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='FECISO benchmarks')
+    parser.add_argument('bench', choices=_BENCHES, help='benchmark to run')
+    parser.add_argument('-s', '--size', type=int, default=256, help='size of the synthetic data in MiB')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('-r', '--roots', type=int, nargs='+', default=range(2, 25), help='fec roots to encode')
+    parser.add_argument('-n', '--samples', type=int, default=256, help='blocks sampled by the preflight estimator')
+    parser.add_argument('--data-dir', type=Path,
+                        help='real data for the preflight, compress and pipeline benchmarks instead of synthetic')
+    parser.add_argument('--corpus', choices=_CORPORA, default='mixed',
+                        help='synthetic data tree: mixed random, text and zero files, only text, only random, many '
+                             'small files or sparse files')
+    parser.add_argument('-C', '--compress', type=str, metavar='PASSCODE',
+                        help='pipeline: build a squashfs image, encrypted unless the passcode is empty')
+    parser.add_argument('--engine', choices=('veritysetup', 'native'), default='native',
+                        help='pipeline and fecsetup: hash tree and fec engine')
+    parser.add_argument('--calls', type=int, default=1000, help='micro: calls per function')
+    parser.add_argument('-p', '--profiles', type=CompProfile, nargs='+',
+                        default=[CompProfile(c) for c in ('xz', 'zstd:3', 'zstd:15', 'zstd:19', 'lz4', 'auto')],
+                        help='compression profiles to build with')
+    parser.add_argument('--processors', type=int, help='compressor threads (default: all cores)')
+    parser.add_argument('--fill', type=float, default=0.5, help='fraction of the sparse image holding data')
+    parser.add_argument('--tmpdir', type=Path, help='scratch directory')
+    parser.add_argument('--json', type=Path, metavar='FILE', help='write the results as json')
+    parser.add_argument('--baseline', type=Path, metavar='FILE',
+                        help='json of an earlier run to compare the results with')
+    parser.add_argument('--threshold', type=float, default=10, metavar='PERCENT',
+                        help='slowdown against --baseline reported as a regression')
+    return parser.parse_args()
+
+
+def _make_data(file: Path, size: int, seed: int) -> int:
+    rng = np.random.default_rng(seed)
+    chunk = 64 * 1024 * 1024
+    with file.open('wb') as f:
+        for o in range(0, size, chunk):
+            f.write(rng.bytes(min(chunk, size - o)))
+    return size // _BLK_SZ
+
+
+@contextmanager
+def _timed(opt: argparse.Namespace, name: str, size: int, **info):
+    with opt.metrics.stage(name, size, **info) as st:
+        yield st
+    print(f'{name:>12}: {st.wall:8.3f}s {sizeof_fmt(st.nbytes / st.wall)}/s')
+
+
+async def bench_hashtree(opt: argparse.Namespace, tmpdir: Path) -> int:
+    datafile = tmpdir / 'data.img'
+    blocks = _make_data(datafile, opt.size * 1024 * 1024, opt.seed)
+    tree = HashTree(blocks)
+    uuid_ = uuid.uuid4()
+    print('Data:', sizeof_fmt(blocks * _BLK_SZ), 'Hash:', sizeof_fmt(tree.hash_blocks * _BLK_SZ))
+
+    with _timed(opt, 'native', blocks * _BLK_SZ):
+        root_hash = tree.build(datafile, tmpdir / 'native.hash', uuid_=uuid_, workers=opt.workers)
+    print('Root hash:', root_hash.hex())
+
+    if not shutil.which('veritysetup'):
+        print('veritysetup not found, skipping the subprocess path')
+        return 0
+
+    hashfile = tmpdir / 'veritysetup.hash'
+    with _timed(opt, 'veritysetup', blocks * _BLK_SZ):
+        msg = await acall('veritysetup', 'format', '--salt=-', '--hash=md5', f'--uuid={uuid_}',
+                          f'--data-block-size={_BLK_SZ}', f'--hash-block-size={_BLK_SZ}',
+                          os.fspath(datafile), os.fspath(hashfile), capture=True)
+
+    ret = dict(s.split(':', maxsplit=1) for s in msg.decode().splitlines() if ':' in s)
+    same_root = bytes.fromhex(ret['Root hash'].strip()) == root_hash
+    same_file = filecmp.cmp(hashfile, tmpdir / 'native.hash', shallow=False)
+    print('Root hash identical:', same_root, 'Hash file identical:', same_file)
+    return 0 if same_root and same_file else 1
+
+
+async def bench_fec(opt: argparse.Namespace, tmpdir: Path) -> int:
+    datafile, hashfile = tmpdir / 'data.img', tmpdir / 'data.hash'
+    blocks = _make_data(datafile, opt.size * 1024 * 1024, opt.seed)
+    tree = HashTree(blocks)
+    uuid_ = uuid.uuid4()
+    tree.build(datafile, hashfile, uuid_=uuid_, workers=opt.workers)
+    # veritysetup encodes the hash file from the block after the superblock on
+    sources = ((datafile, blocks), (hashfile, tree.hash_blocks - 1, 1))
+    size = (blocks + tree.hash_blocks - 1) * _BLK_SZ
+    print('Data:', sizeof_fmt(blocks * _BLK_SZ), 'Hash:', sizeof_fmt(tree.hash_blocks * _BLK_SZ))
+
+    veritysetup = shutil.which('veritysetup')
+    ret = 0
+    for roots in opt.roots:
+        fecfile = tmpdir / f'native.fec_{roots}'
+        with _timed(opt, f'native({roots})', size):
+            FecEncoder(sources, roots).encode(fecfile, workers=opt.workers)
+        if not veritysetup:
+            fecfile.unlink()
+            continue
+
+        vfecfile, vhashfile = tmpdir / f'veritysetup.fec_{roots}', tmpdir / f'veritysetup.hash_{roots}'
+        with _timed(opt, f'veritysetup({roots})', size):
+            await acall('veritysetup', 'format', '--salt=-', '--hash=md5', f'--uuid={uuid_}', f'--fec-roots={roots}',
+                        f'--data-block-size={_BLK_SZ}', f'--hash-block-size={_BLK_SZ}', f'--fec-device={vfecfile}',
+                        os.fspath(datafile), os.fspath(vhashfile), capture=True)
+        same = filecmp.cmp(vfecfile, fecfile, shallow=False)
+        print('Fec file identical:', same)
+        ret |= not same
+        for f in (fecfile, vfecfile, vhashfile):
+            f.unlink()
+    return ret
+
+
+def _write_file(file: Path, rng: np.random.Generator, kind: int, n: int, words: list) -> None:
+    if kind == 4:
+        # 64 KiB of data every MiB, holes in between
+        with file.open('wb') as f:
+            f.truncate(n)
+            for o in range(0, n, 1024 * 1024):
+                f.seek(o)
+                f.write(rng.bytes(min(64 * 1024, n - o)))
+        return
+    with file.open('wb') as f:
+        for o in range(0, n, 16 * 1024 * 1024):
+            m = min(16 * 1024 * 1024, n - o)
+            if kind == 0:
+                b = rng.bytes(m)
+            elif kind == 1:
+                b = b' '.join(rng.choice(words, m // 5 + 1))[:m]
+            elif kind == 2:
+                b = bytes(m)
+            else:
+                b = bytes(rng.integers(0, 16, m, dtype=np.uint8))
+            f.write(b)
+
+
+def _make_tree(data_dir: Path, size: int, seed: int, corpus: str = 'mixed') -> None:
+    """The same tree for the same size, seed and corpus, so results of different commits compare."""
+    # files of lognormal sizes holding random, text like, zero or mixed data
+    rng = np.random.default_rng(seed)
+    words = [rng.bytes(rng.integers(2, 10)).hex().encode() for _ in range(2000)]
+    k = 0
+    while size > 0:
+        if corpus == 'small':
+            n = min(size, int(rng.integers(1, 16 * 1024)))
+        else:
+            n = min(size, int(rng.lognormal(11, 2.5)) + 1)
+        kind = {'mixed': None, 'text': 1, 'random': 0, 'small': 1, 'sparse': 4}[corpus]
+        if kind is None:
+            kind = rng.integers(4)
+        d = data_dir / f'd{k % 17}'
+        if corpus == 'small':
+            d = d / f'e{k // 17 % 31}'
+        d.mkdir(parents=True, exist_ok=True)
+        _write_file(d / f'f{k}', rng, kind, n, words)
+        size -= n
+        k += 1
+
+
+def _data_dir(opt: argparse.Namespace, tmpdir: Path) -> Path:
+    if opt.data_dir is not None:
+        return opt.data_dir
+    data_dir = tmpdir / 'data'
+    data_dir.mkdir()
+    _make_tree(data_dir, opt.size * 1024 * 1024, opt.seed, opt.corpus)
+    return data_dir
+
+
+async def bench_preflight(opt: argparse.Namespace, tmpdir: Path) -> int:
+    data_dir = _data_dir(opt, tmpdir)
+    files = walk_files(data_dir)
+    total = sum(s for _, s in files)
+    print('Files:', len(files), 'Data:', sizeof_fmt(total))
+    real_build = shutil.which('mksquashfs')
+    if not real_build:
+        print('mksquashfs not found, skipping the real builds')
+
+    ret = 0
+    for comp in opt.profiles:
+        try:
+            est = SquashfsEstimate(data_dir, comp)
+        except RuntimeError as e:
+            print(f'{e}, skipping {comp}')
+            continue
+        with _timed(opt, f'predicted {comp}', total, samples=opt.samples):
+            size, err = est.image_size(files, opt.samples, opt.workers, opt.seed)
+        print(f'{"":>12}  {sizeof_fmt(size)} +- {sizeof_fmt(2 * err)}')
+
+        with _timed(opt, f'per file {comp}', total):
+            exact = sum(est.file_sizes(files, opt.workers))
+        print(f'{"":>12}  {sizeof_fmt(exact)}')
+
+        if not real_build:
+            continue
+        img = ImageCreate(tmpdir / f'{comp.comp}.iso', VolID('BENCH'), '', comp=comp, processors=opt.processors)
+        img.sqfs_file = tmpdir / 'real.sqfs'
+        with _timed(opt, f'mksquashfs {comp}', total):
+            await img._mksquashfs(os.fspath(data_dir))
+        real = os.path.getsize(img.sqfs_file)
+        img.sqfs_file.unlink()
+        inside = abs(real - size) <= 2 * err
+        print(f'{"":>12}  {sizeof_fmt(real)}')
+        print(f'Prediction error of {comp}: {(size - real) / real * 100:+.2f}%',
+              'within' if inside else 'outside', 'the error bar')
+        ret |= not inside
+    return ret
+
+
+async def bench_compress(opt: argparse.Namespace, tmpdir: Path) -> int:
+    data_dir = _data_dir(opt, tmpdir)
+    total = sum(s for _, s in walk_files(data_dir))
+    print('Data:', sizeof_fmt(total))
+    if not shutil.which('mksquashfs'):
+        print('mksquashfs not found')
+        return 1
+    for comp in opt.profiles:
+        img = ImageCreate(tmpdir / f'{comp.comp}.iso', VolID('BENCH'), '', comp=comp, processors=opt.processors)
+        img.sqfs_file = tmpdir / 'bench.sqfs'
+        with _timed(opt, str(comp), total) as st:
+            await img._mksquashfs(os.fspath(data_dir))
+        size = st.info['image'] = os.path.getsize(img.sqfs_file)
+        print(f'{"":>12}  {sizeof_fmt(size)} ({size / total * 100:.1f}%)')
+        img.sqfs_file.unlink()
+    return 0
+
+
+def _make_sparse(file: Path, size: int, fill: float, seed: int) -> int:
+    # chunks of random data between holes and written zeros, as in a mostly empty ISO
+    rng = np.random.default_rng(seed)
+    chunk = 16 * 1024 * 1024
+    empty = 0
+    with file.open('wb') as f:
+        f.truncate(size)
+        for k, o in enumerate(range(0, size, chunk)):
+            n = min(chunk, size - o)
+            f.seek(o)
+            if (k * fill) % 1 + fill >= 1:
+                f.write(rng.bytes(n))
+            else:
+                if empty % 2:
+                    f.write(bytes(n))
+                empty += 1
+    return size // _BLK_SZ
+
+
+async def bench_sparse(opt: argparse.Namespace, tmpdir: Path) -> int:
+    datafile = tmpdir / 'sparse.img'
+    blocks = _make_sparse(datafile, opt.size * 1024 * 1024, opt.fill, opt.seed)
+    tree = HashTree(blocks)
+    roots = max(opt.roots)
+    layout = FecLayout(blocks + tree.hash_blocks - 1, roots)
+    print('Data:', sizeof_fmt(blocks * _BLK_SZ), 'Allocated:', sizeof_fmt(os.stat(datafile).st_blocks * 512))
+
+    out = []
+    for sparse in (False, True):
+        name = 'sparse' if sparse else 'dense'
+        hashfile, fecfile = tmpdir / f'{name}.hash', tmpdir / f'{name}.fec'
+        with _timed(opt, f'hash {name}', blocks * _BLK_SZ):
+            root_hash = tree.build(datafile, hashfile, uuid_=uuid.UUID(int=0), workers=opt.workers, sparse=sparse)
+        with fecfile.open('wb') as f:
+            f.truncate(layout.size)
+        sources = ((os.fspath(datafile), blocks), (os.fspath(hashfile), tree.hash_blocks - 1, 1))
+        with _timed(opt, f'fec({roots}) {name}', layout.blocks * _BLK_SZ), \
+                ProcessPoolExecutor(max_workers=opt.workers) as pool:
+            futs = [pool.submit(accumulate_blocks, sources, roots, s, min(64 * 1024, layout.blocks - s),
+                                os.fspath(fecfile), sparse=sparse) for s in range(0, layout.blocks, 64 * 1024)]
+            assert sum(f.result() for f in futs) == layout.blocks
+        out.append((root_hash, fecfile))
+    same = out[0][0] == out[1][0] and filecmp.cmp(out[0][1], out[1][1], shallow=False)
+    print('Root hash and fec identical:', same)
+    return 0 if same else 1
+
+
+def _fecsetup(opt: argparse.Namespace, isofile: Path, **kwargs) -> FECSetup:
+    return FECSetup(isofile, dmid=VolID('BENCH'), engine=opt.engine, fec_policy=FecRoots(str(max(opt.roots))),
+                    metrics=opt.metrics, **kwargs)
+
+
+async def bench_fecsetup(opt: argparse.Namespace, tmpdir: Path) -> int:
+    """formatfec on its own, over random data standing in for the ISO."""
+    isofile = tmpdir / 'bench.iso'
+    blocks = _make_data(isofile, opt.size * 1024 * 1024, opt.seed)
+    if opt.engine == 'veritysetup' and not shutil.which('veritysetup'):
+        print('veritysetup not found')
+        return 1
+    fec = _fecsetup(opt, isofile)
+    with _timed(opt, 'formatfec', blocks * _BLK_SZ, roots=max(opt.roots), engine=opt.engine):
+        return await fec.formatfec()
+
+
+async def bench_pipeline(opt: argparse.Namespace, tmpdir: Path) -> int:
+    """ImageCreate and FECSetup end to end, the stages are recorded one by one.
+
+    Encryption runs in userspace, so no root access is needed."""
+    missing = [t for t in ('xorriso', 'mksquashfs' if opt.compress is not None else None,
+                           'veritysetup' if opt.engine == 'veritysetup' else None) if t and not shutil.which(t)]
+    if missing:
+        print(*missing, 'not found')
+        return 1
+    data_dir = _data_dir(opt, tmpdir)
+    total = sum(s for _, s in walk_files(data_dir))
+    isofile = tmpdir / 'bench.iso'
+    img = ImageCreate(isofile, VolID('BENCH'), opt.compress, disc='bench', metrics=opt.metrics, crypt_engine='native',
+                      comp=opt.profiles[0], processors=opt.processors)
+    with _timed(opt, 'pipeline', total, roots=max(opt.roots), engine=opt.engine):
+        await img.create_output(data_dir)
+        fec = _fecsetup(opt, isofile, offset=img.offset, length=img.length, cipher=img.cipher)
+        ret = await fec.formatfec()
+    for st in opt.metrics.stages[1:]:
+        print(f'{st.name:>12}: {st.wall:8.3f}s', f'{sizeof_fmt(st.nbytes / st.wall)}/s' if st.nbytes else '')
+    return ret
+
+
+def _micro(opt: argparse.Namespace, name: str, fn) -> None:
+    with opt.metrics.stage(name, calls=opt.calls) as st:
+        # the best of a few runs, the others are slowed down by the rest of the system
+        best = min(timeit.repeat(fn, number=opt.calls, repeat=5))
+    st.info['us_call'] = round(best / opt.calls * 1e6, 3)
+    print(f'{name:>12}: {st.info["us_call"]:10.3f}us/call')
+
+
+async def bench_micro(opt: argparse.Namespace, tmpdir: Path) -> int:
+    blocks = opt.size * 1024 * 1024 // _BLK_SZ
+    fec = FECSetup(tmpdir / 'bench.iso', dmid=VolID('BENCH'), iso_blocks=blocks)
+    _micro(opt, '_hs', lambda: FECSetup._hs(blocks))
+    _micro(opt, '_fec_len', lambda: FECSetup._fec_len(blocks, fec.hash_s, max(opt.roots)))
+    _micro(opt, '_checkfecsize', fec._checkfecsize)
+    _micro(opt, 'BootSh', lambda: BootSh(**fec._sh_vars))
+    sh = BootSh(**fec._sh_vars)
+    _micro(opt, 'BootSh bytes', lambda: (sh.get_header_bytes(), sh.get_body_bytes()))
+    return 0
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True,
+                              check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _stage_key(st: dict) -> str:
+    return st['name'] + ''.join(f' {k}={st[k]}' for k in ('roots', 'engine') if k in st)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Time of every stage against the baseline, 1 if one got slower by more than threshold percent."""
+    if baseline.get('bench') != results['bench'] or baseline.get('args') != results['args']:
+        print('The baseline was run with other options, the comparison is only indicative')
+    old = {_stage_key(st): st for st in baseline.get('stages', ())}
+    ret = 0
+    for st in results['stages']:
+        b = old.get(_stage_key(st))
+        # the micro benchmarks are compared per call, their wall time is too short
+        k, unit = ('us_call', 'us') if 'us_call' in st else ('wall', 's')
+        if b is None or not b.get(k):
+            continue
+        change = (st[k] - b[k]) / b[k] * 100
+        slower = change > threshold
+        ret |= slower
+        print(f'{_stage_key(st):>24}: {b[k]:10.3f}{unit} -> {st[k]:10.3f}{unit} {change:+7.1f}%',
+              'REGRESSION' if slower else '')
+    return ret
+
+
+async def main(opt: argparse.Namespace) -> int:
+    benches = {
+        'hashtree': bench_hashtree,
+        'fec': bench_fec,
+        'preflight': bench_preflight,
+        'compress': bench_compress,
+        'sparse': bench_sparse,
+        'fecsetup': bench_fecsetup,
+        'pipeline': bench_pipeline,
+        'micro': bench_micro,
+    }
+    opt.metrics = Metrics()
+    with tempfile.TemporaryDirectory(dir=opt.tmpdir) as tmpdir:
+        ret = await benches[opt.bench](opt, Path(tmpdir))
+    args = {k: v for k, v in vars(opt).items() if k not in ('metrics', 'json', 'baseline', 'threshold', 'tmpdir')}
+    # never the passcode
+    args['compress'] = None if opt.compress is None else bool(opt.compress)
+    results = dict(bench=opt.bench, commit=_git_commit(), python=platform.python_version(), cpus=os.cpu_count(),
+                   args=json.loads(json.dumps(args, default=str)), **opt.metrics.to_dict())
+    if opt.json:
+        with opt.json.open('w') as f:
+            json.dump(results, f, indent=2)
+    if opt.baseline:
+        with opt.baseline.open() as f:
+            ret |= compare(results, json.load(f), opt.threshold)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -51,6 +51,23 @@ class BootSh:
                     strf.write(s)
             return strf.getvalue()
 
+    @staticmethod
+    def parse_vars(b: bytes) -> dict:
+        ret = {}
+        for s in b.replace(b'\0', b'').decode(errors='replace').splitlines():
+            if s.startswith('IMG_DEV='):
+                break
+            k, *v = s.split('=', maxsplit=1)
+            if v and k.isidentifier():
+                v, = shlex.split(v[0]) or ('',)
+                ret[k] = v
+        return ret
+
+    @classmethod
+    def read_vars(cls, image: os.PathLike) -> dict:
+        with open(image, 'rb') as f:
+            return cls.parse_vars(f.read(0x8000))
+
     def get_header_bytes(self):
         b = self.header.encode()
         assert len(b) <= 218
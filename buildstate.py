@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import stat
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+from bulkio import BulkIO
+
+
+class BuildState:
+    """Finished build stages with their parameters and the sha256 of their output files, so --resume skips them.
+
+    A stage is reused only if it was recorded with the same parameters and every output file still has the
+    recorded digest. Output files of recorded stages are kept when a build fails."""
+
+    def __init__(self, file: os.PathLike, resume: bool = True, bulk_io: Optional[BulkIO] = None):
+        self.file = Path(file)
+        self.io = bulk_io or BulkIO()
+        self._stages = {}
+        self._digests = {}
+        if resume:
+            try:
+                self._stages = json.loads(self.file.read_text())
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+    @classmethod
+    def tree_key(cls, data_dir: os.PathLike) -> str:
+        """Names, modes, sizes, mtimes and link targets of a tree, the data of changed files changes them too."""
+        ents = []
+        for d, dirs, names in os.walk(data_dir):
+            dirs.sort()
+            for n in sorted(dirs + names):
+                p = os.path.join(d, n)
+                st = os.lstat(p)
+                ents.append([os.path.relpath(p, data_dir), st.st_mode, st.st_size, st.st_mtime_ns,
+                             os.readlink(p) if stat.S_ISLNK(st.st_mode) else None])
+        return cls.key(ents)
+
+    def digest(self, file: os.PathLike, offset: int = 0, length: Optional[int] = None) -> str:
+        st = os.stat(file)
+        ident = (os.path.abspath(file), offset, length, st.st_ino, st.st_size, st.st_mtime_ns)
+        d = self._digests.get(ident)
+        if d is None:
+            h = hashlib.sha256()
+            for b in self.io.read(file, offset, length):
+                h.update(b)
+            d = self._digests[ident] = h.hexdigest()
+        return d
+
+    def _verify(self, files: list) -> bool:
+        for path, offset, length, digest in files:
+            try:
+                if os.path.getsize(path) < offset + length or self.digest(path, offset, length) != digest:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def lookup(self, stage: str, params: dict) -> Optional[dict]:
+        """Result of a finished stage, None if it has to run again."""
+        ent = self._stages.get(stage)
+        if ent is None or ent['params'] != self.key(params):
+            return None
+        if not self._verify(ent['files']):
+            del self._stages[stage]
+            self.save()
+            return None
+        return ent['result']
+
+    def record(self, stage: str, params: dict, files: Sequence[Tuple[os.PathLike, int, Optional[int]]] = (),
+               **result) -> None:
+        ents = []
+        for path, offset, length in files:
+            if length is None:
+                length = os.path.getsize(path) - offset
+            ents.append([os.path.abspath(path), offset, length, self.digest(path, offset, length)])
+        self._stages[stage] = {'params': self.key(params), 'files': ents, 'result': result}
+        self.save()
+
+    def output(self, stage: str) -> Optional[str]:
+        """Digest of the first output file of a stage recorded or looked up before."""
+        ent = self._stages.get(stage)
+        return ent['files'][0][3] if ent and ent['files'] else None
+
+    def keeps(self, file: os.PathLike) -> bool:
+        path = os.path.abspath(file)
+        return any(f[0] == path for ent in self._stages.values() for f in ent['files'])
+
+    def forget(self, stage: str) -> None:
+        if self._stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self) -> None:
+        tmp = self.file.with_name(f'.{self.file.name}.{os.getpid()}')
+        tmp.write_text(json.dumps(self._stages))
+        os.replace(tmp, self.file)
+
+    def clear(self, keep: Sequence[os.PathLike] = ()) -> None:
+        """Remove the state and the output files of its stages, except the ones in keep."""
+        keep = {os.path.abspath(f) for f in keep}
+        for ent in self._stages.values():
+            for path, *_ in ent['files']:
+                if path not in keep:
+                    Path(path).unlink(missing_ok=True)
+                    with suppress(OSError):
+                        Path(path).parent.rmdir()
+        self._stages = {}
+        self.file.unlink(missing_ok=True)
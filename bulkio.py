@@ -0,0 +1,136 @@
+import mmap
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, Iterator, Optional, Tuple
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0) -> None:
+    """Drop the clean cached pages of a range, writeback of dirty ones is started so that a later call drops them."""
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def prefetch(fd: int, offset: int, length: int) -> None:
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def release(m: mmap.mmap, offset: int, length: int) -> None:
+    """Unmap the pages of a range of a shared file mapping, they stay cached until drop_cache evicts them.
+
+    Mapped pages are never dropped from the page cache, so workers release what they have read."""
+    lo = offset // mmap.PAGESIZE * mmap.PAGESIZE
+    hi = min(offset + length, len(m))
+    if lo < hi:
+        m.madvise(mmap.MADV_DONTNEED, lo, hi - lo)
+
+
+class BulkIO:
+    """Sequential transfers of image data through a few reusable page aligned buffers.
+
+    At most mem bytes of buffers are in use, filled ahead of the consumer by a thread. With direct, files are
+    opened with O_DIRECT where the filesystem allows it, otherwise the pages behind the transfer are dropped from
+    the page cache. Either way the page cache does not grow with the size of the image."""
+    _ALIGN: Final[int] = 4096
+    _CHUNK_SZ: Final[int] = 8 * 1024 * 1024
+
+    def __init__(self, mem: int = 64 * 1024 * 1024, direct: bool = False, chunk: int = _CHUNK_SZ):
+        self.chunk = max(chunk // self._ALIGN, 1) * self._ALIGN
+        self.depth = max(mem // self.chunk, 2)
+        self.direct = direct
+        self._bufs: list = []
+        # transfers share the buffers, one at a time, which is how a disk is best read anyway
+        self._lock = threading.Lock()
+
+    def _open(self, file: os.PathLike, flags: int) -> Tuple[int, bool]:
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(file, flags | os.O_DIRECT), True
+            except OSError:
+                # tmpfs and some fuse filesystems refuse O_DIRECT
+                pass
+        return os.open(file, flags), False
+
+    def _fill(self, fd: int, buf: mmap.mmap, pos: int, n: int) -> int:
+        view, got = memoryview(buf), 0
+        while got < n:
+            k = os.preadv(fd, [view[got:n]], pos + got)
+            if not k:
+                break
+            got += k
+        return got
+
+    def read(self, file: os.PathLike, offset: int = 0, length: Optional[int] = None) -> Iterator[memoryview]:
+        """Chunks of [offset, offset + length) of file, each one valid until the next one is taken."""
+        with self._lock:
+            fd, direct = self._open(file, os.O_RDONLY)
+            try:
+                # st_size is 0 for a device
+                end = os.lseek(fd, 0, os.SEEK_END) if length is None else offset + length
+                pos = offset - offset % self._ALIGN if direct else offset
+                if not direct:
+                    try:
+                        os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_SEQUENTIAL)
+                    except OSError:
+                        pass
+                while len(self._bufs) < self.depth:
+                    self._bufs.append(mmap.mmap(-1, self.chunk))
+                with ThreadPoolExecutor(max_workers=1) as ex:
+                    pending = deque()
+
+                    def submit(k: int) -> None:
+                        p = pos + k * self.chunk
+                        if p < end:
+                            # O_DIRECT needs the length aligned as well, a short read tells the end of file
+                            n = min(self.chunk, -(-(end - p) // self._ALIGN) * self._ALIGN if direct else end - p)
+                            pending.append((p, ex.submit(self._fill, fd, self._bufs[k % self.depth], p, n)))
+
+                    for k in range(self.depth - 1):
+                        submit(k)
+                    k = 0
+                    while pending:
+                        p, fut = pending.popleft()
+                        got = fut.result()
+                        submit(k + self.depth - 1)
+                        lo, hi = max(offset, p) - p, min(end, p + got) - p
+                        if lo < hi:
+                            yield memoryview(self._bufs[k % self.depth])[lo:hi]
+                        if not direct:
+                            drop_cache(fd, p, got)
+                        if p + got < min(end, p + self.chunk):
+                            break
+                        k += 1
+                    for _, fut in pending:
+                        fut.cancel()
+            finally:
+                os.close(fd)
+
+    def copy(self, src: os.PathLike, dst_fd: int, dst_off: int = 0, offset: int = 0,
+             length: Optional[int] = None) -> int:
+        """Copy [offset, offset + length) of src to dst_off of dst_fd, the written pages are dropped behind."""
+        pos = lag = mark = dst_off
+        for view in self.read(src, offset, length):
+            n = 0
+            while n < len(view):
+                n += os.pwrite(dst_fd, view[n:], pos + n)
+            pos += n
+            # dirty pages are only written back by the first call, the next one finds them clean and drops them
+            if pos - mark >= self.chunk * self.depth:
+                drop_cache(dst_fd, lag, pos - lag)
+                lag, mark = mark, pos
+        os.fdatasync(dst_fd)
+        drop_cache(dst_fd, dst_off, pos - dst_off)
+        return pos - dst_off
+
+    @staticmethod
+    def flush(file: os.PathLike) -> None:
+        """Write back and drop all cached pages of file."""
+        with open(file, 'rb') as f:
+            os.fdatasync(f.fileno())
+            drop_cache(f.fileno())
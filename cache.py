@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+from pathlib import Path
+from typing import Collection, Final, Optional
+
+
+class BuildCache:
+    """Content addressed store of build artifacts, the least recently used ones are evicted beyond max_size.
+
+    The sha256 of every data file is remembered by path, inode, size and mtime, so unchanged files are not read
+    again to find out they are unchanged."""
+    _INDEX_NAME: Final[str] = 'files.json'
+    _READ_SZ: Final[int] = 1024 * 1024
+
+    def __init__(self, root: os.PathLike, max_size: int):
+        self.root = Path(root)
+        self.max_size = max_size
+        self.objects = self.root / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        # size of the store, counted on the first eviction and kept up to date by the puts of this process
+        self._total: Optional[int] = None
+        self._index_file = self.root / self._INDEX_NAME
+        try:
+            self._index = json.loads(self._index_file.read_text())
+        except (OSError, ValueError):
+            self._index = {}
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+    def _object(self, key: str) -> Path:
+        return self.objects / key[:2] / key
+
+    def get(self, key: str) -> Optional[Path]:
+        obj = self._object(key)
+        try:
+            # the mtime of an object is its last use
+            os.utime(obj)
+        except FileNotFoundError:
+            return None
+        return obj
+
+    def _commit(self, key: str, tmp: Path, evict: bool) -> Path:
+        obj = self._object(key)
+        if self._total is not None:
+            self._total += tmp.stat().st_size - (obj.stat().st_size if obj.exists() else 0)
+        os.replace(tmp, obj)
+        if evict:
+            self.evict(keep=(key,))
+        return obj
+
+    def put(self, key: str, src: os.PathLike, evict: bool = True) -> Path:
+        obj = self._object(key)
+        obj.parent.mkdir(exist_ok=True)
+        tmp = obj.with_name(f'.{key}.{os.getpid()}')
+        shutil.copyfile(src, tmp)
+        return self._commit(key, tmp, evict)
+
+    def put_bytes(self, key: str, b: bytes, evict: bool = True) -> Path:
+        """Store b under key. A batch of puts passes evict=False and calls evict once after the last one."""
+        obj = self._object(key)
+        obj.parent.mkdir(exist_ok=True)
+        tmp = obj.with_name(f'.{key}.{os.getpid()}')
+        tmp.write_bytes(b)
+        return self._commit(key, tmp, evict)
+
+    def evict(self, keep: Collection[str] = ()) -> None:
+        """Delete the least recently used objects beyond max_size, except the keys in keep."""
+        if self._total is not None and self._total <= self.max_size:
+            return
+        objs = []
+        for d in self.objects.iterdir():
+            for p in d.iterdir():
+                if not p.name.startswith('.'):
+                    st = p.stat()
+                    objs.append((st.st_mtime, st.st_size, p))
+        self._total = sum(s for _, s, _ in objs)
+        keep = set(keep)
+        for _, size, p in sorted(objs):
+            if self._total <= self.max_size:
+                break
+            if p.name not in keep:
+                p.unlink(missing_ok=True)
+                self._total -= size
+
+    def file_digest(self, path: os.PathLike) -> str:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        ident = [st.st_ino, st.st_size, st.st_mtime_ns]
+        ent = self._index.get(path)
+        if ent and ent[:3] == ident:
+            return ent[3]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while b := f.read(self._READ_SZ):
+                h.update(b)
+        self._index[path] = ident + [h.hexdigest()]
+        return h.hexdigest()
+
+    def tree_digest(self, data_dir: os.PathLike) -> str:
+        """Digest of everything mksquashfs stores of a tree with -all-root: names, modes, mtimes, links and data."""
+        h = hashlib.sha256()
+        for d, dirs, names in os.walk(data_dir):
+            dirs.sort()
+            for n in sorted(dirs + names):
+                p = os.path.join(d, n)
+                st = os.lstat(p)
+                ent = [os.path.relpath(p, data_dir), st.st_mode, st.st_mtime_ns]
+                if stat.S_ISLNK(st.st_mode):
+                    ent.append(os.readlink(p))
+                elif stat.S_ISREG(st.st_mode):
+                    ent.append(self.file_digest(p))
+                h.update(json.dumps(ent).encode())
+        self.save()
+        return h.hexdigest()
+
+    def save(self) -> None:
+        tmp = self._index_file.with_name(f'.{self._INDEX_NAME}.{os.getpid()}')
+        tmp.write_text(json.dumps(self._index))
+        os.replace(tmp, self._index_file)
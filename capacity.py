@@ -16,9 +16,12 @@ class DiscCapacity:
     _DiscName = ('DVD+R', 'DVD+R DL', 'BD-XL TL', 'BD-XL QL')
     _DiscSectors = (2295104, 4173824, 48878592, 62500864)
 
-    def __init__(self, ds):
+    def __init__(self, ds, disc_name=None):
         self.ds = ds
-        self.disc_name, self.total_s = self._get_closest()
+        if disc_name is None:
+            self.disc_name, self.total_s = self._get_closest()
+        else:
+            self.disc_name, self.total_s = disc_name, self._DiscSectors[self._DiscName.index(disc_name)]
 
     def _get_closest(self):
         dist = np.array(self._DiscSectors, dtype=np.int_) - self.ds
@@ -71,6 +74,16 @@ class NumberSegments:
             return s.getvalue()
 
 
+def number_ranges(numbers) -> list:
+    ret = []
+    for i in sorted(numbers):
+        if ret and ret[-1][1] + 1 == i:
+            ret[-1][1] = i
+        else:
+            ret.append([i, i])
+    return ret
+
+
 class VolID:
     def __init__(self, s: str):
         s = s.strip()
@@ -101,6 +114,46 @@ class DiscID:
         return self.s
 
 
+class FecRoots:
+    _POLICIES = ('ask', 'preview', 'auto', 'max')
+
+    def __init__(self, s: str = 'ask'):
+        s = s.strip().lower()
+        if s not in self._POLICIES and not 2 <= int(s) <= 24:
+            raise ValueError(s)
+        self.s = s
+
+    def get_roots(self):
+        return None if self.s in self._POLICIES else int(self.s)
+
+    def __str__(self):
+        return self.s
+
+
+class CompProfile:
+    _OPTIONS = {
+        'xz': '-comp xz -Xbcj x86 -Xdict-size 1M',
+        'zstd': '-comp zstd -Xcompression-level {}',
+        'lz4': '-comp lz4 -Xhc',
+    }
+
+    def __init__(self, s: str = 'xz'):
+        s = s.strip().lower()
+        comp, _, level = s.partition(':')
+        self.passthrough = comp == 'auto'
+        self.comp = 'xz' if self.passthrough else comp
+        if self.comp not in self._OPTIONS or level and (self.comp != 'zstd' or not 1 <= int(level) <= 22):
+            raise ValueError(s)
+        self.level = int(level) if level else 15 if self.comp == 'zstd' else None
+        self.s = s
+
+    def get_options(self) -> list:
+        return self._OPTIONS[self.comp].format(self.level).split()
+
+    def __str__(self):
+        return self.s
+
+
 class PassHint:
     def __init__(self, s: str = 'Please input you password'):
         assert isinstance(s, str)
@@ -0,0 +1,189 @@
+import lzma
+import os
+import stat
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Final, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+from capacity import CompProfile
+
+
+def walk_files(data_dir: os.PathLike) -> List[Tuple[str, int]]:
+    """Regular files under data_dir as (relative path, size), sorted by path."""
+    data_dir = Path(data_dir)
+    files = []
+    for d, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        for n in sorted(names):
+            p = os.path.join(d, n)
+            if os.path.isfile(p) and not os.path.islink(p):
+                files.append((os.path.relpath(p, data_dir), os.path.getsize(p)))
+    return files
+
+
+def walk_links(data_dir: os.PathLike) -> Tuple[List[str], List[str]]:
+    """Symlinks and empty directories under data_dir, the entries walk_files leaves out, as relative paths.
+
+    Other special files, device nodes, fifos and sockets, raise ValueError."""
+    data_dir = Path(data_dir)
+    links, empty = [], []
+    for d, dirs, names in os.walk(data_dir):
+        dirs.sort()
+        for n in sorted(dirs + names):
+            p = os.path.join(d, n)
+            mode = os.lstat(p).st_mode
+            if stat.S_ISLNK(mode):
+                links.append(os.path.relpath(p, data_dir))
+            elif not stat.S_ISDIR(mode) and not stat.S_ISREG(mode):
+                raise ValueError(f'{os.path.relpath(p, data_dir)}: special files are not supported')
+        if not dirs and not names and d != os.fspath(data_dir):
+            empty.append(os.path.relpath(d, data_dir))
+    return links, empty
+
+
+class SquashfsEstimate:
+    """Per-file size in the squashfs image, from samples compressed with the compressor of the profile."""
+    _BLOCK_SZ: Final[int] = 1024 * 1024
+    _SAMPLE_SZ: Final[int] = 64 * 1024
+    _MAX_SAMPLES: Final[int] = 8
+    # inode, directory entry and block list of a file, roughly
+    _INODE_SZ: Final[int] = 96
+    _XZ_FILTERS: Final[tuple] = ({'id': lzma.FILTER_X86}, {'id': lzma.FILTER_LZMA2, 'preset': 6, 'dict_size': 1 << 20})
+    _PASS_THRESHOLD: Final[float] = 0.98
+
+    def __init__(self, data_dir: os.PathLike, comp: CompProfile = CompProfile()):
+        self.data_dir = Path(data_dir)
+        self.comp = comp
+        if comp.comp == 'zstd' and zstandard is None or comp.comp == 'lz4' and lz4 is None:
+            raise RuntimeError(f'Estimating {comp.comp} needs the python module of the compressor')
+
+    def _compressed(self, b: bytes) -> int:
+        # the compressors are slow on incompressible data, which squashfs stores as is anyway
+        if len(zlib.compress(b, 1)) >= len(b):
+            return len(b)
+        if self.comp.comp == 'zstd':
+            return len(zstandard.ZstdCompressor(level=self.comp.level).compress(b))
+        if self.comp.comp == 'lz4':
+            # -Xhc, the default level of LZ4_compress_HC
+            return len(lz4.block.compress(b, mode='high_compression', compression=9, store_size=False))
+        return len(lzma.compress(b, format=lzma.FORMAT_RAW, filters=self._XZ_FILTERS))
+
+    def _stored(self, rel: str, size: int) -> bool:
+        # with auto, ImageCreate has the incompressible files stored uncompressed
+        return self.comp.passthrough and self._is_incompressible(rel, size, self._PASS_THRESHOLD)
+
+    def sample(self, rel: str, size: int) -> Tuple[int, int]:
+        """(raw, compressed) bytes of the samples taken from a file."""
+        if not size:
+            return 0, 0
+        if self._stored(rel, size):
+            return size, size
+        with (self.data_dir / rel).open('rb') as f:
+            if size <= self._SAMPLE_SZ:
+                b = f.read()
+                return len(b), min(self._compressed(b), len(b))
+            n = min(self._MAX_SAMPLES, (size + self._BLOCK_SZ - 1) // self._BLOCK_SZ)
+            raw = comp = 0
+            for k in range(n):
+                f.seek((size - self._SAMPLE_SZ) * k // max(n - 1, 1))
+                b = f.read(self._SAMPLE_SZ)
+                raw += len(b)
+                # squashfs stores a block uncompressed when compressing does not make it smaller
+                comp += min(self._compressed(b), len(b))
+            return raw, comp
+
+    def file_size(self, rel: str, size: int) -> int:
+        raw, comp = self.sample(rel, size)
+        return (size * comp + raw - 1) // raw + self._INODE_SZ if raw else self._INODE_SZ
+
+    def _file_sizes(self, files: List[Tuple[str, int]]) -> List[int]:
+        return [self.file_size(rel, size) for rel, size in files]
+
+    def file_sizes(self, files: List[Tuple[str, int]], workers: Optional[int] = None, batch: int = 256) -> List[int]:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futs = [pool.submit(self._file_sizes, files[i:i + batch]) for i in range(0, len(files), batch)]
+            return [s for f in futs for s in f.result()]
+
+    def _is_incompressible(self, rel: str, size: int, threshold: float) -> bool:
+        if size < self._SAMPLE_SZ:
+            return False
+        with (self.data_dir / rel).open('rb') as f:
+            raw = comp = 0
+            n = min(self._MAX_SAMPLES, (size + self._BLOCK_SZ - 1) // self._BLOCK_SZ)
+            for k in range(n):
+                f.seek((size - self._SAMPLE_SZ) * k // max(n - 1, 1))
+                b = f.read(self._SAMPLE_SZ)
+                raw += len(b)
+                comp += len(zlib.compress(b, 1))
+        return comp >= raw * threshold
+
+    def _incompressible(self, files: List[Tuple[str, int]], threshold: float) -> List[str]:
+        return [rel for rel, size in files if self._is_incompressible(rel, size, threshold)]
+
+    def incompressible(self, files: List[Tuple[str, int]], threshold: float = _PASS_THRESHOLD,
+                       workers: Optional[int] = None, batch: int = 256) -> List[str]:
+        """Files that a fast zlib pass over their samples can't shrink, already compressed media mostly."""
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futs = [pool.submit(self._incompressible, files[i:i + batch], threshold)
+                    for i in range(0, len(files), batch)]
+            return [rel for f in futs for rel in f.result()]
+
+    def _block(self, rel: str, off: int, size: int) -> Tuple[int, int]:
+        with (self.data_dir / rel).open('rb') as f:
+            f.seek(off)
+            b = f.read(size)
+        return len(b), min(self._compressed(b), len(b))
+
+    def image_size(self, files: List[Tuple[str, int]], samples: int = 64, workers: Optional[int] = None,
+                   seed: int = 0) -> Tuple[int, int]:
+        """Estimated squashfs image size and its standard error, from whole blocks sampled in proportion to size."""
+        sizes = np.array([s for _, s in files], dtype=np.int64)
+        total = int(sizes.sum())
+        meta = len(files) * self._INODE_SZ
+        if not total:
+            return meta, 0
+        # stratified: one byte position in every 1/samples of the data, the block holding it is compressed
+        pos = ((np.arange(samples) + np.random.default_rng(seed).random(samples)) * total / samples).astype(np.int64)
+        ends = np.cumsum(sizes)
+        picks = []
+        for i, p in zip(np.searchsorted(ends, pos, side='right').tolist(), pos.tolist()):
+            off = (p - int(ends[i] - sizes[i])) // self._BLOCK_SZ * self._BLOCK_SZ
+            picks.append((files[i][0], off, min(self._BLOCK_SZ, int(sizes[i]) - off)))
+        stored = set()
+        if self.comp.passthrough:
+            picked = {rel for rel, _, _ in picks}
+            stored = set(self.incompressible([f for f in files if f[0] in picked], workers=workers))
+        blocks = sorted(set(k for k in picks if k[0] not in stored))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            res = dict(zip(blocks, pool.map(self._block, *zip(*blocks)))) if blocks else {}
+        ratios = np.array([1 if k[0] in stored else res[k][1] / res[k][0] for k in picks])
+        err = ratios.std(ddof=1) / np.sqrt(samples) if samples > 1 else ratios[0]
+        return round(total * ratios.mean()) + meta, round(total * err)
+
+
+class IsoEstimate:
+    """Per-file size in an uncompressed ISO9660 image with Rock Ridge and Joliet."""
+    _BLK_SZ: Final[int] = 2048
+    # primary and Joliet directory records with Rock Ridge entries, roughly
+    _RECORD_SZ: Final[int] = 512
+    # system area, volume descriptors, path tables and the root directories
+    _RESERVE_S: Final[int] = 256
+
+    @classmethod
+    def image_blocks(cls, payload: int) -> int:
+        return (payload + cls._BLK_SZ - 1) // cls._BLK_SZ + cls._RESERVE_S
+
+    def file_sizes(self, files: List[Tuple[str, int]], workers: Optional[int] = None) -> List[int]:
+        return [(size + self._BLK_SZ - 1) // self._BLK_SZ * self._BLK_SZ + self._RECORD_SZ for _, size in files]
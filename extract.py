@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import stat
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from getpass import getpass
+from pathlib import Path, PurePosixPath
+from typing import Callable, Final, Iterator, List, Optional, Sequence, Tuple
+
+from bootsh import BootSh
+from capacity import sizeof_fmt
+from iso9660 import IsoReader
+from squashfs import Inode, SquashfsReader
+from verifiedimage import VerifiedImage
+from xtscrypt import XtsPlain64, derive_key
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Extract files from a finished image without root, verifying, '
+                                                 'decrypting and decompressing them in userspace')
+    parser.add_argument('image', type=Path, help='iso file or disc device')
+    parser.add_argument('paths', nargs='*', help='files or directories to extract (default: everything)')
+    parser.add_argument('-o', '--output', type=Path, default=Path('.'), help='output directory (default: .)')
+    parser.add_argument('-l', '--list', action='store_true', help='list the files instead of extracting')
+    parser.add_argument('-w', '--workers', type=int, help='decompression threads (default: all cores)')
+    parser.add_argument('--disc-id', help='disc id of an encrypted image, when it is not saved in the image')
+    parser.add_argument('--no-verify', action='store_true', help='skip the hash tree, e.g. for a faster restore '
+                                                                 'of an image verified before')
+    return parser.parse_intermixed_args()
+
+
+class _Volume:
+    """The squashfs image at [offset, offset + length) of the ISO as a read only file, decrypted when xts is set.
+
+    Sectors are fetched in the calling thread and may be opened, i.e. decrypted, in any other."""
+    _SECTOR_SZ: Final[int] = 512
+
+    def __init__(self, read: Callable[[int, int], bytes], offset: int, length: int,
+                 xts: Optional[XtsPlain64] = None):
+        self._read = read
+        self.offset = offset
+        self.length = length
+        self.xts = xts
+        self.pos = 0
+
+    def seek(self, pos: int) -> None:
+        self.pos = pos
+
+    def read(self, n: int) -> bytes:
+        b = self.open(*self.fetch(self.pos, n))
+        self.pos += len(b)
+        return b
+
+    def fetch(self, pos: int, n: int) -> Tuple[bytes, int, int, int]:
+        n = max(min(n, self.length - pos), 0)
+        if self.xts is None:
+            return self._read(self.offset + pos, n), 0, 0, n
+        # plain64 numbers the sectors from the start of the mapping
+        s0, s1 = pos // self._SECTOR_SZ, -(-(pos + n) // self._SECTOR_SZ)
+        raw = self._read(self.offset + s0 * self._SECTOR_SZ, (s1 - s0) * self._SECTOR_SZ)
+        return raw, s0, pos % self._SECTOR_SZ, n
+
+    def open(self, raw: bytes, sector: int, skip: int, n: int) -> bytes:
+        if self.xts is None:
+            return raw
+        raw = raw[:len(raw) // self._SECTOR_SZ * self._SECTOR_SZ]
+        return self.xts.decrypt(raw, sector)[skip:skip + n]
+
+
+class Extractor:
+    """Files of a finished image, read without root, device-mapper or loop devices.
+
+    Every block is checked against the hash tree as it is read, the squashfs image is decrypted sector by sector
+    as boot.sh would map it. Data blocks are read ahead by the calling thread and decrypted and decompressed by a
+    pool of threads, AES and the decompressors release the GIL."""
+    _READ_SZ: Final[int] = 1024 * 1024
+    _SECTOR_SZ: Final[int] = 512
+
+    def __init__(self, image: os.PathLike, disc: Optional[str] = None, passcode: Optional[str] = None,
+                 verify: bool = True, workers: Optional[int] = None):
+        self.image = Path(image)
+        self.vars = BootSh.read_vars(self.image)
+        self.workers = workers or os.cpu_count() or 1
+        self._img: Optional[VerifiedImage] = None
+        self._fd: Optional[int] = None
+        if verify:
+            self._img = VerifiedImage(self.image)
+            self.read = self._img.read
+        else:
+            self._fd = os.open(self.image, os.O_RDONLY)
+            self.read = lambda offset, n: os.pread(self._fd, n, offset)
+        self.iso: Optional[IsoReader] = None
+        self.sqfs: Optional[SquashfsReader] = None
+        self.volume: Optional[_Volume] = None
+        length = int(self.vars.get('LENGTH') or 0) * self._SECTOR_SZ
+        if not length:
+            self.iso = IsoReader(self.image, read=self.read)
+            return
+        xts = None
+        if self.vars.get('CIPHER') not in (None, '', 'null'):
+            xts = XtsPlain64(self._derive_key(length, disc, passcode))
+        self.volume = _Volume(self.read, int(self.vars['OFFSET']) * self._SECTOR_SZ, length, xts)
+        try:
+            self.sqfs = SquashfsReader(self.volume)
+        except ValueError:
+            if xts is None:
+                raise
+            raise ValueError('Not a squashfs image after decryption, the password or disc id may be wrong')
+
+    def _derive_key(self, length: int, disc: Optional[str], passcode: Optional[str]) -> bytes:
+        if disc is None:
+            disc = self.vars.get('_DISC_ID')
+        if disc is None:
+            disc = input('Input Disc ID: ')
+        if passcode is None:
+            passcode = self.vars.get('_PASS') or getpass(f'{self.vars.get("_HINT", "")}: ')
+        return derive_key(passcode, disc, f'{self.vars["DMID"]}_crypt', self.vars['CIPHER'], length)
+
+    def close(self) -> None:
+        if self.iso is not None:
+            self.iso.close()
+        if self._img is not None:
+            self._img.close()
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def entries(self) -> Iterator[Tuple[str, int, int, int, str, object]]:
+        """(path, mode, size, mtime, link target, ref) of every entry, parents before their children.
+
+        Without Rock Ridge the permissions are defaults, see modes, and the mtime is None when it is not recorded."""
+        if self.sqfs is not None:
+            for path, ino in self.sqfs.walk():
+                yield path, ino.mode, ino.size, ino.mtime, ino.target, ino
+        else:
+            for path, is_dir, extents, mode, mtime, target in self.iso.walk():
+                if mode is None:
+                    mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o644
+                size = 0 if stat.S_ISDIR(mode) or stat.S_ISLNK(mode) else sum(n for _, n in extents)
+                yield path, mode, size, mtime, target, extents
+
+    @property
+    def modes(self) -> bool:
+        """Whether the image records the permissions of its files."""
+        return self.sqfs is not None or self.iso.rr
+
+    def _set_attrs(self, dst: Path, mode: int, mtime: Optional[int]) -> None:
+        if self.modes:
+            os.chmod(dst, stat.S_IMODE(mode))
+        if mtime is not None:
+            os.utime(dst, (mtime, mtime))
+
+    def _iso_chunks(self, extents: List[Tuple[int, int]]) -> Iterator[Tuple[int, Future]]:
+        pos = 0
+        for start, size in extents:
+            for o in range(0, size, self._READ_SZ):
+                fut = Future()
+                fut.set_result(self.read(start * IsoReader._BLK_SZ + o, min(self._READ_SZ, size - o)))
+                yield pos + o, fut
+            pos += size
+
+    def _sqfs_chunks(self, ino: Inode, pool: ThreadPoolExecutor, frag: list) -> Iterator[Tuple[int, Future]]:
+        def block(raw: tuple, compressed: bool) -> bytes:
+            b = self.volume.open(*raw)
+            return self.sqfs.decompress(b, bs) if compressed else b
+
+        bs = self.sqfs.block_size
+        blocks = self.sqfs.data_blocks(ino)
+        if ino.frag_index is not None:
+            *blocks, (start, n, compressed) = blocks
+            # files sharing a fragment block are neighbours in the directory, one block is cached
+            if frag[0] != ino.frag_index:
+                frag[:] = ino.frag_index, pool.submit(block, self.volume.fetch(start, n), compressed)
+        for k, (start, n, compressed) in enumerate(blocks):
+            if n:
+                yield k * bs, pool.submit(block, self.volume.fetch(start, n), compressed)
+        if ino.frag_index is not None:
+            o = ino.frag_offset
+            fut = Future()
+            frag[1].add_done_callback(lambda f: fut.set_exception(f.exception()) if f.exception() else
+                                      fut.set_result(f.result()[o:o + ino.size % bs]))
+            yield len(blocks) * bs, fut
+
+    @staticmethod
+    def _selected(path: str, paths: Sequence[str]) -> bool:
+        return not paths or any(path == p or path.startswith(p + '/') for p in paths)
+
+    def extract(self, out_dir: os.PathLike, paths: Sequence[str] = ()) -> Tuple[int, int]:
+        """Files and bytes written below out_dir. Sparse blocks stay holes, owners are not restored, and neither are
+        permissions or times the image does not record."""
+        out_dir = Path(out_dir)
+        paths = [p.strip('/') for p in paths]
+        found, dirs = set(), []
+        files = bytes_out = 0
+        window = 4 * self.workers
+        pending = deque()
+        frag = [None, None]
+
+        def write(fd: int, pos: int, fut: Optional[Future], done: Optional[tuple]) -> None:
+            nonlocal bytes_out
+            if done is not None:
+                os.close(fd)
+                self._set_attrs(*done)
+                return
+            b = fut.result()
+            n = 0
+            while n < len(b):
+                n += os.pwrite(fd, b[n:], pos + n)
+            bytes_out += n
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for path, mode, size, mtime, target, ref in self.entries():
+                    if not self._selected(path, paths):
+                        continue
+                    found.update(p for p in paths if self._selected(path, [p]))
+                    rel = PurePosixPath(path)
+                    if rel.is_absolute() or '..' in rel.parts:
+                        print('Skipped unsafe path', path, file=sys.stderr)
+                        continue
+                    dst = out_dir / rel
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    if stat.S_ISDIR(mode):
+                        dst.mkdir(exist_ok=True)
+                        dirs.append((dst, mode, mtime))
+                        continue
+                    if stat.S_ISLNK(mode) or dst.is_symlink():
+                        dst.unlink(missing_ok=True)
+                    if stat.S_ISLNK(mode):
+                        os.symlink(target, dst)
+                        if mtime is not None:
+                            os.utime(dst, (mtime, mtime), follow_symlinks=False)
+                        continue
+                    if not stat.S_ISREG(mode):
+                        print('Skipped special file', path, file=sys.stderr)
+                        continue
+                    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                    os.ftruncate(fd, size)
+                    chunks = self._sqfs_chunks(ref, pool, frag) if self.sqfs is not None else self._iso_chunks(ref)
+                    for pos, fut in chunks:
+                        pending.append((fd, pos, fut, None))
+                        while len(pending) > window:
+                            write(*pending.popleft())
+                    # closed, and its mode and mtime set, after its last chunk is written
+                    pending.append((fd, 0, None, (dst, mode, mtime)))
+                    files += 1
+                while pending:
+                    write(*pending.popleft())
+            finally:
+                for fd, _, _, done in pending:
+                    if done is not None:
+                        os.close(fd)
+        for dst, mode, mtime in reversed(dirs):
+            self._set_attrs(dst, mode, mtime)
+        missing = [p for p in paths if p not in found]
+        if missing:
+            raise FileNotFoundError(', '.join(missing))
+        return files, bytes_out
+
+
+def main(opt: argparse.Namespace) -> int:
+    try:
+        ext = Extractor(opt.image, disc=opt.disc_id, verify=not opt.no_verify, workers=opt.workers)
+    except ValueError as e:
+        print(e)
+        return 1
+    with ext:
+        if opt.list:
+            for path, mode, size, _, target, _ in ext.entries():
+                print(stat.filemode(mode), size, f'{path} -> {target}' if target else path)
+            return 0
+        try:
+            files, size = ext.extract(opt.output, opt.paths)
+        except FileNotFoundError as e:
+            print('Not in the image:', e)
+            return 1
+        except (OSError, ValueError) as e:
+            print(e)
+            return 1
+    print(f'Extracted {files} files, {sizeof_fmt(size)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,109 @@
+import os
+import uuid
+from concurrent.futures import Executor
+from itertools import chain
+from pathlib import Path
+from typing import Final, Sequence
+
+import numpy as np
+
+from bootsh import BootSh
+from rsfec import FecLayout, ReedSolomon, accumulate_delta, read_blocks
+from verity import HashTree, map_file
+
+
+class FecImage:
+    _BLK_SZ: Final[int] = 2048
+    _SB_SZ: Final[int] = 512
+    _HASH_SZ: Final[int] = 16
+
+    def __init__(self, image: os.PathLike):
+        self.image = Path(image)
+        self.vars = BootSh.read_vars(self.image)
+        self.iso_sz, self.hash_sz = int(self.vars['ISO_SZ']), int(self.vars['HASH_SZ'])
+        self.data_blocks = self.iso_sz // self._BLK_SZ
+        self.hash_blocks = self.hash_sz // self._BLK_SZ
+        self.tree = HashTree(self.data_blocks)
+        with self.image.open('rb') as f:
+            f.seek(self.iso_sz + self._SB_SZ)
+            self.root_hash = f.read(self._HASH_SZ)
+            self.fec_roots, = f.read(1)
+        # as veritysetup, the fec protects the data and the hash area after the superblock
+        self.fec = FecLayout(self.data_blocks + self.hash_blocks - 1, self.fec_roots)
+        self.fec_off = self.iso_sz + self.hash_sz
+
+    def block_offset(self, j: int) -> int:
+        """Image offset of block j of the fec protected device."""
+        if j < self.data_blocks:
+            return j * self._BLK_SZ
+        return self.iso_sz + (1 + j - self.data_blocks) * self._BLK_SZ
+
+    def read_blocks(self, start: int, count: int) -> np.ndarray:
+        """Blocks of the fec protected device, the data blocks followed by the hash blocks after the superblock."""
+        sources = ((self.image, self.data_blocks), (self.image, self.hash_blocks - 1, self.data_blocks + 1))
+        return read_blocks(sources, start, count, self._BLK_SZ)
+
+    def read_parity(self, r0: int, r1: int) -> np.ndarray:
+        n = (r1 - r0) * self._BLK_SZ
+        par = np.frombuffer(map_file(self.image), dtype=np.uint8, count=n * self.fec_roots,
+                            offset=self.fec_off + r0 * self._BLK_SZ * self.fec_roots)
+        return par.reshape(n, self.fec_roots).T
+
+    def superblock(self) -> bytes:
+        """The superblock block as formatfec writes it, with the uuid of the one in the image."""
+        with self.image.open('rb') as f:
+            uuid_ = uuid.UUID(bytes=os.pread(f.fileno(), 16, self.iso_sz + 16))
+        b = self.tree.superblock(uuid_) + self.root_hash + bytes((self.fec_roots,))
+        return b + bytes(self._BLK_SZ - len(b))
+
+    def check_superblock(self) -> bool:
+        """The superblock is not covered by the fec, a damaged one is rebuilt from its fields instead."""
+        with self.image.open('rb') as f:
+            return os.pread(f.fileno(), self._BLK_SZ, self.iso_sz) == self.superblock()
+
+    def find_erasures(self, pool: Executor) -> list:
+        """Blocks of the fec protected device that failed verification, see check_superblock for the superblock."""
+        bad_hash = self.tree.verify_levels(self.image, self.root_hash, hash_off=self.iso_sz)
+        futs = self.tree.verify_leaves(pool, self.image, self.image, hash_off=self.iso_sz)
+        bad = sorted(chain.from_iterable(f.result() for f in futs))
+        return bad + (np.flatnonzero(bad_hash[1:]) + self.data_blocks).tolist()
+
+    def store_root_hash(self) -> None:
+        """Write the root hash and roots byte after the superblock, and repeat the root hash in the tail padding."""
+        fec_end = self.fec_off + self.fec.size
+        with self.image.open('r+b') as f:
+            f.seek(self.iso_sz + self._SB_SZ)
+            f.write(self.root_hash + bytes((self.fec_roots,)))
+            cnt, tail_rem = divmod(f.seek(0, os.SEEK_END) - fec_end, self._HASH_SZ)
+            f.seek(fec_end)
+            f.write(bytes(tail_rem) + self.root_hash * cnt)
+
+    def patch(self, offset: int, data: bytes) -> bytes:
+        """Overwrite ISO bytes at offset and update only the hash tree path and the fec parity they touch.
+
+        RS is linear, the parity of every changed block is fixed up with the contribution of old ^ new."""
+        if offset < 0 or offset + len(data) > self.iso_sz:
+            raise ValueError('patch outside of the ISO')
+        if not data:
+            return self.root_hash
+        start = offset // self._BLK_SZ
+        count = (offset + len(data) - 1) // self._BLK_SZ + 1 - start
+        changed = [(start, count)] + [(self.data_blocks + b - 1, n) for b, n in self.tree.path_blocks(start, count)]
+        old = [self.read_blocks(j, n) for j, n in changed]
+        with self.image.open('r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        self.root_hash = self.tree.update(self.image, self.image, start, count, hash_off=self.iso_sz)
+        for (j, n), o in zip(changed, old):
+            accumulate_delta(self.image, self.fec.blocks, self.fec_roots, j, self.read_blocks(j, n) ^ o,
+                             fec_off=self.fec_off)
+        self.store_root_hash()
+        return self.root_hash
+
+    def decode_round(self, r: int, blocks: Sequence[int]) -> list:
+        """Rebuild the blocks of round r given as erasures, returned as (block, bytes) pairs."""
+        rounds = self.fec.rounds
+        cw = np.concatenate([np.stack([self.read_blocks(i * rounds + r, 1) for i in range(self.fec.rsn)]),
+                             self.read_parity(r, r + 1)])
+        ReedSolomon(self.fec_roots).decode_erasures(cw, [j // rounds for j in blocks])
+        return [(j, cw[j // rounds].tobytes()) for j in blocks]
@@ -1,19 +1,28 @@
 import asyncio
+import hashlib
 import io
 import os
-import shutil
 import struct
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Final, Optional
+from typing import Callable, Final, Iterator, Optional, Sequence, Tuple
 
 import numpy as np
 import psutil
 from tqdm import tqdm
 
 from bootsh import BootSh
-from capacity import DiscCapacity, NumberSegments, sizeof_fmt, VolID, PassHint
+from buildstate import BuildState
+from bulkio import BulkIO, drop_cache, prefetch
+from cache import BuildCache
+from capacity import DiscCapacity, FecRoots, NumberSegments, sizeof_fmt, VolID, PassHint
 from imagecreate import acall
+from iso9660 import IsoReader
+from metrics import Metrics, Stage
+from scheduler import Resources
+from rsfec import FecLayout, accumulate_blocks
+from verity import HashTree
 
 
 class FECSetup:
@@ -22,13 +31,36 @@ class FECSetup:
     _HASH_SZ: Final[int] = 16
     _HASH_DIV: Final[int] = _BLK_SZ // _HASH_SZ
     _CLUSTER_SZ: Final[int] = 64 * 1024
+    _SYS_BLKS: Final[int] = 16
+    _STREAM_BLKS: Final[int] = 64 * 1024
+    _STREAM_MEM: Final[int] = 512 * 1024 * 1024
+    _VERITYSETUP_MEM: Final[int] = 64 * 1024 * 1024
+    # smaller files are hashed again, their cached digests would cost more than they save
+    _MIN_CACHED_BLKS: Final[int] = 256
 
     def __init__(self, isofile: os.PathLike, dmid: VolID, offset: int = 0, length: int = 0,
-                 cipher: Optional[str] = None, **kwargs):
+                 cipher: Optional[str] = None, engine: str = 'veritysetup', fec_policy: FecRoots = FecRoots(),
+                 fec_margin: int = 0, iso_blocks: Optional[int] = None, metrics: Optional[Metrics] = None,
+                 resources: Optional[Resources] = None, disc_type: Optional[str] = None,
+                 cache: Optional[BuildCache] = None, leaf_files: Sequence[Tuple[str, str]] = (),
+                 bulk_io: Optional[BulkIO] = None, state: Optional[BuildState] = None, **kwargs):
         self.isofile = Path(isofile)
-        self.iso_s = (os.path.getsize(self.isofile) + self._BLK_SZ - 1) // self._BLK_SZ
+        self.io = bulk_io or BulkIO()
+        self.state = state
+        self.metrics = metrics or Metrics()
+        self.resources = resources or Resources()
+        self.engine = engine
+        self.fec_policy = fec_policy
+        self.fec_margin = fec_margin
+        self.cache = cache
+        self.leaf_files = leaf_files
+        self._covered: list = []
+        self._uncached: list = []
+        if iso_blocks is None:
+            iso_blocks = (os.path.getsize(self.isofile) + self._BLK_SZ - 1) // self._BLK_SZ
+        self.iso_s = iso_blocks
         self.hash_s = self._hs(self.iso_s)
-        self.free_s = DiscCapacity(self.iso_s + self.hash_s)
+        self.free_s = DiscCapacity(self.iso_s + self.hash_s, disc_type)
         print('Assuming Disc Type:', self.free_s.disc_name)
 
         self.fec_roots = self._checkfecsize()
@@ -36,53 +68,103 @@ class FECSetup:
             print('Fec is not possible given current disc type')
             self.fec_roots = 24
 
-        self.sh = BootSh(
+        self._sh_vars = dict(
             ISO_SZ=self.iso_s * self._BLK_SZ, HASH_SZ=self.hash_s * self._BLK_SZ, DMID=dmid.get_dmid(),
             OFFSET=offset * 4, LENGTH=length * 4, CIPHER=cipher, **kwargs
         )
+        self.sh = BootSh(**self._sh_vars)
+        self._candidates: Optional[tuple] = None
+        self._tree: Optional[HashTree] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._streamed = (0, 0)
+        self._direct = False
         cpu_count = psutil.cpu_count(logical=False)
         fec_preview_count = min(self.fec_roots - 1, cpu_count) if cpu_count else self.fec_roots - 1
         self.fec_preview_set = tuple(round(a.item()) for a in np.linspace(self.fec_roots, 2, num=fec_preview_count))
 
-    def _hs(self, ds: int, superblock=True) -> int:
+    @classmethod
+    def _hs(cls, ds: int, superblock=True) -> int:
         h = int(superblock)
         while ds:
-            ds, rem = divmod(ds, self._HASH_DIV)
+            ds, rem = divmod(ds, cls._HASH_DIV)
             h += ds + 1
         return h
 
-    def _fec_len(self, ds: int, fec_roots: int) -> int:
-        fec_data_bits = 255 - fec_roots
-        h = ds * self._BLK_SZ
-        h = (h + fec_data_bits - 1) // fec_data_bits
-        h = h * fec_roots
-        return h
+    @classmethod
+    def _fec_len(cls, ds: int, hs: int, fec_roots: int) -> int:
+        # veritysetup covers the data and the hash area after the superblock, the kernel reads it the same way
+        return FecLayout(ds + hs - 1, fec_roots).size
+
+    @classmethod
+    def max_iso_blocks(cls, disc_s: int, fec_roots: int) -> int:
+        """Largest ISO in blocks that fits disc_s sectors together with its hash tree and fec."""
+        def used(ds):
+            hs = cls._hs(ds)
+            return ds + hs + (cls._fec_len(ds, hs, fec_roots) + cls._BLK_SZ - 1) // cls._BLK_SZ
+
+        lo, hi = 0, disc_s
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if used(mid) <= disc_s:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def _hashfile(self, fec_roots: int) -> Path:
+        return self.isofile.with_suffix('.hash' if self.engine == 'native' else f'.hash_{fec_roots}')
+
+    def _fecfile(self, fec_roots: int) -> Path:
+        return self.isofile.with_suffix(f'.fec_{fec_roots}')
+
+    def _image_size(self, fec_roots: int) -> int:
+        size = (self.iso_s + self.hash_s) * self._BLK_SZ + self._fec_len(self.iso_s, self.hash_s, fec_roots)
+        return (size + self._CLUSTER_SZ - 1) // self._CLUSTER_SZ * self._CLUSTER_SZ
+
+    def _preallocate(self, fec_roots: int) -> None:
+        off = self.iso_s * self._BLK_SZ
+        with self.isofile.open('r+b') as f:
+            f.truncate(off)
+            os.posix_fallocate(f.fileno(), off, self._image_size(fec_roots) - off)
+
+    def _copy_into(self, src: Path, dst_fd: int, off: int) -> None:
+        with src.open('rb') as f:
+            size, pos = os.fstat(f.fileno()).st_size, 0
+            try:
+                # reflinks or in-kernel copy where the filesystem allows
+                while pos < size:
+                    n = os.copy_file_range(f.fileno(), dst_fd, size - pos, pos, off + pos)
+                    if not n:
+                        break
+                    pos += n
+            except OSError:
+                pass
+        if pos < size:
+            self.io.copy(src, dst_fd, off + pos, pos, size - pos)
 
     def _combine_with_root_hash(self, hashfile: Path, fecfile: Path, root_hash: bytes, sel_roots: int) -> None:
-        root_off = self.iso_s * self._BLK_SZ + self._SB_SZ
+        hash_off = self.iso_s * self._BLK_SZ
+        fec_end = (self.iso_s + self.hash_s) * self._BLK_SZ + self._fec_len(self.iso_s, self.hash_s, sel_roots)
+        if not self._direct:
+            self._preallocate(sel_roots)
         with self.isofile.open('r+b') as isofd:
-            with hashfile.open('rb') as src:
-                isofd.seek(self.iso_s * self._BLK_SZ)
-                shutil.copyfileobj(src, isofd)
-            isofd.seek(root_off)
-            assert not np.fromfile(isofd, dtype=np.uint64, count=(self._BLK_SZ - self._SB_SZ) // 8).any()
-            isofd.seek(root_off)
+            if not self._direct:
+                self._copy_into(hashfile, isofd.fileno(), hash_off)
+                hashfile.unlink()
+                self._copy_into(fecfile, isofd.fileno(), (self.iso_s + self.hash_s) * self._BLK_SZ)
+                fecfile.unlink()
+            assert not any(os.pread(isofd.fileno(), self._BLK_SZ - self._SB_SZ, hash_off + self._SB_SZ))
+            isofd.seek(hash_off + self._SB_SZ)
             isofd.write(root_hash)
             isofd.write(struct.pack("B", sel_roots))
-            with fecfile.open('rb') as src:
-                isofd.seek(0, io.SEEK_END)
-                shutil.copyfileobj(src, isofd)
-
-        root_off = os.path.getsize(self.isofile)
-        tail_rem = root_off % self._CLUSTER_SZ
-        if tail_rem:
-            cnt, tail_rem = divmod(self._CLUSTER_SZ - tail_rem, self._HASH_SZ)
-            with self.isofile.open('r+b') as isofd:
-                isofd.seek(root_off)
-                if tail_rem:
-                    isofd.write(bytes(tail_rem))
-                for i in range(cnt):
-                    isofd.write(root_hash)
+
+            cnt, tail_rem = divmod(self._image_size(sel_roots) - fec_end, self._HASH_SZ)
+            isofd.seek(fec_end)
+            isofd.write(bytes(tail_rem) + root_hash * cnt)
+            isofd.flush()
+            # the image is done, keeping it cached only pushes out everything else
+            os.fdatasync(isofd.fileno())
+            drop_cache(isofd.fileno())
 
     def _patch_iso(self) -> None:
         iso_size = os.path.getsize(self.isofile)
@@ -104,7 +186,7 @@ class FECSetup:
         if disc_s < 0:
             return -1
         fec_len = np.fromiter(
-            (self._fec_len(self.iso_s + self.hash_s, r) for r in range(24, 1, -1)), dtype=np.int_, count=24 - 1)
+            (self._fec_len(self.iso_s, self.hash_s, r) for r in range(24, 1, -1)), dtype=np.int_, count=24 - 1)
         fec_len += self._BLK_SZ - 1
         fec_len //= self._BLK_SZ
         fec_len -= disc_s - self.iso_s - self.hash_s
@@ -113,7 +195,8 @@ class FECSetup:
             return 24 - idx.item(0)
         return 0
 
-    async def _veriysetup(self, hashfile: Path, fecfile: Path, fec_roots: int, queue: asyncio.Semaphore) -> bytes:
+    async def _veriysetup(self, hashfile: Path, fecfile: Path, fec_roots: int,
+                          progress: Callable[[int], object]) -> bytes:
         hashfile.unlink(missing_ok=True)
         fecfile.unlink(missing_ok=True)
 
@@ -121,8 +204,10 @@ class FECSetup:
                 f'--data-block-size={self._BLK_SZ}', f'--hash-block-size={self._BLK_SZ}',
                 f'--fec-device={os.fspath(fecfile)}', os.fspath(self.isofile), os.fspath(hashfile)]
 
-        async with queue:
-            msg = await acall(*args, capture=True)
+        async with self.resources.hold(cpu=1, mem=self._VERITYSETUP_MEM):
+            with self.metrics.stage('veritysetup', progress=progress, roots=fec_roots) as st:
+                msg = await acall(*args, capture=True)
+                st.add((self.iso_s + self.hash_s) * self._BLK_SZ)
 
         assert os.path.getsize(hashfile) == self.hash_s * self._BLK_SZ
 
@@ -139,81 +224,309 @@ class FECSetup:
 
         return root_hash
 
-    async def _try_different_fecroots(self):
-        q = asyncio.BoundedSemaphore(value=os.cpu_count())
+    def _fec_params(self, fec_roots: int) -> Optional[dict]:
+        """Inputs of the hash tree and fec of one roots value, None unless the ISO is a recorded stage."""
+        if self.state is None or self.state.output('iso') is None:
+            return None
+        with self.isofile.open('rb') as f:
+            header = hashlib.sha256(os.pread(f.fileno(), self._SYS_BLKS * self._BLK_SZ, 0)).hexdigest()
+        return {'iso': self.state.output('iso'), 'header': header, 'blocks': self.iso_s, 'engine': self.engine,
+                'roots': fec_roots}
+
+    async def _resume_fec(self, fec_roots: int) -> Optional[bytes]:
+        params = self._fec_params(fec_roots)
+        ret = params and await asyncio.to_thread(self.state.lookup, f'fec_{fec_roots}', params)
+        return bytes.fromhex(ret['root_hash']) if ret else None
+
+    async def _record_fec(self, fec_roots: int, root_hash: bytes) -> None:
+        params = self._fec_params(fec_roots)
+        if params is not None:
+            files = [(self._hashfile(fec_roots), 0, None), (self._fecfile(fec_roots), 0, None)]
+            await asyncio.to_thread(self.state.record, f'fec_{fec_roots}', params, files, root_hash=root_hash.hex())
+
+    async def _veritysetup_or_resume(self, fec_roots: int, progress: Callable[[int], object]) -> bytes:
+        root_hash = await self._resume_fec(fec_roots)
+        if root_hash is not None:
+            print('Resuming with the hash tree and fec of', fec_roots, 'roots')
+            progress((self.iso_s + self.hash_s) * self._BLK_SZ)
+            return root_hash
+        root_hash = await self._veriysetup(self._hashfile(fec_roots), self._fecfile(fec_roots), fec_roots, progress)
+        await self._record_fec(fec_roots, root_hash)
+        return root_hash
 
-        co_list = set(self._veriysetup(self.isofile.with_suffix(f'.hash_{i}'), self.isofile.with_suffix(f'.fec_{i}'),
-                                       i, q) for i in self.fec_preview_set)
-        root_hash = None
-        total_s = self.hash_s * self._BLK_SZ * (self.fec_roots - 1)
-        total_s += sum(self._fec_len(self.iso_s + self.hash_s, i) for i in self.fec_preview_set)
+    async def _try_different_fecroots(self, candidates: tuple):
+        total_s = (self.iso_s + self.hash_s) * self._BLK_SZ * len(candidates)
         with tqdm(total=total_s, unit='B', dynamic_ncols=True, unit_scale=True, leave=False,
-                  desc=f'Roots({self.fec_roots}-2,{len(self.fec_preview_set)})') as pbar:
-            while True:
-                done, co_list = await asyncio.wait(co_list, timeout=1)
-                for t in done:
-                    if root_hash is None:
-                        root_hash = t.result()
+                  desc=f'Roots({max(candidates)}-{min(candidates)},{len(candidates)})') as pbar:
+            hashes = await asyncio.gather(*(self._veritysetup_or_resume(i, pbar.update) for i in candidates))
+        root_hash = hashes[0]
+        assert all(h == root_hash for h in hashes)
+        # the runs shared the cached ISO while they were reading it
+        BulkIO.flush(self.isofile)
+
+        print('Rec Calc Done.')
+        return root_hash
+
+    def _stream_open(self, candidates: tuple, direct: bool) -> None:
+        """With direct, the hash tree and the only candidate's fec are built in place in the preallocated ISO."""
+        self._direct = direct
+        if direct:
+            self._preallocate(candidates[0])
+        hashfile, hash_off = self._hash_area()
+        self._tree = HashTree(self.iso_s)
+        assert self._tree.hash_blocks <= self.hash_s
+        self._tree.create(hashfile, hash_blocks=self.hash_s, hash_off=hash_off)
+        if not direct:
+            for i in candidates:
+                with self._fecfile(i).open('wb') as f:
+                    f.truncate(self._fec_len(self.iso_s, self.hash_s, i))
+        self._pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    def _hash_area(self) -> Tuple[Path, int]:
+        return (self.isofile, self.iso_s * self._BLK_SZ) if self._direct else (self._hashfile(0), 0)
+
+    def _fec_area(self, fec_roots: int) -> Tuple[Path, int]:
+        if self._direct:
+            return self.isofile, (self.iso_s + self.hash_s) * self._BLK_SZ
+        return self._fecfile(fec_roots), 0
+
+    def _leaf_key(self, content_key: str) -> str:
+        return self.cache.key('leaves', content_key, HashTree._HASH_ALG, self._BLK_SZ)
+
+    def _load_leaves(self) -> None:
+        """Copy the cached leaf digests of unchanged files into the hash tree, those blocks are not hashed again."""
+        hashfile, hash_off = self._hash_area()
+        leaf_off = hash_off + self._tree.level_block[0] * self._BLK_SZ
+        with IsoReader(self.isofile) as iso, open(hashfile, 'r+b') as f:
+            for path, content_key in self.leaf_files:
+                try:
+                    start, size = iso.lookup(path)
+                except (FileNotFoundError, ValueError):
+                    continue
+                n = (size + self._BLK_SZ - 1) // self._BLK_SZ
+                if start < self._SYS_BLKS or n < self._MIN_CACHED_BLKS:
+                    continue
+                key = self._leaf_key(content_key)
+                obj = self.cache.get(key)
+                if obj is not None and obj.stat().st_size == n * self._HASH_SZ:
+                    os.pwrite(f.fileno(), obj.read_bytes(), leaf_off + start * self._HASH_SZ)
+                    self._covered.append((start, start + n))
+                else:
+                    self._uncached.append((start, n, key))
+        self._covered.sort()
+        print('Reusing cached hashes of', sizeof_fmt(sum(e - s for s, e in self._covered) * self._BLK_SZ))
+
+    def _store_leaves(self) -> None:
+        hashfile, hash_off = self._hash_area()
+        leaf_off = hash_off + self._tree.level_block[0] * self._BLK_SZ
+        with open(hashfile, 'rb') as f:
+            for start, n, key in self._uncached:
+                self.cache.put_bytes(key, os.pread(f.fileno(), n * self._HASH_SZ, leaf_off + start * self._HASH_SZ),
+                                     evict=False)
+        self.cache.evict(keep=[key for _, _, key in self._uncached])
+
+    def _uncovered(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        for s, e in self._covered:
+            if e <= start or s >= end:
+                continue
+            if s > start:
+                yield start, s - start
+            start = e
+        if start < end:
+            yield start, end - start
+
+    def _stream_close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    async def _stream_blocks(self, candidates: tuple, start: int, end: int, stage: Stage) -> None:
+        hashfile, hash_off = self._hash_area()
+        # the fec covers the hash area from the block after the superblock on
+        sources = ((os.fspath(self.isofile), self.iso_s),
+                   (os.fspath(hashfile), self.hash_s - 1, hash_off // self._BLK_SZ + 1))
+        # every window is read once and handed to the hash tree and all candidate encoders together. The next one is
+        # read ahead meanwhile and a finished one is dropped from the page cache, so two windows stay cached at most.
+        fd = os.open(sources[0][0], os.O_RDONLY)
+        try:
+            for s in range(start, end, self._STREAM_BLKS):
+                n = min(self._STREAM_BLKS, end - s)
+                if s + n < end:
+                    prefetch(fd, (s + n) * self._BLK_SZ, min(self._STREAM_BLKS, end - s - n) * self._BLK_SZ)
+                await self._stream_window(candidates, s, n, sources, hashfile, hash_off)
+                drop_cache(fd, s * self._BLK_SZ, n * self._BLK_SZ)
+                stage.add(n * self._BLK_SZ)
+        finally:
+            os.close(fd)
+
+    async def _stream_window(self, candidates: tuple, s: int, n: int, sources: tuple, hashfile: Path,
+                             hash_off: int) -> None:
+        futs = []
+        for hs, hn in self._uncovered(s, min(s + n, self.iso_s)):
+            futs += self._tree.hash_leaves(self._pool, self.isofile, hashfile, hs, hn, hash_off)
+        for i in candidates:
+            fecfile, fec_off = self._fec_area(i)
+            futs.append(self._pool.submit(accumulate_blocks, sources, i, s, n, os.fspath(fecfile),
+                                          fec_off=fec_off))
+        await asyncio.gather(*map(asyncio.wrap_future, futs))
+
+    async def stream_iso(self, done: asyncio.Event, poll_intvl: float = 0.5) -> None:
+        """Hash and encode the ISO while it is being written, until done is set.
+
+        The first 16 blocks are left for formatfec, as the boot header is patched into them afterwards."""
+        if self._candidates is None:
+            await self.select_candidates()
+        # the ISO is still growing, so the hash tree and fec can't be placed in it yet
+        self._stream_open(self._candidates, direct=False)
+        start = pos = self._SYS_BLKS
+        try:
+            with self.metrics.stage('stream_iso', roots=self._candidates) as st:
+                while True:
+                    finished = done.is_set()
+                    # the ISO is written sequentially into a new file, so its size tells how far it is complete
+                    avail = min(os.path.getsize(self.isofile) // self._BLK_SZ if self.isofile.exists() else 0,
+                                self.iso_s)
+                    if not finished:
+                        # only whole windows, the last one may still be partially written
+                        avail = pos + max(avail - pos - 1, 0) // self._STREAM_BLKS * self._STREAM_BLKS
+                    if avail > pos:
+                        await self._stream_blocks(self._candidates, pos, avail, st)
+                        pos = avail
+                    elif finished:
+                        break
                     else:
-                        assert t.result() == root_hash
-                ps = 0
-                for i in range(self.fec_roots, 1, -1):
-                    hashfile = self.isofile.with_suffix(f'.hash_{i}')
-                    if hashfile.exists():
-                        ps += os.path.getsize(hashfile)
-                    fecfile = self.isofile.with_suffix(f'.fec_{i}')
-                    if fecfile.exists():
-                        ps += os.path.getsize(fecfile)
-                pbar.update((ps if ps < pbar.total else pbar.total) - pbar.n)
-                if not co_list:
-                    pbar.update(pbar.total - pbar.n)
-                    break
+                        await asyncio.sleep(poll_intvl)
+        except BaseException:
+            self._stream_close()
+            raise
+        self._streamed = (start, pos)
+
+    async def _stream_fecroots(self, candidates: tuple) -> bytes:
+        if self._pool is None and len(candidates) > 1:
+            # a single candidate is built in place in the ISO, only separate files are kept for resuming
+            hashes = {await self._resume_fec(i) for i in candidates}
+            if None not in hashes and len(hashes) == 1:
+                print('Resuming with the hash tree and fec of', *candidates, 'roots')
+                return hashes.pop()
+        if self._pool is None:
+            self._stream_open(candidates, direct=len(candidates) == 1)
+            if self.cache is not None and self.leaf_files:
+                with self.metrics.stage('load_leaves'):
+                    await asyncio.to_thread(self._load_leaves)
+        hashfile, hash_off = self._hash_area()
+        lo, hi = self._streamed
+        total_s = self.iso_s + self.hash_s - 1
+        with tqdm(total=total_s * self._BLK_SZ, unit='B', dynamic_ncols=True, unit_scale=True, leave=False,
+                  desc=f'Roots({max(candidates)}-{min(candidates)},{len(candidates)})') as pbar:
+            pbar.update((hi - lo) * self._BLK_SZ)
+            async with self.resources.hold(cpu=os.cpu_count() or 1, io=1, mem=self._STREAM_MEM):
+                with self.metrics.stage('fec_stream', progress=pbar.update, roots=candidates,
+                                        direct=self._direct) as st:
+                    await self._stream_blocks(candidates, 0, lo, st)
+                    await self._stream_blocks(candidates, hi, self.iso_s, st)
+                    root_hash = await asyncio.get_running_loop().run_in_executor(
+                        self._pool, self._tree.finish, self.isofile, hashfile, hash_off)
+                    if self._uncached:
+                        await asyncio.to_thread(self._store_leaves)
+                    await self._stream_blocks(candidates, self.iso_s, total_s, st)
+        if not self._direct:
+            for i in candidates:
+                await self._record_fec(i, root_hash)
 
         print('Rec Calc Done.')
         return root_hash
 
-    def _select_lucky_fec(self):
-        disc_s = self.free_s.total_s
+    def _leftover(self, fec_roots: int) -> int:
+        fec_s = (self._fec_len(self.iso_s, self.hash_s, fec_roots) + self._BLK_SZ - 1) // self._BLK_SZ
+        return (self.free_s.total_s - self.iso_s - self.hash_s - fec_s) * self._BLK_SZ
+
+    def _print_plan(self, candidates: tuple) -> None:
         prev_str = None
-        for i in self.fec_preview_set:
-            fecfile = self.isofile.with_suffix(f'.fec_{i}')
-            fec_s = (os.path.getsize(fecfile) + self._BLK_SZ - 1) // self._BLK_SZ
-            size_s = (disc_s - self.iso_s - self.hash_s - fec_s) * self._BLK_SZ
+        for i in candidates:
+            size_s = self._leftover(i)
             if prev_str != size_s:
                 if prev_str:
                     print(prev_str, end='  ')
                 prev_str = NumberSegments(size_s)
             prev_str.add_val(i)
-
         print(prev_str)
+
+    def _select_lucky_fec(self, candidates: tuple) -> int:
         while True:
             try:
                 sel_roots = int(input('\nSelect your lucky number: '))
-                if sel_roots in self.fec_preview_set:
-                    break
+                if sel_roots in candidates:
+                    return sel_roots
             except ValueError:
                 pass
-            print('Your selection must be one of', self.fec_preview_set)
-
-        hashfile = self.isofile.with_suffix(f'.hash_{sel_roots}')
-        fecfile = self.isofile.with_suffix(f'.fec_{sel_roots}')
-
-        return hashfile, fecfile, sel_roots
+            print('Your selection must be one of', candidates)
+
+    def _plan_fec(self) -> int:
+        if self.fec_policy.get_roots():
+            if self._leftover(self.fec_policy.get_roots()) < 0 <= self.free_s.total_s:
+                print('Fec roots', self.fec_policy, 'does not fit given current disc type')
+            return self.fec_policy.get_roots()
+        if self.fec_policy.s == 'max' or self.free_s.total_s < 0:
+            return self.fec_roots
+        if self.fec_policy.s == 'auto':
+            fit = [i for i in range(24, 1, -1) if self._leftover(i) >= self.fec_margin]
+            if not fit:
+                print('No fec roots leaves', sizeof_fmt(self.fec_margin), 'free, using the smallest one')
+            return fit[0] if fit else 2
+        return self._select_lucky_fec(tuple(range(self.fec_roots, 1, -1)))
 
     def _clean_different_fecroots(self):
-        for i in range(self.fec_roots, 1, -1):
-            self.isofile.with_suffix(f'.hash_{i}').unlink(missing_ok=True)
-            self.isofile.with_suffix(f'.fec_{i}').unlink(missing_ok=True)
+        for i in range(24, 1, -1):
+            for file in (self._hashfile(i), self._fecfile(i)):
+                # a failed build keeps what --resume can start from
+                if self.state is None or not self.state.keeps(file):
+                    file.unlink(missing_ok=True)
+
+    def _select_candidates(self) -> tuple:
+        if self.free_s.total_s >= 0:
+            self._print_plan(tuple(range(self.fec_roots, 1, -1)))
+        if self.fec_policy.s == 'preview':
+            return self.fec_preview_set
+        candidates = (self._plan_fec(),)
+        print('Selected Fec Roots:', *candidates)
+        return candidates
+
+    async def select_candidates(self) -> tuple:
+        """Plan the fec roots, a prompt for them runs in a thread so it doesn't block the event loop."""
+        self._candidates = await asyncio.to_thread(self._select_candidates)
+        return self._candidates
+
+    def set_extent(self, offset: int, length: int) -> None:
+        self._sh_vars.update(OFFSET=offset * 4, LENGTH=length * 4)
+        self.sh = BootSh(**self._sh_vars)
 
     async def formatfec(self) -> int:
-        self._patch_iso()
+        with self.metrics.stage('patch_iso'):
+            self._patch_iso()
 
         try:
-            root_hash = await self._try_different_fecroots()
-            hashfile, fecfile, sel_roots = self._select_lucky_fec()
-            fec_size = os.path.getsize(fecfile)
-            self._combine_with_root_hash(hashfile, fecfile, root_hash, sel_roots)
+            candidates = self._candidates or await self.select_candidates()
+            if self.engine == 'native':
+                root_hash = await self._stream_fecroots(candidates)
+            else:
+                root_hash = await self._try_different_fecroots(candidates)
+            if len(candidates) > 1:
+                sel_roots = await asyncio.to_thread(self._select_lucky_fec, candidates)
+            else:
+                sel_roots = candidates[0]
+            hashfile, fecfile = self._hashfile(sel_roots), self._fecfile(sel_roots)
+            fec_size = self._fec_len(self.iso_s, self.hash_s, sel_roots)
+            for i in candidates:
+                if i != sel_roots:
+                    self._fecfile(i).unlink(missing_ok=True)
+                    if self._hashfile(i) != hashfile:
+                        self._hashfile(i).unlink(missing_ok=True)
+            async with self.resources.hold(io=1):
+                with self.metrics.stage('combine', roots=sel_roots, direct=self._direct) as st:
+                    await asyncio.to_thread(self._combine_with_root_hash, hashfile, fecfile, root_hash, sel_roots)
+                    st.add(0 if self._direct else (self.hash_s * self._BLK_SZ + fec_size))
         finally:
+            self._stream_close()
             self._clean_different_fecroots()
 
         print('Root hash:', root_hash.hex())
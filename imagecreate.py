@@ -1,19 +1,26 @@
 import asyncio
 import hashlib
 import os
-import re
 import secrets
 import shlex
 import shutil
 import subprocess
 import sys
-from collections import namedtuple
 from contextlib import asynccontextmanager
-from getpass import getuser
-from pathlib import Path
-from typing import Optional, Union
+from pathlib import Path, PurePosixPath
+from typing import Awaitable, Callable, Collection, Final, List, Optional, Tuple, Union
 
-from capacity import VolID, DiscID
+from buildstate import BuildState
+from bulkio import BulkIO
+from cache import BuildCache
+from capacity import CompProfile, VolID, DiscID
+from estimate import SquashfsEstimate, walk_files
+from iso9660 import IsoReader
+from manifest import MANIFEST_NAME, plain_manifest, squashfs_manifest, write_manifest
+from metrics import Metrics
+from privhelper import PrivHelper
+from scheduler import Resources
+from xtscrypt import crypt_in_place, derive_key
 
 
 async def acall(*args, capture=False, forward=False, stdin: Optional[int] = asyncio.subprocess.DEVNULL,
@@ -39,21 +46,25 @@ async def acall(*args, capture=False, forward=False, stdin: Optional[int] = asyn
     return msg
 
 
-async def _refresh_rootpassword(refresh_done, refresh_intvl=10):
-    _, aws = await asyncio.wait({refresh_done.wait()}, timeout=refresh_intvl)
-    while aws and not refresh_done.is_set():
-        await acall('sudo', '-S', '-v', capture=True)
-        _, aws = await asyncio.wait(aws, timeout=refresh_intvl)
-
-
 async def _fallocate(file, size):
     cmd = shlex.split('fallocate -x -l')
     return await acall(*cmd, str(size), os.fspath(file), capture=True)
 
 
 class ImageCreate:
+    _SCRYPT_MEM: Final[int] = 128 * 8 * 2 ** 20 + 64 * 1024 * 1024
+    _MKSQUASHFS_MEM: Final[int] = 1024 * 1024 * 1024
+    _STREAM_MEM: Final[int] = 512 * 1024 * 1024
+    _NCPU: Final[int] = os.cpu_count() or 1
+    # the system area, where formatfec writes the boot header
+    _SYS_SZ: Final[int] = 16 * 2048
+
     def __init__(self, isofile: os.PathLike, dmid: VolID, _key: Optional[str], bpassword: Optional[bytes] = None,
-                 disc: Optional[Union[str, DiscID]] = None):
+                 disc: Optional[Union[str, DiscID]] = None, in_place: bool = False, metrics: Optional[Metrics] = None,
+                 crypt_engine: str = 'dm-crypt', resources: Optional[Resources] = None,
+                 comp: Optional[CompProfile] = None, processors: Optional[int] = None,
+                 cache: Optional[BuildCache] = None, manifest: bool = False, bulk_io: Optional[BulkIO] = None,
+                 state: Optional[BuildState] = None):
         self.isofile = Path(isofile)
         self.volid = dmid.get_volid()
         self.bpassword = bpassword
@@ -62,18 +73,50 @@ class ImageCreate:
         self.offset = 0
         self.cipher: Optional[str] = None
         self.disc = disc
+        self.in_place = in_place
+        self.crypt_engine = crypt_engine
+        self.comp = comp or CompProfile()
+        self.processors = processors
+        self.cache = cache
+        self.manifest = manifest
+        self.io = bulk_io or BulkIO()
+        self.state = state
+        self._key: Optional[tuple] = None
+        self.sqfs_key: Optional[str] = None
+        self.helper: Optional[PrivHelper] = None
+        self.resources = resources or Resources()
+        self.metrics = metrics or Metrics()
         self.sqfs_file = None if _key is None else self.isofile.with_suffix('.rootdir') / f'{dmid.get_dmid()}.sqfs'
 
     @asynccontextmanager
-    async def _maybe_refresh_pw(self):
-        if self.bpassword:
+    async def _maybe_helper(self):
+        # one root helper for all dm-crypt steps, instead of a sudo per step and a sudo -v keep alive loop
+        if not self.comp_key or self.crypt_engine == 'native':
             yield
         else:
-            refresh_done = asyncio.Event()
-            task = asyncio.create_task(_refresh_rootpassword(refresh_done))
-            yield
-            refresh_done.set()
-            await task
+            async with PrivHelper(self.bpassword) as self.helper:
+                yield
+            self.helper = None
+
+    @staticmethod
+    def _key_check(key: bytes) -> str:
+        # as costly to guess from as the image itself, the key is derived with scrypt
+        return hashlib.sha256(b'resume' + key).hexdigest()
+
+    async def _resume_squashfs(self, params: dict) -> Optional[str]:
+        """The last finished stage of the squashfs image, which is kept from an earlier build."""
+        if self.comp_key:
+            ret = await asyncio.to_thread(self.state.lookup, 'encrypt', dict(params, cipher='aes-xts-plain64'))
+            if ret is not None and (self.disc is None or str(self.disc) == ret['disc']):
+                disc, self.cipher = self.disc, 'aes-xts-plain64'
+                if disc is None:
+                    self.disc = ret['disc']
+                if self._key_check(await self._derive_key()) == ret['key_check']:
+                    return 'encrypt'
+                self.disc, self.cipher = disc, None
+        if await asyncio.to_thread(self.state.lookup, 'squashfs', params) is not None:
+            return 'squashfs'
+        return None
 
     async def _maybe_encrypt(self):
         crypt_file = self.sqfs_file.with_suffix('.crypt')
@@ -82,15 +125,27 @@ class ImageCreate:
             self.cipher = 'aes-xts-plain64'
             if not self.disc:
                 self.disc = secrets.token_urlsafe()
+            if self.crypt_engine == 'native':
+                key = await self._derive_key()
+                async with self.resources.hold(cpu=self._NCPU, io=1):
+                    with self.metrics.stage('encrypt', os.path.getsize(self.sqfs_file), in_place=True):
+                        await asyncio.to_thread(crypt_in_place, self.sqfs_file, key)
+                return
             try:
-                await _fallocate(crypt_file, os.path.getsize(self.sqfs_file))
-                await self._cryptsetup_open(crypt_file)
+                if self.in_place:
+                    # every chunk is read before the mapping overwrites it, so no second copy is needed
+                    await self._cryptsetup_open(self.sqfs_file)
+                else:
+                    await _fallocate(crypt_file, os.path.getsize(self.sqfs_file))
+                    await self._cryptsetup_open(crypt_file)
                 crypt_name = '{}_crypt'.format(self.sqfs_file.with_suffix('').name)
                 crypt_dev = Path(f'/dev/mapper/{crypt_name}')
-                with self.sqfs_file.open('rb') as sqf, crypt_dev.open('r+b') as blk:
-                    shutil.copyfileobj(sqf, blk)
+                async with self.resources.hold(cpu=1, io=1):
+                    with self.metrics.stage('encrypt', os.path.getsize(self.sqfs_file), in_place=self.in_place):
+                        await asyncio.to_thread(self._copy_to_mapping, crypt_dev)
                 await self._cryptsetup_close()
-                crypt_file.replace(self.sqfs_file)
+                if not self.in_place:
+                    crypt_file.replace(self.sqfs_file)
             finally:
                 crypt_file.unlink(missing_ok=True)
         else:
@@ -98,96 +153,243 @@ class ImageCreate:
             self.comp_key = 'null'
             self.cipher = 'null'
 
+    def _copy_to_mapping(self, crypt_dev: Path) -> None:
+        with crypt_dev.open('r+b') as blk:
+            self.io.copy(self.sqfs_file, blk.fileno())
+
     @asynccontextmanager
     async def _maybe_compress(self, data_dir):
         if self.sqfs_file:
             self.sqfs_file.parent.mkdir(exist_ok=True)
-            self.sqfs_file.unlink(missing_ok=True)
+            resumed = None
+            if self.state is not None:
+                params = {'tree': await asyncio.to_thread(BuildState.tree_key, data_dir),
+                          'options': shlex.split(self._MKSQUASHFS_OPTS) + self.comp.get_options(),
+                          'passthrough': self.comp.passthrough}
+                resumed = await self._resume_squashfs(params)
+            if resumed is None:
+                self.sqfs_file.unlink(missing_ok=True)
+            else:
+                print('Resuming with the', resumed, 'stage of the squashfs image done')
             try:
-                async with self._maybe_refresh_pw():
-                    await self._mksquashfs(data_dir)
-                    await self._maybe_encrypt()
-                    yield os.fspath(self.sqfs_file.parent)
+                async with self._maybe_helper():
+                    if resumed is None:
+                        await self._mksquashfs(data_dir)
+                        if self.state is not None:
+                            await asyncio.to_thread(self.state.record, 'squashfs', params, [(self.sqfs_file, 0, None)])
+                    if self.manifest:
+                        await self._write_manifest(Path(data_dir), self.sqfs_file.parent / MANIFEST_NAME)
+                    if resumed != 'encrypt':
+                        await self._maybe_encrypt()
+                        if self.state is not None and self.cipher != 'null':
+                            await asyncio.to_thread(
+                                self.state.record, 'encrypt', dict(params, cipher=self.cipher),
+                                [(self.sqfs_file, 0, None)], disc=str(self.disc),
+                                key_check=self._key_check(await self._derive_key()))
+                    yield os.fspath(self.sqfs_file.parent),
             finally:
-                self.sqfs_file.unlink(missing_ok=True)
-                self.sqfs_file.parent.rmdir()
+                (self.sqfs_file.parent / MANIFEST_NAME).unlink(missing_ok=True)
+                # a failed build keeps what --resume can start from
+                if self.state is None or not self.state.keeps(self.sqfs_file):
+                    self.sqfs_file.unlink(missing_ok=True)
+                    self.sqfs_file.parent.rmdir()
+        elif self.manifest:
+            manifest = self.isofile.with_suffix('.manifest.json')
+            try:
+                await self._write_manifest(Path(data_dir), manifest)
+                yield '-graft-points', f'/={self._graft_quote(data_dir)}', \
+                    f'/{MANIFEST_NAME}={self._graft_quote(manifest)}'
+            finally:
+                manifest.unlink(missing_ok=True)
         else:
-            yield data_dir
+            yield os.fspath(data_dir),
 
-    async def create_output(self, data_dir: Path):
-        self.isofile.unlink(missing_ok=True)
+    async def _write_manifest(self, data_dir: Path, file: Path) -> None:
+        def write():
+            if self.sqfs_file:
+                write_manifest(squashfs_manifest(self.sqfs_file, data_dir, self.cache), file)
+            else:
+                write_manifest(plain_manifest(data_dir, self.cache), file)
 
-        async with self._maybe_compress(data_dir) as data_dir:
-            await self._mkisofs(data_dir)
+        with self.metrics.stage('manifest'):
+            await asyncio.to_thread(write)
+
+    @staticmethod
+    def _graft_quote(path: os.PathLike) -> str:
+        return os.fspath(path).replace('\\', '\\\\').replace('=', '\\=')
+
+    async def create_output(self, data_dir: Path, on_size: Optional[Callable[[int], Awaitable]] = None):
+        """on_size receives the ISO size in blocks before mastering and returns a coroutine function that
+        consumes the ISO while it is written, until the event passed to it is set. It is not called when the ISO
+        of an earlier build is resumed."""
+        async with self._maybe_compress(data_dir) as source:
+            params = None
+            if self.state is not None:
+                params = {'source': await asyncio.to_thread(self.state.digest, self.sqfs_file) if self.sqfs_file
+                          else await asyncio.to_thread(BuildState.tree_key, data_dir),
+                          'volid': self.volid, 'options': self._MKISOFS_OPTS, 'manifest': self.manifest}
+                ret = await asyncio.to_thread(self.state.lookup, 'iso', params)
+                if ret is not None:
+                    # formatfec patches the boot header in and appends to the ISO
+                    os.truncate(self.isofile, ret['size'])
+                    self.offset, self.length = ret['offset'], ret['length']
+                    print('Resuming with the ISO of an earlier build')
+                    return
+            self.isofile.unlink(missing_ok=True)
+            if on_size is None:
+                async with self.resources.hold(cpu=1, io=1):
+                    await self._mkisofs(*source)
+            else:
+                consumer = await on_size(await self._mkisofs_size(*source))
+                done = asyncio.Event()
+                # xorriso and the consumer share one reservation, they must run together
+                async with self.resources.hold(cpu=self._NCPU, io=1, mem=self._STREAM_MEM):
+                    task = asyncio.create_task(consumer(done))
+                    try:
+                        await self._mkisofs(*source)
+                    except BaseException:
+                        task.cancel()
+                        raise
+                    finally:
+                        done.set()
+                    await task
 
         if self.sqfs_file:
-            await self._mount_iso(self.sqfs_file.parent)
-            try:
-                extent, = await self._filefrag(self.sqfs_file)
-            finally:
-                await self._umount_iso(self.sqfs_file.parent)
-            log_start, log_end = map(int, extent.logical_offset.split('..'))
-            self.offset, phy_end = map(int, extent.physical_offset.split('..'))
-            self.length = int(extent.length)
-            assert log_start == 0 and log_end + 1 == self.length == phy_end - self.offset + 1
-            print('Physical Offset', self.offset, phy_end)
+            with self.metrics.stage('extent_lookup'), IsoReader(self.isofile) as iso:
+                self.offset, size = iso.lookup(self.sqfs_file.name)
+            self.length = (size + 2047) // 2048
+            print('Physical Offset', self.offset, self.offset + self.length - 1)
+        if self.state is not None:
+            size = os.path.getsize(self.isofile)
+            await asyncio.to_thread(self.state.record, 'iso', params,
+                                    [(self.isofile, self._SYS_SZ, size - self._SYS_SZ)],
+                                    size=size, offset=self.offset, length=self.length)
+
+    _MKISOFS_OPTS = '-as mkisofs -iso-level 4 -r -J -joliet-long -no-pad'
 
     async def _mkisofs(self, *source: str):
-        options = shlex.split('-as mkisofs -verbose -iso-level 4 -r -J -joliet-long -no-pad')
-        await acall('xorriso', *options, '-V', self.volid, '-o', os.fspath(self.isofile),
-                    *source, capture=True, forward=True)
+        options = shlex.split(self._MKISOFS_OPTS)
+        with self.metrics.stage('xorriso') as st:
+            await acall('xorriso', *options, '-verbose', '-V', self.volid, '-o', os.fspath(self.isofile),
+                        *source, capture=True, forward=True)
+            st.add(os.path.getsize(self.isofile))
 
-    async def _mksquashfs(self, *source):
-        # options = shlex.split('-b 1M -all-root -comp zstd -Xcompression-level 22')
-        options = shlex.split('-b 1M -all-root -comp xz -Xbcj x86 -Xdict-size 1M')
-        return await acall('mksquashfs', *source, self.sqfs_file, *options)
+    async def _mkisofs_size(self, *source: str) -> int:
+        options = shlex.split(self._MKISOFS_OPTS)
+        with self.metrics.stage('xorriso_size'):
+            msg = await acall('xorriso', *options, '-print-size', '-V', self.volid, *source,
+                              capture=True, stderr=asyncio.subprocess.DEVNULL)
+        return int(msg.split()[-1])
 
-    async def _mount_iso(self, mountpoint):
-        cmd = shlex.split('sudo -S mount')
-        mountpoint.mkdir(exist_ok=True)
-        await acall(*cmd, os.fspath(self.isofile), mountpoint, capture=True, binput=self.bpassword)
-        return mountpoint
+    _MKSQUASHFS_OPTS = '-b 1M -all-root'
+    # mksquashfs evaluates every action for every file
+    _MAX_ACTIONS: Final[int] = 1024
 
-    async def _umount_iso(self, mountpoint: Path):
-        cmd = shlex.split('sudo -S umount')
-        await acall(*cmd, mountpoint, capture=True, binput=self.bpassword)
-        mountpoint.rmdir()
+    @staticmethod
+    def _action_quote(rel: str, glob: str = '') -> str:
+        # path() takes a glob, and the action parser its own quoting
+        rel = glob + ''.join('\\' + c if c in '*?[]\\' else c for c in rel)
+        return '"{}"'.format(rel.replace('\\', '\\\\').replace('"', '\\"'))
 
-    async def _filefrag(self, file):
-        cmd = shlex.split('sudo -S filefrag -e')
-        msg = await acall(*cmd, os.fspath(file), capture=True, binput=self.bpassword)
-        fs_type, blocks, kw, *extents, summary = msg.decode().splitlines()
+    @classmethod
+    def _passthrough_exprs(cls, files: List[Tuple[str, int]], rels: Collection[str]) -> List[str]:
+        """Action expressions matching the files of rels and no other file.
 
-        m = re.search(r"\(([\w\s]+)\)", blocks)
-        _, block_size, _ = m.group(1).rsplit(maxsplit=2)
-        assert int(block_size) == 2048
+        Directories and extensions holding only such files take one expression each, the remaining files one
+        each. Beyond _MAX_ACTIONS of them the smaller files are compressed after all."""
+        rels = set(rels)
+        mixed_dirs, mixed_exts = set(), set()
+        for rel, _ in files:
+            if rel not in rels:
+                mixed_dirs.update(PurePosixPath(rel).parents)
+                mixed_exts.add(PurePosixPath(rel).suffix)
+        dirs, exts, rest = set(), set(), []
+        for rel, size in files:
+            if rel not in rels:
+                continue
+            path = PurePosixPath(rel)
+            top = next((d for d in reversed(list(path.parents)[:-1]) if d not in mixed_dirs), None)
+            if top is not None:
+                dirs.add(top)
+            elif path.suffix and path.suffix not in mixed_exts:
+                exts.add(path.suffix)
+            else:
+                rest.append((size, rel))
+        rest = sorted(rest, reverse=True)[:max(cls._MAX_ACTIONS - len(dirs) - len(exts), 0)]
+        return ([f'subpathname({cls._action_quote(str(d))})' for d in sorted(dirs)] +
+                [f'name({cls._action_quote(e, glob="*")})' for e in sorted(exts)] +
+                [f'path({cls._action_quote(rel)})' for _, rel in sorted(rest, key=lambda e: e[1])])
 
-        _, n_ext = summary.rsplit(':', maxsplit=1)
-        n_ext, _ = n_ext.split(maxsplit=1)
-        assert len(extents) == int(n_ext)
+    async def _passthrough_actions(self, data_dir: Path) -> Optional[Path]:
+        """Action file storing the incompressible files uncompressed, so the compressor skips them."""
+        with self.metrics.stage('passthrough_scan') as st:
+            files = await asyncio.to_thread(walk_files, data_dir)
+            rels = await asyncio.to_thread(SquashfsEstimate(data_dir).incompressible, files, workers=self.processors)
+            st.add(sum(s for _, s in files))
+        exprs = self._passthrough_exprs(files, rels)
+        print(f'{len(rels)} of {len(files)} files are incompressible, stored uncompressed by {len(exprs)} actions')
+        if not exprs:
+            return None
+        actions = self.isofile.with_suffix('.actions')
+        actions.write_text(''.join(f'uncompressed@{e}\n' for e in exprs))
+        return actions
 
-        T = namedtuple('file_extents', kw.replace(':', ' '), defaults=(None,))
-        return [T(*map(str.strip, s.split(':'))) for s in extents]
+    async def _cached_squashfs(self, source: os.PathLike) -> bool:
+        options = shlex.split(self._MKSQUASHFS_OPTS) + self.comp.get_options()
+        with self.metrics.stage('tree_digest'):
+            digest = await asyncio.to_thread(self.cache.tree_digest, source)
+        self.sqfs_key = self.cache.key('squashfs', digest, options, self.comp.passthrough)
+        hit = self.cache.get(self.sqfs_key)
+        if hit is None:
+            return False
+        async with self.resources.hold(io=1):
+            with self.metrics.stage('squashfs_cached') as st:
+                await asyncio.to_thread(shutil.copyfile, hit, self.sqfs_file)
+                st.add(os.path.getsize(self.sqfs_file))
+        print('Reusing the cached squashfs image of an identical tree')
+        return True
+
+    async def _mksquashfs(self, *source):
+        if self.cache is not None and await self._cached_squashfs(source[0]):
+            return b''
+        options = shlex.split(self._MKSQUASHFS_OPTS) + self.comp.get_options()
+        ncpu = self._NCPU
+        if self.processors:
+            options += ['-processors', str(self.processors)]
+            ncpu = self.processors
+        actions = await self._passthrough_actions(Path(source[0])) if self.comp.passthrough else None
+        if actions:
+            options += ['-action-file', os.fspath(actions)]
+        try:
+            async with self.resources.hold(cpu=ncpu, mem=self._MKSQUASHFS_MEM):
+                with self.metrics.stage('mksquashfs') as st:
+                    msg = await acall('mksquashfs', *source, self.sqfs_file, *options)
+                    st.add(os.path.getsize(self.sqfs_file))
+        finally:
+            if actions:
+                actions.unlink()
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, self.sqfs_key, self.sqfs_file)
+        return msg
 
     async def _cryptsetup_open(self, file):
         crypt_name = '{}_crypt'.format(self.sqfs_file.with_suffix('').name)
-        options = shlex.split('cryptsetup open --type plain --hash plain --key-size 512 --key-file=- --cipher')
-        options += (self.cipher, os.fspath(file), crypt_name)
-        shell_cmd = shlex.split('sudo -S -E bash -euo pipefail -c')
-        shell_cmd.append(f'xxd -r -p <<<"$_COMP_KEY" | {shlex.join(options)}')
-        h = hashlib.new('sm3')
+        x = await self._derive_key()
+        return await self.helper.call('crypt_open', file=os.fspath(Path(file).resolve()), name=crypt_name,
+                                      cipher=self.cipher, key=x.hex())
+
+    async def _derive_key(self) -> bytes:
+        crypt_name = '{}_crypt'.format(self.sqfs_file.with_suffix('').name)
         x = os.path.getsize(self.sqfs_file)
-        h.update(str(self.disc).encode())
-        h.update(crypt_name.encode())
-        h.update(self.cipher.encode())
-        h.update(x.to_bytes((x.bit_length() + 7) // 8, byteorder='little'))
-        x = hashlib.scrypt(self.comp_key.encode(), salt=h.digest(), n=2 ** 20, r=8, p=1, maxmem=2 ** 31 - 1, dklen=64)
-        msg = await acall(*shell_cmd, capture=True, binput=self.bpassword, env=dict(os.environ, _COMP_KEY=x.hex()))
-        cmd = shlex.split('sudo -S chown')
-        await acall(*cmd, getuser(), f'/dev/mapper/{crypt_name}', capture=True, binput=self.bpassword)
-        return msg
+        if self._key is not None and self._key[0] == (str(self.disc), x):
+            return self._key[1]
+        # scrypt is bound by its memory, a single core is left to the kernel to share
+        async with self.resources.hold(mem=self._SCRYPT_MEM):
+            with self.metrics.stage('scrypt'):
+                key = await asyncio.to_thread(derive_key, self.comp_key, str(self.disc), crypt_name, self.cipher, x)
+        self._key = (str(self.disc), x), key
+        return key
 
     async def _cryptsetup_close(self):
-        cmd = shlex.split('sudo -S cryptsetup close')
         crypt_name = '{}_crypt'.format(self.sqfs_file.with_suffix('').name)
-        return await acall(*cmd, crypt_name, capture=True, binput=self.bpassword)
+        return await self.helper.call('crypt_close', name=crypt_name)
@@ -0,0 +1,238 @@
+import calendar
+import mmap
+import os
+import struct
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Final, Iterator, List, Optional, Tuple
+
+
+class IsoReader:
+    _BLK_SZ: Final[int] = 2048
+    _VD_START: Final[int] = 16
+    _JOLIET_ESC: Final[tuple] = (b'%/@', b'%/C', b'%/E')
+
+    def __init__(self, isofile: os.PathLike, read: Optional[Callable[[int, int], bytes]] = None):
+        """read(offset, size) replaces reading the file directly, e.g. with verified reads."""
+        self.isofile = Path(isofile)
+        self.m = None
+        if read is None:
+            with self.isofile.open('rb') as f:
+                # st_size is 0 for a disc device
+                self.m = mmap.mmap(f.fileno(), os.lseek(f.fileno(), 0, os.SEEK_END), access=mmap.ACCESS_READ)
+        self._read = read or (lambda pos, n: self.m[pos:pos + n])
+        self.primary, self.joliet = self._volume_descriptors()
+        # the SP entry of the root directory marks SUSP and Rock Ridge, and the bytes every other system use field
+        # starts with before its entries
+        extent, size, *_ = self._parse_record(self.primary)
+        su = self._parse_record(next(self._records(extent, size)))[4]
+        self.rr = su[:2] == b'SP' and su[4:6] == b'\xbe\xef'
+        self._su_skip = su[6] if self.rr else 0
+
+    def close(self) -> None:
+        if self.m is not None:
+            self.m.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _volume_descriptors(self) -> Tuple[bytes, Optional[bytes]]:
+        primary = joliet = None
+        i = self._VD_START
+        while len(vd := self._read(i * self._BLK_SZ, self._BLK_SZ)) == self._BLK_SZ:
+            if vd[1:6] != b'CD001':
+                raise ValueError(f'Bad volume descriptor at sector {i}')
+            if vd[0] == 255:
+                break
+            if vd[0] == 1 and primary is None:
+                primary = vd[156:190]
+            elif vd[0] == 2 and vd[88:91] in self._JOLIET_ESC:
+                joliet = vd[156:190]
+            i += 1
+        if primary is None:
+            raise ValueError('No primary volume descriptor')
+        return primary, joliet
+
+    @staticmethod
+    def _parse_record(rec: bytes) -> Tuple[int, int, int, bytes, bytes]:
+        extent, = struct.unpack_from('<I', rec, 2)
+        size, = struct.unpack_from('<I', rec, 10)
+        flags, name_len = rec[25], rec[32]
+        name = rec[33:33 + name_len]
+        su = rec[33 + name_len + (1 - name_len % 2):]
+        return extent, size, flags, name, su
+
+    def _records(self, extent: int, size: int) -> Iterator[bytes]:
+        d = self._read(extent * self._BLK_SZ, size)
+        pos = 0
+        while pos < len(d):
+            n = d[pos]
+            if not n:
+                # records never cross a sector boundary
+                pos = (pos // self._BLK_SZ + 1) * self._BLK_SZ
+                continue
+            yield d[pos:pos + n]
+            pos += n
+
+    def _su_entries(self, su: bytes) -> Iterator[Tuple[bytes, bytes]]:
+        """(signature, entry) of the SUSP entries of a system use field, continuation areas included."""
+        su, seen = su[self._su_skip:], set()
+        while su:
+            pos, ce = 0, None
+            while pos + 4 <= len(su):
+                sig, n = su[pos:pos + 2], su[pos + 2]
+                if n < 4 or sig == b'ST':
+                    break
+                if sig == b'CE' and n >= 28:
+                    block, offset, length = struct.unpack_from('<I4xI4xI', su, pos + 4)
+                    ce = block * self._BLK_SZ + offset, length
+                else:
+                    yield sig, su[pos:pos + n]
+                pos += n
+            if ce is None or ce in seen:
+                break
+            seen.add(ce)
+            su = self._read(*ce)
+
+    def _rr(self, su: bytes) -> Dict[bytes, List[bytes]]:
+        """Rock Ridge entries of a system use field by signature."""
+        ret = {}
+        if self.rr:
+            for sig, e in self._su_entries(su):
+                ret.setdefault(sig, []).append(e)
+        return ret
+
+    def _entry(self, rec: bytes, joliet: bool) -> Optional[Tuple[int, int, int, Tuple[str, ...], dict]]:
+        """extent, size, flags, names and Rock Ridge entries of a directory record.
+
+        None for '.', '..' and directories Rock Ridge relocated, which are listed at their child link instead."""
+        extent, size, flags, name, su = self._parse_record(rec)
+        if name in (b'\0', b'\1'):
+            return None
+        if joliet:
+            return extent, size, flags, (name.decode('utf-16-be', errors='replace').split(';')[0], ), {}
+        rr = self._rr(su)
+        if b'RE' in rr:
+            return None
+        if b'CL' in rr:
+            extent, = struct.unpack_from('<I', rr[b'CL'][0], 4)
+            size, flags = self._parse_record(next(self._records(extent, self._BLK_SZ)))[1:3]
+        nm = b''.join(e[5:] for e in rr.get(b'NM', ()))
+        if nm:
+            return extent, size, flags, (nm.decode(errors='replace'), ), rr
+        iso = name.decode('ascii', errors='replace').split(';')[0].rstrip('.')
+        return extent, size, flags, (iso, iso.lower()), rr
+
+    @staticmethod
+    def _timestamp(d: bytes) -> Optional[int]:
+        # 7 bytes from 1900 as in directory records, or the 17 byte digits of volume descriptors, both with the offset
+        # from GMT in 15 minute intervals
+        if len(d) == 17:
+            if not d[:14].strip(b'0'):
+                return None
+            t = int(d[:4]), int(d[4:6]), int(d[6:8]), int(d[8:10]), int(d[10:12]), int(d[12:14])
+        elif not d[:6].strip(b'\0'):
+            return None
+        else:
+            t = d[0] + 1900, *d[1:6]
+        return calendar.timegm(t) - struct.unpack_from('b', d, len(d) - 1)[0] * 900
+
+    @staticmethod
+    def _symlink(sl: List[bytes]) -> str:
+        parts, cont = [], False
+        for e in sl:
+            pos = 5
+            while pos + 2 <= len(e):
+                flags, n = e[pos], e[pos + 1]
+                c = '.' if flags & 0x02 else '..' if flags & 0x04 else '' if flags & 0x08 else \
+                    e[pos + 2:pos + 2 + n].decode(errors='surrogateescape')
+                if cont:
+                    parts[-1] += c
+                else:
+                    parts.append(c)
+                cont = bool(flags & 0x01)
+                pos += 2 + n
+        return '/'.join(parts) if parts != [''] else '/'
+
+    def _attrs(self, rec: bytes, rr: Dict[bytes, List[bytes]]) -> Tuple[Optional[int], Optional[int], str]:
+        """Mode, mtime and link target of a record, the mode only with Rock Ridge."""
+        mode, mtime = None, self._timestamp(rec[18:25])
+        if b'PX' in rr:
+            mode, = struct.unpack_from('<I', rr[b'PX'][0], 4)
+        if b'TF' in rr:
+            tf = rr[b'TF'][0]
+            flags, n = tf[4], 17 if tf[4] & 0x80 else 7
+            # creation, then modification time
+            if flags & 0x02:
+                pos = 5 + n * (flags & 0x01)
+                mtime = self._timestamp(tf[pos:pos + n])
+        return mode, mtime, self._symlink(rr[b'SL']) if b'SL' in rr else ''
+
+    def _lookup(self, root: bytes, parts: Tuple[str, ...], joliet: bool) -> Optional[list]:
+        extent, size, *_ = self._parse_record(root)
+        for k, part in enumerate(parts):
+            found = None
+            for rec in self._records(extent, size):
+                if found is not None:
+                    # multi-extent files continue with records of the same name
+                    if found[-1][2] & 0x80:
+                        found.append(self._parse_record(rec)[:3])
+                        continue
+                    break
+                if (entry := self._entry(rec, joliet)) is not None and part in entry[3]:
+                    found = [entry[:3]]
+                    if not entry[2] & 0x80:
+                        break
+            if found is None:
+                return None
+            if k + 1 < len(parts):
+                if not found[0][2] & 0x02:
+                    return None
+                extent, size = found[0][:2]
+            else:
+                return found
+        return None
+
+    def lookup(self, path: str) -> Tuple[int, int]:
+        """Start sector and byte length of a contiguous file."""
+        parts = PurePosixPath('/', path).parts[1:]
+        extents = None
+        if self.joliet is not None:
+            extents = self._lookup(self.joliet, parts, True)
+        if extents is None:
+            extents = self._lookup(self.primary, parts, False)
+        if extents is None:
+            raise FileNotFoundError(path)
+        start, size, _ = extents[0]
+        for extent, length, _ in extents[1:]:
+            if size % self._BLK_SZ or extent != start + size // self._BLK_SZ:
+                raise ValueError(f'{path} is not contiguous')
+            size += length
+        return start, size
+
+    def walk(self) -> Iterator[Tuple[str, bool, List[Tuple[int, int]], Optional[int], Optional[int], str]]:
+        """(path, is directory, extents, mode, mtime, link target) of every entry below the root, parents before their
+        children.
+
+        Extents are (start sector, byte length). Rock Ridge names are preferred, then Joliet ones. The mode is None
+        without Rock Ridge, the mtime when the image does not record it."""
+        joliet = self.joliet is not None and not self.rr
+        stack = [('', self._parse_record(self.joliet if joliet else self.primary)[:2])]
+        while stack:
+            path, (extent, size) = stack.pop()
+            children, last = [], None
+            for rec in self._records(extent, size):
+                if last is not None and last[1] & 0x80:
+                    r_extent, r_size, last[1] = self._parse_record(rec)[:3]
+                    last[2].append((r_extent, r_size))
+                    continue
+                if (entry := self._entry(rec, joliet)) is None:
+                    continue
+                r_extent, r_size, flags, names, rr = entry
+                last = [f'{path}/{names[0]}' if path else names[0], flags, [(r_extent, r_size)], self._attrs(rec, rr)]
+                children.append(last)
+            for p, flags, extents, attrs in children:
+                yield p, bool(flags & 0x02), extents, *attrs
+            stack.extend(reversed([(p, extents[0]) for p, flags, extents, _ in children if flags & 0x02]))
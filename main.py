@@ -9,26 +9,77 @@ import sys
 from getpass import getpass
 from io import StringIO
 from pathlib import Path
+from typing import Optional
 
-from capacity import VolID, DiscID, PassHint
+from buildstate import BuildState
+from bulkio import BulkIO
+from cache import BuildCache
+from capacity import CompProfile, DiscCapacity, VolID, DiscID, FecRoots, PassHint
+from estimate import walk_files
 from fecsetup import FECSetup
 from imagecreate import ImageCreate, acall
+from metrics import Metrics
+from scheduler import Resources
 
 
-def parse_args() -> argparse.Namespace:
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Oh My GBC~')
     parser.add_argument('data_dir', type=Path, help='data environment')
     parser.add_argument('-o', '--output', type=Path, required=True, help='output iso file')
     parser.add_argument('-V', '--volid', type=VolID, required=True, help='volume label')
     parser.add_argument('-C', '--compress', type=str, metavar='PASSCODE',
                         help='to compress and encrypt data. To disable encryption, pass an empty string.')
+    parser.add_argument('--comp', type=CompProfile, default=CompProfile(), metavar='xz|zstd[:N]|lz4|auto',
+                        help='squashfs compression. zstd takes a level of 1-22 (default 15). '
+                             'auto: xz, but files a fast sample shows to be incompressible are stored as is.')
+    parser.add_argument('--processors', type=int, help='compressor threads (default: all cores)')
     parser.add_argument('-d', '--disc', type=DiscID, help='disc id')
     parser.add_argument('--hint', type=PassHint, help='password hint')
     parser.add_argument('--save_disc', action='store_true', help='save disc id')
     parser.add_argument('--save_pass', action='store_true',
                         help='save password. It also enables compression and encryption. (A random passcode will be '
                              'generated if no passcode is specified).')
-    return parser.parse_args()
+    parser.add_argument('--engine', choices=('veritysetup', 'native'), default='veritysetup',
+                        help='hash tree and fec engine. native reads the ISO once for all fec roots candidates.')
+    parser.add_argument('--fec-roots', type=FecRoots, default=FecRoots(), metavar='ask|preview|auto|max|N',
+                        help='how to choose fec roots. ask: prompt after showing the free space of every roots value, '
+                             'preview: encode several candidates and prompt (old behaviour), max: most roots that fit, '
+                             'auto: most roots that leave --fec-margin free, N: use N roots (2-24). '
+                             'Only the chosen roots value is encoded unless preview is used.')
+    parser.add_argument('--fec-margin', type=int, default=0, metavar='MiB',
+                        help='free space to keep on the disc with --fec-roots auto')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='encrypt in place and build the hash tree and fec while the ISO is mastered. '
+                             'Implies --engine native.')
+    parser.add_argument('--crypt-engine', choices=('dm-crypt', 'native'), default='dm-crypt',
+                        help='dm-crypt: encrypt through a dm-crypt mapping (needs root). '
+                             'native: encrypt in userspace with python3-cryptography, no root needed.')
+    parser.add_argument('--disc-type', choices=DiscCapacity._DiscName,
+                        help='disc to plan fec roots for (default: the smallest one that fits)')
+    parser.add_argument('--cache', type=Path, metavar='DIR',
+                        help='reuse the squashfs image of an unchanged tree and, without encryption, the hashes of '
+                             'unchanged files from earlier builds. Needs --engine native for the hashes.')
+    parser.add_argument('--cache-size', type=float, default=64, metavar='GiB',
+                        help='size of the cache, the least recently used entries are evicted beyond it')
+    parser.add_argument('--manifest', action='store_true',
+                        help='embed the sha256 and extents of every file, so manifest.py can verify single files. '
+                             'Not available with encryption, the manifest would expose the file names.')
+    parser.add_argument('--resume', action='store_true',
+                        help='record every finished stage (squashfs, encryption, ISO, hash tree and fec) with a digest '
+                             'of its output in <output>.state.json, and skip the stages an earlier --resume build has '
+                             'finished with the same inputs. A failed build keeps their files.')
+    parser.add_argument('--io-mem', type=int, default=64, metavar='MiB',
+                        help='buffers for copying image data. Copies and the hash tree and fec passes drop what they '
+                             'have read from the page cache, so it does not grow with the image.')
+    parser.add_argument('--direct-io', action='store_true',
+                        help='copy image data with O_DIRECT where the filesystem allows it')
+    parser.add_argument('--metrics-json', type=Path, metavar='FILE',
+                        help='write wall time, cpu time, throughput and peak memory of every build stage')
+    return parser
+
+
+def parse_args(args: Optional[list] = None) -> argparse.Namespace:
+    return build_parser().parse_args(args)
 
 
 async def check_rootpassword(root_password=None):
@@ -39,17 +90,12 @@ async def check_rootpassword(root_password=None):
         except subprocess.CalledProcessError:
             pass
         with StringIO() as buf:
-            print(getpass('We need root password to mount ISO file: '), file=buf, flush=True)
+            print(getpass('We need root password to set up dm-crypt: '), file=buf, flush=True)
             root_password = buf.getvalue().encode()
     return root_password
 
 
-async def main(opt: argparse.Namespace) -> int:
-    if opt.save_pass and not opt.compress:
-        opt.compress = base64.b85encode(secrets.token_bytes()).decode()
-    root_password = await check_rootpassword() if opt.compress else None
-    img = ImageCreate(opt.output, dmid=opt.volid, _key=opt.compress, bpassword=root_password, disc=opt.disc)
-    await img.create_output(opt.data_dir)
+def boot_vars(opt: argparse.Namespace, img: ImageCreate) -> dict:
     kwargs = {}
     if opt.save_pass or opt.compress == '':
         kwargs['_PASS'] = PassHint(img.comp_key)
@@ -59,8 +105,79 @@ async def main(opt: argparse.Namespace) -> int:
         kwargs['_DISC_ID'] = img.disc
     if opt.hint is not None:
         kwargs['_HINT'] = opt.hint
-    img = FECSetup(opt.output, dmid=opt.volid, offset=img.offset, length=img.length, cipher=img.cipher, **kwargs)
-    ret = await img.formatfec()
+    return kwargs
+
+
+def leaf_files(opt: argparse.Namespace, img: ImageCreate, cache: BuildCache) -> list:
+    """ISO paths and content keys of the files whose cached hashes can be reused."""
+    if opt.engine != 'native' or img.cipher not in (None, 'null'):
+        return []
+    if img.sqfs_file:
+        return [(img.sqfs_file.name, img.sqfs_key)] if img.sqfs_key else []
+    files = [(rel, cache.file_digest(opt.data_dir / rel))
+             for rel, size in walk_files(opt.data_dir) if size >= FECSetup._MIN_CACHED_BLKS * FECSetup._BLK_SZ]
+    cache.save()
+    return files
+
+
+async def build(opt: argparse.Namespace, root_password: Optional[bytes], metrics: Metrics,
+                resources: Optional[Resources] = None) -> int:
+    if opt.save_pass and not opt.compress:
+        opt.compress = base64.b85encode(secrets.token_bytes()).decode()
+    if opt.pipeline:
+        opt.engine = 'native'
+    if opt.manifest and opt.compress:
+        raise ValueError('--manifest would expose the file names of encrypted data')
+    cache = BuildCache(opt.cache, int(opt.cache_size * 1024 ** 3)) if opt.cache else None
+    bulk_io = BulkIO(opt.io_mem * 1024 * 1024, opt.direct_io)
+    state = BuildState(opt.output.with_suffix('.state.json'), bulk_io=bulk_io) if opt.resume else None
+    img = ImageCreate(opt.output, dmid=opt.volid, _key=opt.compress, bpassword=root_password, disc=opt.disc,
+                      in_place=opt.pipeline, metrics=metrics, crypt_engine=opt.crypt_engine, resources=resources,
+                      comp=opt.comp, processors=opt.processors, cache=cache, manifest=opt.manifest, bulk_io=bulk_io,
+                      state=state)
+    fec_args = dict(engine=opt.engine, fec_policy=opt.fec_roots, fec_margin=opt.fec_margin * 1024 * 1024,
+                    metrics=metrics, resources=resources, disc_type=opt.disc_type, bulk_io=bulk_io, state=state)
+    if opt.pipeline:
+        fec = None
+
+        async def on_size(iso_blocks: int):
+            nonlocal fec
+            fec = FECSetup(opt.output, dmid=opt.volid, cipher=img.cipher, iso_blocks=iso_blocks, **fec_args,
+                           **boot_vars(opt, img))
+            # a prompt for the roots comes before xorriso starts writing the ISO
+            await fec.select_candidates()
+            return fec.stream_iso
+
+        await img.create_output(opt.data_dir, on_size=on_size)
+        if fec is None:
+            # a resumed ISO was not mastered again
+            fec = FECSetup(opt.output, dmid=opt.volid, offset=img.offset, length=img.length, cipher=img.cipher,
+                           **fec_args, **boot_vars(opt, img))
+        fec.set_extent(img.offset, img.length)
+    else:
+        await img.create_output(opt.data_dir)
+        if cache is not None:
+            fec_args.update(cache=cache, leaf_files=await asyncio.to_thread(leaf_files, opt, img, cache))
+        fec = FECSetup(opt.output, dmid=opt.volid, offset=img.offset, length=img.length, cipher=img.cipher,
+                       **fec_args, **boot_vars(opt, img))
+    ret = await fec.formatfec()
+    if state is not None:
+        state.clear(keep=(opt.output,))
+    return ret
+
+
+def needs_root(opt: argparse.Namespace) -> bool:
+    return bool(opt.compress or opt.save_pass) and opt.crypt_engine == 'dm-crypt'
+
+
+async def main(opt: argparse.Namespace) -> int:
+    root_password = await check_rootpassword() if needs_root(opt) else None
+    metrics = Metrics()
+    try:
+        ret = await build(opt, root_password, metrics)
+    finally:
+        if opt.metrics_json:
+            metrics.write_json(opt.metrics_json)
     return ret
 
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import stat
+import sys
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from cache import BuildCache
+from estimate import walk_files
+from fecimage import FecImage
+from iso9660 import IsoReader
+from squashfs import SquashfsReader
+
+MANIFEST_NAME = '.fecmanifest.json'
+_BLK_SZ = 2048
+_READ_SZ = 1024 * 1024
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Verify single files of an ISO against its hash tree, reading only '
+                                                 'their blocks and hash tree path')
+    parser.add_argument('image', type=Path, help='iso file or disc device')
+    parser.add_argument('paths', nargs='*', help='files to verify (default: every file of the manifest)')
+    parser.add_argument('--sha256', action='store_true',
+                        help='also compare the sha256 of uncompressed files with the one of the source')
+    parser.add_argument('-l', '--list', action='store_true', help='list the manifest instead of verifying')
+    return parser.parse_args()
+
+
+def file_sha256(path: os.PathLike, cache: Optional[BuildCache] = None) -> str:
+    if cache is not None:
+        return cache.file_digest(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while b := f.read(_READ_SZ):
+            h.update(b)
+    return h.hexdigest()
+
+
+def plain_manifest(data_dir: Path, cache: Optional[BuildCache] = None) -> dict:
+    """Extents of plain files are looked up in the ISO directory when verifying."""
+    files = [{'path': rel, 'size': size, 'sha256': file_sha256(data_dir / rel, cache)}
+             for rel, size in walk_files(data_dir)]
+    return {'version': 1, 'container': None, 'files': files}
+
+
+def squashfs_manifest(sqfs_file: Path, data_dir: Path, cache: Optional[BuildCache] = None) -> dict:
+    """Extents are byte ranges of the squashfs image, from its inode table."""
+    files = []
+    with sqfs_file.open('rb') as f:
+        sqfs = SquashfsReader(f)
+        for rel, ino in sqfs.walk():
+            if stat.S_ISREG(ino.mode):
+                files.append({'path': rel, 'size': ino.size, 'sha256': file_sha256(data_dir / rel, cache),
+                              'extents': sqfs.file_extents(ino)})
+    return {'version': 1, 'container': sqfs_file.name, 'files': files}
+
+
+def write_manifest(manifest: dict, file: Path) -> None:
+    with file.open('w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+
+
+def _blocks(offset: int, size: int) -> Tuple[int, int]:
+    start = offset // _BLK_SZ
+    return start, (offset + size + _BLK_SZ - 1) // _BLK_SZ - start
+
+
+def file_blocks(iso: IsoReader, manifest: dict, entry: dict) -> List[Tuple[int, int]]:
+    if manifest['container'] is None:
+        start, size = iso.lookup(entry['path'])
+        return [(start, (size + _BLK_SZ - 1) // _BLK_SZ)] if size else []
+    base = iso.lookup(manifest['container'])[0] * _BLK_SZ
+    return [_blocks(base + off, n) for off, n in entry['extents']]
+
+
+def read_manifest(img: FecImage, iso: IsoReader) -> dict:
+    start, size = iso.lookup(MANIFEST_NAME)
+    if img.tree.verify_range(img.image, start, (size + _BLK_SZ - 1) // _BLK_SZ, img.root_hash, img.iso_sz):
+        raise ValueError('The manifest is damaged')
+    with img.image.open('rb') as f:
+        return json.loads(os.pread(f.fileno(), size, start * _BLK_SZ))
+
+
+def verify_file(img: FecImage, iso: IsoReader, manifest: dict, entry: dict, sha256: bool) -> List[int]:
+    """Bad blocks of a file, a sha256 mismatch of a plain file is reported as all of its blocks."""
+    bad = []
+    for start, n in file_blocks(iso, manifest, entry):
+        bad += img.tree.verify_range(img.image, start, n, img.root_hash, img.iso_sz)
+    if sha256 and not bad and manifest['container'] is None:
+        (start, n), = file_blocks(iso, manifest, entry) or ((0, 0),)
+        h = hashlib.sha256()
+        with img.image.open('rb') as f:
+            for o in range(0, entry['size'], _READ_SZ):
+                h.update(os.pread(f.fileno(), min(_READ_SZ, entry['size'] - o), start * _BLK_SZ + o))
+        if h.hexdigest() != entry['sha256']:
+            bad = list(range(start, start + n))
+    return bad
+
+
+def main(opt: argparse.Namespace) -> int:
+    img = FecImage(opt.image)
+    with IsoReader(opt.image) as iso:
+        try:
+            manifest = read_manifest(img, iso)
+        except FileNotFoundError:
+            print('The image has no manifest, it was built without --manifest')
+            return 2
+        entries = {e['path']: e for e in manifest['files']}
+        if opt.list:
+            for e in manifest['files']:
+                print(e['sha256'], e['size'], e['path'])
+            return 0
+        paths = [p.strip('/') for p in opt.paths] or list(entries)
+        failed = 0
+        for p in paths:
+            if p not in entries:
+                print('Not in the manifest:', p)
+                failed += 1
+                continue
+            bad = verify_file(img, iso, manifest, entries[p], opt.sha256)
+            if bad:
+                failed += 1
+            print('BAD' if bad else 'OK', p, f'({len(bad)} bad blocks)' if bad else '')
+    print(f'{len(paths) - failed} of {len(paths)} files intact')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,113 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Final, List, Optional
+
+import psutil
+
+
+def _tree_cpu() -> float:
+    t = os.times()
+    cpu = t.user + t.system + t.children_user + t.children_system
+    for c in psutil.Process().children(recursive=True):
+        try:
+            ct = c.cpu_times()
+            cpu += ct.user + ct.system
+        except psutil.Error:
+            pass
+    return cpu
+
+
+def _tree_rss() -> int:
+    rss = psutil.Process().memory_info().rss
+    for c in psutil.Process().children(recursive=True):
+        try:
+            rss += c.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+class Stage:
+    def __init__(self, name: str, nbytes: int = 0, progress: Optional[Callable[[int], object]] = None, **info):
+        self.name = name
+        self.info = info
+        self.nbytes = nbytes
+        self.progress = progress
+        self.start = time.monotonic()
+        self.cpu0 = _tree_cpu()
+        self.wall = self.cpu = 0.0
+        self.peak_rss = 0
+
+    def add(self, nbytes: int) -> None:
+        self.nbytes += nbytes
+        if self.progress is not None:
+            self.progress(nbytes)
+
+    def close(self) -> None:
+        self.wall = time.monotonic() - self.start
+        self.cpu = _tree_cpu() - self.cpu0
+
+    def to_dict(self, t0: float) -> dict:
+        return dict(name=self.name, **self.info, start=round(self.start - t0, 3), wall=round(self.wall, 3),
+                    cpu=round(self.cpu, 3), bytes=self.nbytes,
+                    mb_s=round(self.nbytes / self.wall / 1e6, 2) if self.wall else None, peak_rss=self.peak_rss)
+
+
+class Metrics:
+    """Wall time, cpu time, bytes and peak rss of build stages.
+
+    Cpu time and rss are of the whole process tree, so stages running concurrently share them."""
+    _SAMPLE_INTVL: Final[float] = 0.2
+
+    def __init__(self):
+        self.t0 = time.monotonic()
+        self.stages: List[Stage] = []
+        self._active: List[Stage] = []
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while True:
+            rss = _tree_rss()
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                for s in self._active:
+                    s.peak_rss = max(s.peak_rss, rss)
+            time.sleep(self._SAMPLE_INTVL)
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0, progress: Optional[Callable[[int], object]] = None, **info):
+        s = Stage(name, nbytes, progress, **info)
+        s.peak_rss = _tree_rss()
+        with self._lock:
+            self.stages.append(s)
+            self._active.append(s)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        try:
+            yield s
+        finally:
+            s.close()
+            with self._lock:
+                self._active.remove(s)
+
+    def to_dict(self) -> dict:
+        usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'wall': round(time.monotonic() - self.t0, 3),
+            'cpu': round(sum(u.ru_utime + u.ru_stime for u in usage), 3),
+            'max_rss': max(u.ru_maxrss for u in usage) * 1024,
+            'stages': [s.to_dict(self.t0) for s in self.stages],
+        }
+
+    def write_json(self, path: os.PathLike) -> None:
+        with Path(path).open('w') as f:
+            json.dump(self.to_dict(), f, indent=2)
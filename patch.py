@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from pathlib import Path
+
+from bootsh import BootSh
+from fecimage import FecImage
+
+_HEADER_SZ = 218
+_BOOT_SZ = 0x8000
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Change boot.sh of a finished ISO, updating only the hashes and fec '
+                                                 'code of the blocks it occupies')
+    parser.add_argument('image', type=Path, help='iso file')
+    parser.add_argument('--hint', help='new password hint')
+    parser.add_argument('--disc-id', help='new saved disc id')
+    parser.add_argument('--set', action='append', default=[], metavar='VAR=VALUE', help='set a boot.sh variable')
+    parser.add_argument('--unset', action='append', default=[], metavar='VAR', help='remove a boot.sh variable')
+    return parser.parse_args()
+
+
+def boot_bytes(old: bytes, sh: BootSh) -> bytes:
+    b = bytearray(old)
+    header, body = sh.get_header_bytes(), sh.get_body_bytes()
+    b[:_HEADER_SZ] = header + bytes(_HEADER_SZ - len(header))
+    b[512:] = body + bytes(len(b) - 512 - len(body))
+    return bytes(b)
+
+
+def main(opt: argparse.Namespace) -> int:
+    img = FecImage(opt.image)
+    sh_vars = dict(img.vars)
+    for k, v in (('_HINT', opt.hint), ('_DISC_ID', opt.disc_id)):
+        if v is not None:
+            sh_vars[k] = v
+    for s in opt.set:
+        k, _, v = s.partition('=')
+        sh_vars[k] = v
+    for k in opt.unset:
+        sh_vars.pop(k, None)
+    # the script is rendered from the current boot.sh, so fixes to the template are picked up as well
+    sh = BootSh(**sh_vars)
+
+    with img.image.open('rb') as f:
+        old = f.read(_BOOT_SZ)
+    new = boot_bytes(old, sh)
+    diff = [i for i in range(_BOOT_SZ) if old[i] != new[i]]
+    if not diff:
+        print('Nothing to patch')
+        return 0
+    old_hash = img.root_hash
+    img.patch(diff[0], new[diff[0]:diff[-1] + 1])
+    print(f'Patched {diff[-1] + 1 - diff[0]} bytes, Root hash: {old_hash.hex()} -> {img.root_hash.hex()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from capacity import CompProfile, DiscCapacity, sizeof_fmt
+from estimate import IsoEstimate, SquashfsEstimate, walk_files
+from fecsetup import FECSetup
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Predict the image size, disc type and fec roots before building')
+    parser.add_argument('data_dir', type=Path, help='data environment')
+    parser.add_argument('-C', '--compress', action='store_true', help='predict for a compressed squashfs image')
+    parser.add_argument('--comp', type=CompProfile, default=CompProfile(), metavar='xz|zstd[:N]|lz4|auto',
+                        help='squashfs compression of the build, as main.py --comp')
+    parser.add_argument('-n', '--samples', type=int, default=256, help='1 MiB blocks to compress')
+    parser.add_argument('--sigma', type=float, default=2.0, help='width of the error bars in standard errors')
+    parser.add_argument('--disc-type', choices=DiscCapacity._DiscName, help='disc to plan for')
+    parser.add_argument('--fec-margin', type=int, default=0, metavar='MiB', help='free space to keep on the disc')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sample positions')
+    parser.add_argument('--json', type=Path, metavar='FILE', help='write the prediction as json')
+    return parser.parse_args()
+
+
+def plan(iso_s: int, disc_type, margin: int) -> dict:
+    """Disc type and most fec roots for an ISO of iso_s blocks, as FECSetup would choose them."""
+    disc = DiscCapacity(iso_s + FECSetup._hs(iso_s), disc_type)
+    margin_s = (margin + FECSetup._BLK_SZ - 1) // FECSetup._BLK_SZ
+    roots = next((r for r in range(24, 1, -1) if disc.total_s >= 0
+                  and iso_s <= FECSetup.max_iso_blocks(disc.total_s - margin_s, r)), 0)
+    return {'iso_blocks': iso_s, 'disc_type': disc.disc_name, 'fec_roots': roots}
+
+
+def predict(opt: argparse.Namespace) -> dict:
+    files = walk_files(opt.data_dir)
+    total = sum(s for _, s in files)
+    if opt.compress:
+        size, err = SquashfsEstimate(opt.data_dir, opt.comp).image_size(files, opt.samples, opt.workers, opt.seed)
+    else:
+        size, err = sum(IsoEstimate().file_sizes(files)), 0
+    low, high = max(size - round(opt.sigma * err), 0), size + round(opt.sigma * err)
+    margin = opt.fec_margin * 1024 * 1024
+    return {
+        'files': len(files), 'bytes': total, 'compressed': opt.compress, 'samples': opt.samples if opt.compress else 0,
+        'comp': str(opt.comp) if opt.compress else None,
+        'image': {'low': low, 'estimate': size, 'high': high, 'stderr': err},
+        'plan': {k: plan(IsoEstimate.image_blocks(v), opt.disc_type, margin)
+                 for k, v in (('low', low), ('estimate', size), ('high', high))},
+    }
+
+
+def main(opt: argparse.Namespace) -> int:
+    t = time.perf_counter()
+    ret = predict(opt)
+    img = ret['image']
+    print('Files:', ret['files'], 'Data:', sizeof_fmt(ret['bytes']))
+    print('Image:', sizeof_fmt(img['estimate']), f'({sizeof_fmt(img["low"])} - {sizeof_fmt(img["high"])})')
+    for k, p in ret['plan'].items():
+        print(f'{k:>8}: ISO {sizeof_fmt(p["iso_blocks"] * FECSetup._BLK_SZ)}',
+              'Disc Type:', p['disc_type'] or 'none fits', 'Fec Roots:', p['fec_roots'] or 'not possible')
+    print(f'Predicted in {time.perf_counter() - t:.1f}s')
+    if opt.json:
+        with opt.json.open('w') as f:
+            json.dump(ret, f, indent=2)
+    return 0 if ret['plan']['high']['fec_roots'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
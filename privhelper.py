@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import shlex
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+from typing import Final, Optional
+
+
+class PrivHelper:
+    """Client of a helper process started once with sudo, which runs a fixed set of privileged operations.
+
+    Requests and results are json lines over a unix socket in a private directory. The helper only talks to the
+    user who started it and exits when the connection is closed."""
+    _START_TIMEOUT: Final[float] = 60
+
+    def __init__(self, password: Optional[bytes] = None, sudo: bool = True, dry_run: bool = False):
+        self.password = password
+        self.sudo = sudo
+        self.dry_run = dry_run
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._tmpdir: Optional[str] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        self._tmpdir = tempfile.mkdtemp(prefix='privhelper.')
+        sock = os.path.join(self._tmpdir, 'helper.sock')
+        cmd = [sys.executable, os.path.abspath(__file__), sock, str(os.getuid())] + ['--dry-run'] * self.dry_run
+        if self.sudo:
+            cmd = ['sudo', '-S', '-p', ''] + cmd
+        self._proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE)
+        # sudo reads the password from stdin, the helper itself never reads it
+        self._proc.stdin.write(self.password or b'\n')
+        self._proc.stdin.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._START_TIMEOUT
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(sock)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self._proc.returncode is not None or loop.time() > deadline:
+                    await self.close()
+                    raise RuntimeError('Failed to start the privileged helper')
+                await asyncio.sleep(0.05)
+
+    async def call(self, op: str, **args):
+        async with self._lock:
+            self._writer.write(json.dumps(dict(args, op=op)).encode() + b'\n')
+            await self._writer.drain()
+            line = await self._reader.readline()
+        if not line:
+            raise RuntimeError('The privileged helper exited')
+        ret = json.loads(line)
+        if 'error' in ret:
+            raise subprocess.CalledProcessError(ret.get('returncode', 1), op, None, ret['error'])
+        return ret['result']
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._proc is not None:
+            await self._proc.wait()
+            self._proc = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+_NAME_RE = re.compile(r'[A-Za-z0-9_.+-]+_crypt')
+_CIPHERS = ('aes-xts-plain64',)
+
+
+class _Server:
+    def __init__(self, uid: int, dry_run: bool):
+        self.uid = uid
+        self.dry_run = dry_run
+
+    def _run(self, cmd: list, binput: Optional[bytes] = None) -> None:
+        if self.dry_run:
+            print(shlex.join(cmd), file=sys.stderr, flush=True)
+        else:
+            subprocess.run(cmd, input=binput, check=True, capture_output=True)
+
+    def op_ping(self) -> dict:
+        return {'euid': os.geteuid(), 'dry_run': self.dry_run}
+
+    def op_crypt_open(self, file: str, name: str, cipher: str, key: str) -> dict:
+        st = os.stat(file)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != self.uid:
+            raise PermissionError(f'{file} is not a regular file of the user')
+        if not _NAME_RE.fullmatch(name) or cipher not in _CIPHERS:
+            raise ValueError('Bad mapping name or cipher')
+        dev = f'/dev/mapper/{name}'
+        self._run(['cryptsetup', 'open', '--type', 'plain', '--hash', 'plain', '--key-size', '512', '--key-file=-',
+                   '--cipher', cipher, file, name], bytes.fromhex(key))
+        self._run(['chown', str(self.uid), dev])
+        return {'device': dev}
+
+    def op_crypt_close(self, name: str) -> dict:
+        if not _NAME_RE.fullmatch(name):
+            raise ValueError('Bad mapping name')
+        self._run(['cryptsetup', 'close', name])
+        return {}
+
+    def handle(self, req: dict) -> dict:
+        op = getattr(self, f'op_{req.pop("op", "")}', None)
+        if op is None:
+            return {'error': 'Unknown operation'}
+        try:
+            return {'result': op(**req)}
+        except subprocess.CalledProcessError as e:
+            return {'error': (e.stderr or b'').decode(errors='replace'), 'returncode': e.returncode}
+        except (OSError, TypeError, ValueError) as e:
+            return {'error': str(e)}
+
+    def serve(self, sock_path: str) -> int:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as srv:
+            srv.bind(sock_path)
+            os.chown(sock_path, self.uid, -1)
+            os.chmod(sock_path, 0o600)
+            srv.listen(1)
+            srv.settimeout(PrivHelper._START_TIMEOUT)
+            conn, _ = srv.accept()
+            os.unlink(sock_path)
+        with conn, conn.makefile('rwb') as f:
+            _, peer_uid, _ = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12))
+            if peer_uid != self.uid:
+                return 1
+            for line in f:
+                try:
+                    req = json.loads(line)
+                    ret = self.handle(req) if isinstance(req, dict) else {'error': 'Bad request'}
+                except (TypeError, ValueError):
+                    ret = {'error': 'Bad request'}
+                f.write(json.dumps(ret).encode() + b'\n')
+                f.flush()
+        return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Privileged helper, started by PrivHelper')
+    parser.add_argument('socket', help='unix socket to serve')
+    parser.add_argument('uid', type=int, help='the only user allowed to connect')
+    parser.add_argument('--dry-run', action='store_true', help='print the commands to stderr instead of running them')
+    return parser.parse_args()
+
+
+def main(opt: argparse.Namespace) -> int:
+    return _Server(opt.uid, opt.dry_run).serve(opt.socket)
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import shutil
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from capacity import number_ranges, sizeof_fmt
+from fecimage import FecImage
+from verity import map_file
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Verify and repair an ISO or disc dump with its hash tree and FEC')
+    parser.add_argument('image', type=Path, help='iso file or raw disc dump')
+    parser.add_argument('-o', '--output', type=Path, help='repaired image. Only verify when omitted.')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--report', type=Path, help='write a json report of bad and repaired blocks')
+    return parser.parse_args()
+
+
+def _write_blocks(img: FecImage, output: Path, repaired: list, superblock: bool) -> None:
+    with output.open('r+b') as f:
+        for j, b in repaired:
+            f.seek(img.block_offset(j))
+            f.write(b)
+        if superblock:
+            f.seek(img.iso_sz)
+            f.write(img.superblock())
+
+
+def _image_blocks(img: FecImage, blocks) -> list:
+    # the report numbers the blocks of the image, not of the fec protected device
+    return [img.block_offset(j) // img._BLK_SZ for j in blocks]
+
+
+def _recheck(output: Path, blocks: list) -> list:
+    img = FecImage(output)
+    bad_hash = img.tree.verify_levels(img.image, img.root_hash, hash_off=img.iso_sz)
+    leaf = img.iso_sz + (img.tree.level_block[0] * img._BLK_SZ if img.tree.level_size else 0)
+    digests = np.frombuffer(map_file(img.image), dtype=np.uint8, count=img.data_blocks * img._HASH_SZ, offset=leaf)
+    bad = []
+    for j in blocks:
+        if j >= img.data_blocks:
+            if bad_hash[j - img.data_blocks + 1]:
+                bad.append(j)
+        elif img.tree._digest(img.read_blocks(j, 1)) != digests[j * img._HASH_SZ:(j + 1) * img._HASH_SZ].tobytes():
+            bad.append(j)
+    return bad
+
+
+def main(opt: argparse.Namespace) -> int:
+    img = FecImage(opt.image)
+    print(f'Root Hash is {img.root_hash.hex()}, Fec Roots is {img.fec_roots}')
+    print('Data:', sizeof_fmt(img.iso_sz), 'Hash:', sizeof_fmt(img.hash_sz), 'Code:', sizeof_fmt(img.fec.size))
+
+    report = {'image': str(opt.image), 'root_hash': img.root_hash.hex(), 'fec_roots': img.fec_roots}
+    with ProcessPoolExecutor(max_workers=opt.workers) as pool:
+        erasures = img.find_erasures(pool)
+        bad_sb = not img.check_superblock()
+        rounds = defaultdict(list)
+        for j in erasures:
+            rounds[j % img.fec.rounds].append(j)
+        lost = sorted(j for b in rounds.values() if len(b) > img.fec_roots for j in b)
+        print('Bad data blocks:', sum(j < img.data_blocks for j in erasures),
+              'Bad hash blocks:', sum(j >= img.data_blocks for j in erasures) + bad_sb,
+              'Unrecoverable blocks:', len(lost))
+        if bad_sb:
+            print('Bad superblock, it is not covered by the FEC and is rebuilt from its fields')
+        sb = [img.data_blocks] * bad_sb
+        report.update(bad=number_ranges(_image_blocks(img, erasures) + sb),
+                      unrecoverable=number_ranges(_image_blocks(img, lost)))
+
+        repaired = []
+        if (erasures or bad_sb) and opt.output:
+            shutil.copyfile(opt.image, opt.output)
+            futs = [pool.submit(img.decode_round, r, b) for r, b in rounds.items() if len(b) <= img.fec_roots]
+            repaired = [j for f in futs for j in f.result()]
+            _write_blocks(img, opt.output, repaired, bad_sb)
+
+    if repaired or sb and opt.output:
+        still_bad = _recheck(opt.output, [j for j, _ in repaired])
+        lost = sorted(lost + still_bad)
+        print('Repaired blocks:', len(repaired) - len(still_bad), 'Failed to repair:', len(still_bad))
+        report.update(repaired=number_ranges(_image_blocks(img, set(j for j, _ in repaired) - set(still_bad)) + sb),
+                      unrecoverable=number_ranges(_image_blocks(img, lost)))
+
+    if opt.report:
+        with opt.report.open('w') as f:
+            json.dump(report, f, indent=2)
+    if not erasures and not bad_sb:
+        print('Image is intact')
+        return 0
+    return 0 if opt.output and not lost else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,251 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Final, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from bulkio import release
+from verity import block_mask, map_file
+
+
+def _gf_tables(poly: int = 0x11d) -> Tuple[np.ndarray, np.ndarray]:
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int_)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= poly
+    exp[255:510] = exp[:255]
+    return exp, log
+
+
+GF_EXP, GF_LOG = _gf_tables()
+
+
+def gf_mul(a, b) -> np.ndarray:
+    a, b = np.asarray(a, dtype=np.uint8), np.asarray(b, dtype=np.uint8)
+    r = GF_EXP[GF_LOG[a] + GF_LOG[b]]
+    return np.where((a == 0) | (b == 0), np.uint8(0), r)
+
+
+def _gf_inv_matrix(m: list) -> list:
+    n = len(m)
+    m = [list(map(int, row)) + [int(i == j) for j in range(n)] for i, row in enumerate(m)]
+    for c in range(n):
+        p = next(r for r in range(c, n) if m[r][c])
+        m[c], m[p] = m[p], m[c]
+        inv = int(GF_EXP[255 - GF_LOG[m[c][c]]])
+        m[c] = [int(gf_mul(inv, v)) for v in m[c]]
+        for r in range(n):
+            if r != c and m[r][c]:
+                f = m[r][c]
+                m[r] = [v ^ int(gf_mul(f, w)) for v, w in zip(m[r], m[c])]
+    return [row[n:] for row in m]
+
+
+class ReedSolomon:
+    """RS(255, 255 - roots) over GF(2^8), init_rs_char(8, 0x11d, 0, 1, roots, 0) as used by dm-verity FEC."""
+    _RSM: Final[int] = 255
+
+    def __init__(self, roots: int):
+        assert 2 <= roots <= 24
+        self.roots = roots
+        self.rsn = self._RSM - roots
+        self.genpoly = self._genpoly(roots)
+        # feedback tables for the shift register, pre-rotated for every head position of the ring buffer
+        fbtab = gf_mul(self.genpoly[roots - 1::-1, None], np.arange(256, dtype=np.uint8)[None, :])
+        idx = np.arange(roots)
+        self._fbtab = np.stack([fbtab[(idx - h) % roots] for h in range(roots)])
+
+    @staticmethod
+    def _genpoly(roots: int) -> np.ndarray:
+        g = np.zeros(roots + 1, dtype=np.uint8)
+        g[0] = 1
+        for i in range(roots):
+            g[i + 1] = 1
+            for j in range(i, 0, -1):
+                g[j] = g[j - 1] ^ gf_mul(g[j], GF_EXP[i])
+            g[0] = gf_mul(g[0], GF_EXP[i])
+        return g
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        """Parity of (rsn, W) interleaved codewords, returned as (roots, W)."""
+        rsn, width = data.shape
+        assert rsn == self.rsn
+        par = np.zeros((self.roots, width), dtype=np.uint8)
+        fb = np.empty(width, dtype=np.uint8)
+        tmp = np.empty_like(par)
+        for i in range(rsn):
+            h = i % self.roots
+            np.bitwise_xor(data[i], par[h], out=fb)
+            par[h] = 0
+            np.take(self._fbtab[(h + 1) % self.roots], fb, axis=1, out=tmp)
+            par ^= tmp
+        return np.roll(par, -(rsn % self.roots), axis=0)
+
+    def syndromes(self, cw: np.ndarray) -> np.ndarray:
+        """Syndromes of (255, W) codewords (data followed by parity), returned as (roots, W)."""
+        tab = gf_mul(GF_EXP[:self.roots, None], np.arange(256, dtype=np.uint8)[None, :])
+        s = np.zeros((self.roots, cw.shape[1]), dtype=np.uint8)
+        for p in range(self._RSM):
+            s = np.take_along_axis(tab, s, axis=1)
+            s ^= cw[p]
+        return s
+
+    def decode_erasures(self, cw: np.ndarray, erasures: Sequence[int]) -> np.ndarray:
+        """Rebuild the erased symbol rows of (255, W) codewords in place, up to roots erasures."""
+        erasures = sorted(set(erasures))
+        k = len(erasures)
+        assert k <= self.roots
+        if not k:
+            return cw
+        cw[erasures] = 0
+        s = self.syndromes(cw)[:k]
+        x = [int(GF_EXP[(self._RSM - 1 - e) % 255]) for e in erasures]
+        vinv = _gf_inv_matrix([[int(GF_EXP[GF_LOG[v] * j % 255]) for v in x] for j in range(k)])
+        for row, e in zip(vinv, erasures):
+            acc = np.zeros(cw.shape[1], dtype=np.uint8)
+            for c, sj in zip(row, s):
+                acc ^= gf_mul(c, sj)
+            cw[e] = acc
+        return cw
+
+
+class FecLayout:
+    _BLK_SZ: Final[int] = 2048
+
+    def __init__(self, blocks: int, roots: int):
+        self.blocks = blocks
+        self.roots = roots
+        self.rsn = ReedSolomon._RSM - roots
+        self.rounds = (blocks + self.rsn - 1) // self.rsn
+        self.size = self.rounds * self._BLK_SZ * roots
+
+    def block_range(self, i: int, r0: int, r1: int) -> Tuple[int, int]:
+        # codeword symbol i of rounds [r0, r1) is byte b of blocks i * rounds + [r0, r1)
+        return i * self.rounds + r0, i * self.rounds + r1
+
+
+def _spans(sources: Sequence[tuple], start: int, count: int) -> Iterator[Tuple[str, int, int, int]]:
+    """(file, first block in the file, first block in the range, blocks) of [start, start + count) of the sources.
+
+    A source is (file, blocks) or (file, blocks, first block in the file), the sources are concatenated."""
+    base = 0
+    for file, blocks, *first in sources:
+        lo, hi = max(start, base), min(start + count, base + blocks)
+        if lo < hi:
+            yield file, lo - base + (first[0] if first else 0), lo - start, hi - lo
+        base += blocks
+
+
+def read_blocks(sources: Sequence[tuple], start: int, count: int, blk_sz: int) -> np.ndarray:
+    """Blocks [start, start + count) of the concatenated sources, zero beyond their end."""
+    out = np.zeros(count * blk_sz, dtype=np.uint8)
+    for file, pos, k, n in _spans(sources, start, count):
+        m = map_file(file)
+        out[k * blk_sz:(k + n) * blk_sz] = np.frombuffer(m, dtype=np.uint8, count=n * blk_sz, offset=pos * blk_sz)
+        release(m, pos * blk_sz, n * blk_sz)
+    return out
+
+
+def data_runs(sources: Sequence[tuple], start: int, count: int, blk_sz: int) -> list:
+    """Runs (start, count) of the blocks of [start, start + count) that are neither holes nor all zero."""
+    mask = np.zeros(count, dtype=np.bool_)
+    for file, pos, k, n in _spans(sources, start, count):
+        mask[k:k + n] = block_mask(file, pos, n, blk_sz)
+    edges = np.flatnonzero(np.diff(mask, prepend=False, append=False))
+    return [(start + int(a), int(b - a)) for a, b in zip(edges[::2], edges[1::2])]
+
+
+def encode_rounds(sources: Sequence[tuple], roots: int, r0: int, r1: int) -> bytes:
+    """FEC parity of rounds [r0, r1), as laid out at byte r0 * block_size * roots of the fec device."""
+    layout = FecLayout(sum(src[1] for src in sources), roots)
+    r1 = min(r1, layout.rounds)
+    data = np.stack([read_blocks(sources, layout.block_range(i, r0, r1)[0], r1 - r0, layout._BLK_SZ)
+                     for i in range(layout.rsn)])
+    return ReedSolomon(roots).encode(data).T.tobytes()
+
+
+def _encode_into(sources, roots: int, r0: int, r1: int, fecfile) -> int:
+    par = encode_rounds(sources, roots, r0, r1)
+    off = r0 * FecLayout._BLK_SZ * roots
+    map_file(fecfile, writable=True)[off:off + len(par)] = par
+    return r1 - r0
+
+
+_contrib_tables = {}
+
+
+def contrib_table(roots: int) -> np.ndarray:
+    """(rsn, 256, words) table of the parity contributed by byte x at symbol i, packed into uint64 words."""
+    tab = _contrib_tables.get(roots)
+    if tab is None:
+        rs = ReedSolomon(roots)
+        unit = rs.encode(np.eye(rs.rsn, dtype=np.uint8)).T
+        tab = np.zeros((rs.rsn, 256, (roots + 7) // 8 * 8), dtype=np.uint8)
+        tab[:, :, :roots] = gf_mul(np.arange(256, dtype=np.uint8)[None, :, None], unit[:, None, :])
+        tab = _contrib_tables[roots] = tab.view(np.uint64)
+    return tab
+
+
+def _xor_parity(state: np.ndarray, layout: FecLayout, tab: np.ndarray, start: int, data: np.ndarray) -> None:
+    blk_sz = layout._BLK_SZ
+    j, end = start, start + len(data) // blk_sz
+    while j < end:
+        i, r = divmod(j, layout.rounds)
+        n = min(layout.rounds - r, end - j)
+        par = np.take(tab[i], data[(j - start) * blk_sz:(j - start + n) * blk_sz], axis=0)
+        state[r * blk_sz:(r + n) * blk_sz] ^= par.view(np.uint8)[:, :layout.roots]
+        j += n
+
+
+def _fec_state(fecfile: os.PathLike, layout: FecLayout, fec_off: int) -> np.ndarray:
+    return np.frombuffer(map_file(fecfile, writable=True), dtype=np.uint8, count=layout.size,
+                         offset=fec_off).reshape(-1, layout.roots)
+
+
+def accumulate_blocks(sources: Sequence[tuple], roots: int, start: int, count: int,
+                      fecfile: os.PathLike, step: int = 512, fec_off: int = 0, sparse: bool = True) -> int:
+    """XOR the parity contribution of blocks [start, start + count) into the fec device at fec_off of fecfile.
+
+    RS is linear, so blocks may be streamed in any order into a zero-initialized fec device. A zero block
+    contributes nothing, with sparse holes and all zero blocks are skipped."""
+    layout = FecLayout(sum(src[1] for src in sources), roots)
+    tab = contrib_table(roots)
+    state = _fec_state(fecfile, layout, fec_off)
+    for s in range(start, start + count, step):
+        n = min(step, start + count - s)
+        for rs, rn in data_runs(sources, s, n, layout._BLK_SZ) if sparse else ((s, n),):
+            _xor_parity(state, layout, tab, rs, read_blocks(sources, rs, rn, layout._BLK_SZ))
+    return count
+
+
+def accumulate_delta(fecfile: os.PathLike, blocks: int, roots: int, start: int, delta: np.ndarray,
+                     fec_off: int = 0) -> None:
+    """Update the parity of a fec device over blocks in place, after blocks from start changed by XOR delta."""
+    layout = FecLayout(blocks, roots)
+    _xor_parity(_fec_state(fecfile, layout, fec_off), layout, contrib_table(roots), start, delta)
+
+
+class FecEncoder:
+    _BATCH_SZ: Final[int] = 32 * 1024 * 1024
+
+    def __init__(self, sources: Sequence[tuple], roots: int):
+        self.sources = tuple((os.fspath(f), *rest) for f, *rest in sources)
+        self.layout = FecLayout(sum(src[1] for src in sources), roots)
+
+    def encode(self, fecfile: os.PathLike, workers: Optional[int] = None) -> int:
+        fecfile = Path(fecfile)
+        with fecfile.open('wb') as f:
+            f.truncate(self.layout.size)
+        rounds = self.layout.rounds
+        batch = max(1, self._BATCH_SZ // (self.layout.rsn * self.layout._BLK_SZ))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futs = [pool.submit(_encode_into, self.sources, self.layout.roots, r, min(r + batch, rounds),
+                                os.fspath(fecfile)) for r in range(0, rounds, batch)]
+            assert sum(f.result() for f in futs) == rounds
+        return self.layout.size
@@ -0,0 +1,42 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import psutil
+
+
+class Resources:
+    """Budgets shared by the stages of concurrent builds.
+
+    A stage waits until everything it asks for is free. Requests are clamped to the budget, so a single stage
+    larger than the budget still runs, alone. The cpu slots are oversubscribed by overcommit, so a stage using
+    every core, e.g. mksquashfs, still overlaps with the stages of another build and the kernel shares the cores."""
+
+    def __init__(self, cpu: Optional[int] = None, mem: Optional[int] = None, io: int = 1,
+                 scratch: Optional[int] = None, overcommit: int = 2):
+        self.total = {
+            'cpu': (cpu or os.cpu_count() or 1) * overcommit,
+            'mem': mem or psutil.virtual_memory().available,
+            'io': io,
+            'scratch': scratch or float('inf'),
+        }
+        self.free = dict(self.total)
+        self._cond: Optional[asyncio.Condition] = None
+
+    @asynccontextmanager
+    async def hold(self, **need):
+        need = {k: min(v, self.total[k]) for k, v in need.items() if v}
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: all(self.free[k] >= v for k, v in need.items()))
+            for k, v in need.items():
+                self.free[k] -= v
+        try:
+            yield
+        finally:
+            async with self._cond:
+                for k, v in need.items():
+                    self.free[k] += v
+                self._cond.notify_all()
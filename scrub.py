@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from capacity import number_ranges, sizeof_fmt
+from fecimage import FecImage
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Resumable media scrub against the appended hash tree')
+    parser.add_argument('image', type=Path, help='iso file or disc device')
+    parser.add_argument('-m', '--map', type=Path, help='bad block map and checkpoint (default: <image>.scrub.json)')
+    parser.add_argument('--chunk', type=int, default=8, metavar='MiB', help='read size')
+    parser.add_argument('--slow', type=float, default=0.25, metavar='RATIO',
+                        help='chunks read slower than RATIO times the median rate are recorded as slow')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    return parser.parse_args()
+
+
+class MediaScrub:
+    _CKPT_INTVL = 10
+
+    def __init__(self, image: Path, map_path: Path, chunk: int, slow: float):
+        self.img = FecImage(image)
+        self.blk_sz = self.img._BLK_SZ
+        self.map_path = map_path
+        self.hash_copy = map_path.with_suffix('.hash')
+        self.chunk = max(chunk // self.blk_sz, 1)
+        self.slow_ratio = slow
+        n, h = self.img.data_blocks, self.img.hash_blocks
+        f = self.img.fec.size // self.blk_sz
+        # the hash area comes first, so that data blocks can be checked while they are read
+        self.segments = ((n, n + h), (0, n), (n + h, n + h + f))
+        self.total = h + n + f
+        self.state = {
+            'image': os.fspath(image), 'root_hash': self.img.root_hash.hex(), 'fec_roots': self.img.fec_roots,
+            'blocks': {'data': n, 'hash': h, 'fec': f}, 'complete': False, 'scanned': 0, 'elapsed': 0.0,
+            'bad': [], 'unreadable': [], 'slow': [],
+        }
+        self.bad, self.unreadable, self.rates = set(), set(), []
+        self.bad_hash = None
+        # leaf digests of the data blocks, read from the hash copy once the hash area is scanned
+        self.leaf = None
+
+    def load(self) -> bool:
+        try:
+            with self.map_path.open() as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get('root_hash') != self.state['root_hash'] or state.get('blocks') != self.state['blocks']:
+            return False
+        self.state = state
+        self.bad = set(j for a, b in state['bad'] for j in range(a, b + 1))
+        self.unreadable = set(j for a, b in state['unreadable'] for j in range(a, b + 1))
+        if not state['complete'] and state['scanned'] >= self.segments[0][1] - self.segments[0][0]:
+            self._check_hash()
+        return True
+
+    def save(self) -> None:
+        self.state.update(bad=number_ranges(self.bad), unreadable=number_ranges(self.unreadable),
+                          margin=self.margin())
+        tmp = self.map_path.with_suffix('.tmp')
+        with tmp.open('w') as f:
+            json.dump(self.state, f)
+        tmp.replace(self.map_path)
+
+    def _read(self, fd: int, buf: bytearray, start: int, count: int) -> list:
+        view = memoryview(buf)[:count * self.blk_sz]
+        try:
+            n = os.preadv(fd, [view], start * self.blk_sz)
+            if n == len(view):
+                return []
+        except OSError:
+            n = 0
+        # fall back to single blocks to narrow down the unreadable ones
+        lost = []
+        for j in range(n // self.blk_sz, count):
+            blk = view[j * self.blk_sz:(j + 1) * self.blk_sz]
+            try:
+                if os.preadv(fd, [blk], (start + j) * self.blk_sz) == self.blk_sz:
+                    continue
+            except OSError:
+                pass
+            blk[:] = bytes(self.blk_sz)
+            lost.append(start + j)
+        return lost
+
+    def _check_hash(self) -> None:
+        img = self.img
+        self.bad_hash = img.tree.verify_levels(self.hash_copy, img.root_hash)
+        sb = bytearray(self.hash_copy.read_bytes()[:self.blk_sz])
+        sb[img._SB_SZ:img._SB_SZ + img._HASH_SZ + 1] = bytes(img._HASH_SZ + 1)
+        self.bad_hash[0] = (sb[:img._SB_SZ] != img.tree.superblock(uuid.UUID(bytes=bytes(sb[16:32])))
+                            or any(sb[img._SB_SZ:]))
+        self.bad.update((np.flatnonzero(self.bad_hash) + img.data_blocks).tolist())
+        if img.tree.level_size:
+            self.leaf = np.memmap(self.hash_copy, dtype=np.uint8, mode='r',
+                                  offset=img.tree.level_block[0] * self.blk_sz,
+                                  shape=(img.tree.level_size[0] * img.tree._HASH_DIV, img._HASH_SZ))
+        else:
+            # a single data block, the root hash is its digest
+            self.leaf = np.frombuffer(img.root_hash, dtype=np.uint8).reshape(1, img._HASH_SZ)
+
+    def _check(self, seg: int, start: int, buf: bytearray, count: int) -> None:
+        img = self.img
+        if seg == 0:
+            with self.hash_copy.open('r+b') as f:
+                f.seek((start - img.data_blocks) * self.blk_sz)
+                f.write(memoryview(buf)[:count * self.blk_sz])
+        elif seg == 1:
+            view = memoryview(buf)
+            for j in range(count):
+                if img.tree._digest(view[j * self.blk_sz:(j + 1) * self.blk_sz]) != self.leaf[start + j].tobytes():
+                    self.bad.add(start + j)
+
+    def margin(self) -> dict:
+        img, rounds = self.img, self.img.fec.rounds
+        n = img.data_blocks + img.hash_blocks
+        # the fec skips the superblock, the hash blocks after it follow the data blocks
+        fec_blocks = [j if j < img.data_blocks else j - 1 for j in self.bad | self.unreadable
+                      if j < n and j != img.data_blocks]
+        erasures = np.bincount(np.array([j % rounds for j in fec_blocks], dtype=np.int_), minlength=rounds)
+        parity_lost = np.zeros(rounds, dtype=np.bool_)
+        parity_lost[[(j - n) // img.fec_roots for j in self.unreadable if j >= n]] = True
+        margin = img.fec_roots - erasures - np.where(parity_lost, img.fec_roots, 0)
+        hist = np.bincount(margin - margin.min())
+        return {
+            'min': int(margin.min()),
+            'histogram': {int(m + margin.min()): int(c) for m, c in enumerate(hist) if c},
+            'exhausted_rounds': number_ranges(np.flatnonzero(margin <= 0).tolist()),
+        }
+
+    def _positions(self):
+        skip = self.state['scanned']
+        for seg, (a, b) in enumerate(self.segments):
+            if skip >= b - a:
+                skip -= b - a
+                continue
+            for s in range(a + skip, b, self.chunk):
+                yield seg, s, min(self.chunk, b - s)
+            skip = 0
+
+    def run(self) -> None:
+        if self.state['scanned'] == 0:
+            with self.hash_copy.open('wb') as f:
+                f.truncate(self.img.hash_sz)
+        bufs = (bytearray(self.chunk * self.blk_sz), bytearray(self.chunk * self.blk_sz))
+        t0, last_save = time.monotonic() - self.state['elapsed'], time.monotonic()
+        fd = os.open(self.img.image, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as reader:
+                # double buffered: the next chunk is read while the current one is checked
+                pos, i = list(self._positions()), 0
+                t = time.monotonic()
+                fut = reader.submit(self._read, fd, bufs[0], *pos[0][1:]) if pos else None
+                for k, (seg, s, n) in enumerate(pos):
+                    lost = fut.result()
+                    rate = n * self.blk_sz / max(time.monotonic() - t, 1e-9)
+                    buf, i = bufs[i], 1 - i
+                    if k + 1 < len(pos):
+                        t = time.monotonic()
+                        fut = reader.submit(self._read, fd, bufs[i], *pos[k + 1][1:])
+                    self.unreadable.update(lost)
+                    self._record_rate(s, n, rate)
+                    self._check(seg, s, buf, n)
+                    self.state['scanned'] += n
+                    if seg == 0 and s + n == self.segments[0][1]:
+                        self._check_hash()
+                    if time.monotonic() - last_save > self._CKPT_INTVL:
+                        self.state['elapsed'] = time.monotonic() - t0
+                        self.save()
+                        last_save = time.monotonic()
+                    print(f'\rScrubbed {self.state["scanned"] * 100 // self.total}% '
+                          f'bad: {len(self.bad | self.unreadable)}', end='', flush=True)
+        finally:
+            os.close(fd)
+            self.state['elapsed'] = time.monotonic() - t0
+            self.state['complete'] = self.state['scanned'] >= self.total
+            self.save()
+            print()
+        if self.state['complete']:
+            self.hash_copy.unlink(missing_ok=True)
+
+    def _record_rate(self, start: int, count: int, rate: float) -> None:
+        self.rates.append(rate)
+        median = statistics.median(self.rates[-256:])
+        if rate < self.slow_ratio * median:
+            slow = self.state['slow']
+            if slow and slow[-1][1] + 1 == start:
+                slow[-1][1] = start + count - 1
+                slow[-1][2] = min(slow[-1][2], round(rate / 1e6, 2))
+            else:
+                slow.append([start, start + count - 1, round(rate / 1e6, 2)])
+
+
+def main(opt: argparse.Namespace) -> int:
+    map_path = opt.map or Path(f'{opt.image.name}.scrub.json')
+    scrub = MediaScrub(opt.image, map_path, opt.chunk * 1024 * 1024, opt.slow)
+    if not opt.restart and scrub.load():
+        if scrub.state['complete']:
+            print('Scrub already complete, use --restart to scan again')
+        else:
+            print('Resuming at', sizeof_fmt(scrub.state['scanned'] * scrub.blk_sz))
+    if not scrub.state['complete']:
+        scrub.run()
+    margin = scrub.state['margin']
+    print('Bad blocks:', len(scrub.bad), 'Unreadable blocks:', len(scrub.unreadable),
+          'Slow regions:', len(scrub.state['slow']))
+    print(f'Fec margin: at least {margin["min"]} of {scrub.img.fec_roots} roots left in every round')
+    print('Map written to', map_path)
+    return 0 if not scrub.bad and not scrub.unreadable else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import List, Sequence
+
+import numpy as np
+
+from capacity import DiscCapacity, FecRoots, VolID, sizeof_fmt
+from estimate import IsoEstimate, SquashfsEstimate, walk_files, walk_links
+from fecsetup import FECSetup
+from main import build, build_parser, check_rootpassword, needs_root
+from metrics import Metrics
+from scheduler import Resources
+
+_INDEX_NAME = 'SPAN_INDEX.json'
+
+
+def parse_args() -> argparse.Namespace:
+    parser = build_parser()
+    parser.description = 'Split a data set that does not fit on one disc over several discs'
+    parser.add_argument('--span-roots', type=int, default=8, choices=range(2, 25), metavar='2-24',
+                        help='fec roots to reserve room for on every disc, unless --fec-roots is a number')
+    parser.add_argument('--fill', type=float, default=0.97,
+                        help='fraction of the free disc space the estimated data may use')
+    parser.add_argument('--plan-only', action='store_true', help='write the index without building the discs')
+    return parser.parse_args()
+
+
+def volume_budget(disc_type: str, fec_roots: int, fill: float) -> int:
+    disc_s = DiscCapacity(0, disc_type).total_s
+    return int((FECSetup.max_iso_blocks(disc_s, fec_roots) - IsoEstimate._RESERVE_S) * FECSetup._BLK_SZ * fill)
+
+
+def pack(sizes: List[int], budget: int) -> List[List[int]]:
+    """First fit decreasing: file indices of every volume."""
+    free = np.zeros(0, dtype=np.int64)
+    volumes = []
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        if sizes[i] > budget:
+            raise ValueError(f'file {i} of estimated {sizeof_fmt(sizes[i])} does not fit on one disc')
+        fit = np.flatnonzero(free >= sizes[i])
+        if len(fit):
+            v = fit[0]
+        else:
+            v = len(volumes)
+            volumes.append([])
+            free = np.append(free, budget)
+        volumes[v].append(i)
+        free[v] -= sizes[i]
+    return [sorted(v) for v in volumes]
+
+
+def volume_id(volid: VolID, i: int) -> VolID:
+    suffix = f'_{i + 1}'
+    return VolID(volid.s[:15 - len(suffix)] + suffix)
+
+
+def stage(data_dir: Path, files: List[str], dest: Path, index: bytes, links: Sequence[str] = (),
+          empty: Sequence[str] = ()) -> None:
+    shutil.rmtree(dest, ignore_errors=True)
+    dest.mkdir()
+    for rel in files:
+        target = dest / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(data_dir / rel, target)
+        except OSError:
+            shutil.copy2(data_dir / rel, target)
+    for rel in links:
+        target = dest / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(os.readlink(data_dir / rel), target)
+        shutil.copystat(data_dir / rel, target, follow_symlinks=False)
+    for rel in empty:
+        (dest / rel).mkdir(parents=True)
+        shutil.copystat(data_dir / rel, dest / rel)
+    (dest / _INDEX_NAME).write_bytes(index)
+
+
+async def main(opt: argparse.Namespace) -> int:
+    disc_type = opt.disc_type or DiscCapacity._DiscName[-1]
+    roots = opt.fec_roots.get_roots() or opt.span_roots
+    if opt.fec_roots.s in ('ask', 'preview'):
+        opt.fec_roots = FecRoots(str(roots))
+
+    files = walk_files(opt.data_dir)
+    try:
+        links, empty = walk_links(opt.data_dir)
+    except ValueError as e:
+        print(e)
+        return 1
+    compressed = opt.compress is not None or opt.save_pass
+    estimator = SquashfsEstimate(opt.data_dir, opt.comp) if compressed else IsoEstimate()
+    print('Estimating', len(files), 'files of', sizeof_fmt(sum(s for _, s in files)))
+    sizes = estimator.file_sizes(files)
+    # every disc carries the index of all discs, the first one also the symlinks and empty directories
+    index_sz = sum(len(rel.encode()) + 16 for rel, _ in files) + 4096
+    index_sz += sum(len(rel.encode()) + SquashfsEstimate._INODE_SZ for rel in links + empty)
+    budget = volume_budget(disc_type, roots, opt.fill) - index_sz
+    volumes = pack(sizes, budget)
+
+    stem, suffix = opt.output.with_suffix(''), opt.output.suffix or '.iso'
+    outputs = [opt.output] if len(volumes) == 1 else [Path(f'{stem}_{i + 1}{suffix}') for i in range(len(volumes))]
+    volids = [opt.volid] if len(volumes) == 1 else [volume_id(opt.volid, i) for i in range(len(volumes))]
+    index = {
+        'volumes': [{'volid': v.get_volid(), 'output': os.fspath(o), 'disc_type': disc_type, 'fec_roots': roots,
+                     'files': len(vol), 'bytes': sum(files[i][1] for i in vol), 'estimated': sum(sizes[i] for i in vol)}
+                    for v, o, vol in zip(volids, outputs, volumes)],
+        'files': {**{files[i][0]: k for k, vol in enumerate(volumes) for i in vol}, **dict.fromkeys(links, 0)},
+    }
+    index_bytes = json.dumps(index, indent=1).encode()
+    Path(f'{stem}.index.json').write_bytes(index_bytes)
+    for v in index['volumes']:
+        print(v['volid'], v['files'], 'files', sizeof_fmt(v['bytes']), 'estimated', sizeof_fmt(v['estimated']))
+    print('Index written to', f'{stem}.index.json')
+    if opt.plan_only:
+        return 0
+
+    root_password = await check_rootpassword() if needs_root(opt) else None
+    resources = Resources()
+    builds, stages = [], []
+    for o, v, vol in zip(outputs, volids, volumes):
+        vopt = copy.copy(opt)
+        vopt.output, vopt.volid, vopt.disc_type, vopt.metrics_json = o, v, disc_type, None
+        vopt.data_dir = o.parent / f'.{o.stem}.span'
+        first = not stages
+        stage(opt.data_dir, [files[i][0] for i in vol], vopt.data_dir, index_bytes,
+              links if first else (), empty if first else ())
+        stages.append(vopt.data_dir)
+        builds.append(vopt)
+    metrics = [Metrics() for _ in builds]
+    try:
+        rets = await asyncio.gather(*(build(b, root_password, m, resources) for b, m in zip(builds, metrics)),
+                                    return_exceptions=True)
+    finally:
+        for d in stages:
+            shutil.rmtree(d, ignore_errors=True)
+    for b, r in zip(builds, rets):
+        if isinstance(r, BaseException):
+            print(b.output, 'failed:', repr(r))
+    if opt.metrics_json:
+        with opt.metrics_json.open('w') as f:
+            json.dump({str(b.output): m.to_dict() for b, m in zip(builds, metrics)}, f, indent=2)
+    return 0 if all(r == 0 for r in rets) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,212 @@
+import lzma
+import stat
+import struct
+import zlib
+from typing import BinaryIO, Final, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+
+class Inode:
+    __slots__ = ('number', 'mode', 'mtime', 'size', 'blocks_start', 'block_sizes', 'frag_index', 'frag_offset',
+                 'target', 'rdev', 'dir_block', 'dir_offset')
+
+    def __init__(self, number: int, mode: int, mtime: int):
+        self.number = number
+        self.mode = mode
+        self.mtime = mtime
+        self.size = 0
+        self.blocks_start = 0
+        self.block_sizes: List[int] = []
+        self.frag_index: Optional[int] = None
+        self.frag_offset = 0
+        self.target = ''
+        self.rdev = 0
+        self.dir_block = self.dir_offset = 0
+
+
+class _MetaStream:
+    def __init__(self, sqfs: 'SquashfsReader', table: int, block: int, offset: int):
+        self.sqfs = sqfs
+        self.pos = table + block
+        self.buf, self.nxt = sqfs._meta_block(self.pos)
+        self.offset = offset
+
+    def read(self, n: int) -> bytes:
+        out = b''
+        while len(out) < n:
+            if self.offset == len(self.buf):
+                self.pos = self.nxt
+                self.buf, self.nxt = self.sqfs._meta_block(self.pos)
+                self.offset = 0
+            chunk = self.buf[self.offset:self.offset + n - len(out)]
+            out += chunk
+            self.offset += len(chunk)
+        return out
+
+    def unpack(self, fmt: str) -> tuple:
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+
+class SquashfsReader:
+    """Read only access to a squashfs 4.0 image starting at byte base of a file."""
+    _MAGIC: Final[int] = 0x73717368
+    _SB_FMT: Final[str] = '<IIIIIHHHHHHQQQQQQQQ'
+    _META_SZ: Final[int] = 8192
+    _UNCOMPRESSED_META: Final[int] = 0x8000
+    _UNCOMPRESSED_BLK: Final[int] = 1 << 24
+    _NO_FRAG: Final[int] = 0xffffffff
+    _FRAGS_PER_META: Final[int] = 512
+    # basic inode types, the extended ones are 7 more
+    _FMT: Final[dict] = {1: stat.S_IFDIR, 2: stat.S_IFREG, 3: stat.S_IFLNK, 4: stat.S_IFBLK, 5: stat.S_IFCHR,
+                         6: stat.S_IFIFO, 7: stat.S_IFSOCK}
+
+    def __init__(self, f: BinaryIO, base: int = 0):
+        self.f = f
+        self.base = base
+        (magic, self.inode_count, self.mtime, self.block_size, self.frag_count, self.comp, self.block_log,
+         self.flags, self.id_count, major, minor, self.root_ref, self.bytes_used, self.id_table, self.xattr_table,
+         self.inode_table, self.dir_table, self.frag_table, self.export_table) = struct.unpack(
+            self._SB_FMT, self._read(0, struct.calcsize(self._SB_FMT)))
+        if magic != self._MAGIC or (major, minor) != (4, 0):
+            raise ValueError('Not a squashfs 4.0 image')
+        self._meta_cache = {}
+        self._frags: Optional[List[Tuple[int, int]]] = None
+
+    def _read(self, pos: int, n: int) -> bytes:
+        self.f.seek(self.base + pos)
+        b = self.f.read(n)
+        if len(b) != n:
+            raise ValueError(f'Truncated squashfs image at {pos}')
+        return b
+
+    def decompress(self, b: bytes, size: int) -> bytes:
+        if self.comp == 1:
+            return zlib.decompress(b)
+        if self.comp == 4:
+            return lzma.decompress(b, format=lzma.FORMAT_XZ)
+        if self.comp == 6 and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(b, max_output_size=size)
+        if self.comp == 5 and lz4 is not None:
+            return lz4.block.decompress(b, uncompressed_size=size)
+        raise RuntimeError(f'Compressor {self.comp} of the squashfs image is not supported')
+
+    def _meta_block(self, pos: int) -> Tuple[bytes, int]:
+        """Uncompressed metadata block at pos and the position of the next one."""
+        ret = self._meta_cache.get(pos)
+        if ret is None:
+            hdr, = struct.unpack('<H', self._read(pos, 2))
+            n = hdr & ~self._UNCOMPRESSED_META
+            b = self._read(pos + 2, n)
+            if not hdr & self._UNCOMPRESSED_META:
+                b = self.decompress(b, self._META_SZ)
+            ret = self._meta_cache[pos] = b, pos + 2 + n
+        return ret
+
+    def inode(self, ref: int) -> Inode:
+        s = _MetaStream(self, self.inode_table, ref >> 16, ref & 0xffff)
+        itype, mode, _, _, mtime, number = s.unpack('<HHHHII')
+        ext = itype > 7
+        ino = Inode(number, self._FMT[itype - 7 if ext else itype] | mode, mtime)
+        if itype == 1:
+            ino.dir_block, _, size, ino.dir_offset, _ = s.unpack('<IIHHI')
+            # the listing size counts 3 bytes more than stored
+            ino.size = size - 3
+        elif itype == 8:
+            _, size, ino.dir_block, _, _, ino.dir_offset, _ = s.unpack('<IIIIHHI')
+            ino.size = size - 3
+        elif itype in (2, 9):
+            if ext:
+                ino.blocks_start, ino.size, _, _, frag, ino.frag_offset, _ = s.unpack('<QQQIIII')
+            else:
+                ino.blocks_start, frag, ino.frag_offset, ino.size = s.unpack('<IIII')
+            if frag != self._NO_FRAG:
+                ino.frag_index = frag
+                n = ino.size // self.block_size
+            else:
+                n = (ino.size + self.block_size - 1) // self.block_size
+            ino.block_sizes = list(s.unpack(f'<{n}I'))
+        elif itype in (3, 10):
+            _, n = s.unpack('<II')
+            ino.target = s.read(n).decode(errors='surrogateescape')
+            ino.size = n
+        elif itype in (4, 5, 11, 12):
+            _, ino.rdev = s.unpack('<II')
+        return ino
+
+    def _listing(self, ino: Inode) -> Iterator[Tuple[str, int]]:
+        s = _MetaStream(self, self.dir_table, ino.dir_block, ino.dir_offset)
+        left = ino.size
+        while left > 0:
+            count, start, _ = s.unpack('<III')
+            left -= 12
+            for _ in range(count + 1):
+                offset, _, _, n = s.unpack('<HhHH')
+                name = s.read(n + 1).decode(errors='surrogateescape')
+                left -= 8 + n + 1
+                yield name, start << 16 | offset
+
+    def walk(self) -> Iterator[Tuple[str, Inode]]:
+        """(path, inode) of every entry below the root, parents before their children."""
+        stack = [('', self.inode(self.root_ref))]
+        while stack:
+            path, ino = stack.pop()
+            children = []
+            for name, ref in self._listing(ino):
+                child = self.inode(ref)
+                p = f'{path}/{name}' if path else name
+                yield p, child
+                if stat.S_ISDIR(child.mode):
+                    children.append((p, child))
+            stack.extend(reversed(children))
+
+    def fragment(self, index: int) -> Tuple[int, int]:
+        """(start, on disk size) of a fragment block, bit 24 of the size set when stored uncompressed."""
+        if self._frags is None:
+            n_meta = (self.frag_count + self._FRAGS_PER_META - 1) // self._FRAGS_PER_META
+            ptrs = struct.unpack(f'<{n_meta}Q', self._read(self.frag_table, 8 * n_meta))
+            self._frags = []
+            for k, p in enumerate(ptrs):
+                n = min(self._FRAGS_PER_META, self.frag_count - k * self._FRAGS_PER_META)
+                s = _MetaStream(self, p, 0, 0)
+                self._frags += [s.unpack('<QII')[:2] for _ in range(n)]
+        return self._frags[index]
+
+    def data_blocks(self, ino: Inode) -> List[Tuple[int, int, bool]]:
+        """(start, on disk size, compressed) of the blocks holding a file, its fragment block last.
+
+        An on disk size of 0 is a sparse block."""
+        blocks = []
+        pos = ino.blocks_start
+        for b in ino.block_sizes:
+            n = b & ~self._UNCOMPRESSED_BLK
+            blocks.append((pos, n, not b & self._UNCOMPRESSED_BLK))
+            pos += n
+        if ino.frag_index is not None:
+            start, size = self.fragment(ino.frag_index)
+            blocks.append((start, size & ~self._UNCOMPRESSED_BLK, not size & self._UNCOMPRESSED_BLK))
+        return blocks
+
+    def file_extents(self, ino: Inode) -> List[Tuple[int, int]]:
+        """Byte ranges of the image holding the data of a file, its fragment block included."""
+        extents = []
+        pos = ino.blocks_start
+        for b in ino.block_sizes:
+            n = b & ~self._UNCOMPRESSED_BLK
+            if n:
+                if extents and extents[-1][0] + extents[-1][1] == pos:
+                    extents[-1] = (extents[-1][0], extents[-1][1] + n)
+                else:
+                    extents.append((pos, n))
+            pos += n
+        if ino.frag_index is not None:
+            start, size = self.fragment(ino.frag_index)
+            extents.append((start, size & ~self._UNCOMPRESSED_BLK))
+        return extents
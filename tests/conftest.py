@@ -0,0 +1,83 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# the modules live at the top of the repository, next to main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bootsh import BootSh
+from capacity import FecRoots, VolID
+from fecsetup import FECSetup
+from main import build, parse_args
+from metrics import Metrics
+
+BLK_SZ = 2048
+
+
+def _rs_tables():
+    alpha_to, index_of = np.zeros(256, dtype=np.int_), np.zeros(256, dtype=np.int_)
+    index_of[0] = 255
+    sr = 1
+    for i in range(255):
+        index_of[sr], alpha_to[i] = i, sr
+        sr <<= 1
+        if sr & 0x100:
+            sr ^= 0x11d
+    alpha_to[255] = 0
+    return alpha_to, index_of
+
+
+def rs_parity(data: np.ndarray, roots: int) -> np.ndarray:
+    """encode_rs_char of libfec after init_rs_char(8, 0x11d, 0, 1, roots, 0), run on every column of data."""
+    alpha_to, index_of = _rs_tables()
+    genpoly = [1] + [0] * roots
+    for i in range(roots):
+        genpoly[i + 1] = 1
+        for j in range(i, 0, -1):
+            genpoly[j] = genpoly[j - 1] ^ (alpha_to[(index_of[genpoly[j]] + i) % 255] if genpoly[j] else 0)
+        genpoly[0] = alpha_to[(index_of[genpoly[0]] + i) % 255]
+    genpoly = [index_of[g] for g in genpoly]
+    parity = np.zeros((roots, data.shape[1]), dtype=np.int_)
+    for row in data.astype(np.int_):
+        feedback = index_of[row ^ parity[0]]
+        live = feedback != 255
+        for j in range(1, roots):
+            parity[j] ^= np.where(live, alpha_to[(feedback + genpoly[roots - j]) % 255], 0)
+        parity = np.roll(parity, -1, axis=0)
+        parity[-1] = np.where(live, alpha_to[(feedback + genpoly[0]) % 255], 0)
+    return parity.astype(np.uint8)
+
+
+def reference_fec(image: bytes, roots: int) -> bytes:
+    """The fec area as FEC_encode_inputs of veritysetup writes it for the layout of boot.sh.
+
+    Its inputs are the data blocks and the hash area after the superblock. The codeword of round n takes byte b of the
+    blocks i * rounds + n, and the parity is written round by round, byte by byte."""
+    sh = BootSh.parse_vars(image[:0x8000])
+    iso_sz, hash_sz = int(sh['ISO_SZ']), int(sh['HASH_SZ'])
+    return encode_inputs(image[:iso_sz] + image[iso_sz + BLK_SZ:iso_sz + hash_sz], roots)
+
+
+def encode_inputs(inputs: bytes, roots: int) -> bytes:
+    rsn = 255 - roots
+    rounds = -(-len(inputs) // BLK_SZ // rsn)
+    data = np.frombuffer(inputs.ljust(rsn * rounds * BLK_SZ, b'\0'), dtype=np.uint8).reshape(rsn, -1)
+    return rs_parity(data, roots).reshape(roots, rounds, BLK_SZ).transpose(1, 2, 0).tobytes()
+
+
+def build_native(tmp_path, monkeypatch, blocks: int, policy: str) -> bytes:
+    iso = tmp_path / 'fec.iso'
+    iso.write_bytes(np.random.default_rng(blocks).bytes(blocks * BLK_SZ + 100))
+    fec = FECSetup(iso, dmid=VolID('test'), engine='native', fec_policy=FecRoots(policy))
+    fec.fec_preview_set = (8, 4)
+    monkeypatch.setattr('builtins.input', lambda _: '8')
+    asyncio.run(fec.formatfec())
+    return iso.read_bytes()
+
+
+def build_image(data_dir, output, *args: str) -> int:
+    """A build of main.py with the native engines and 8 fec roots, args are further options."""
+    opt = parse_args([str(data_dir), '-o', str(output), '-V', 'test', '--engine', 'native', '--fec-roots', '8', *args])
+    return asyncio.run(build(opt, None, Metrics()))
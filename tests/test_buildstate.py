@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from bootsh import BootSh
+from buildstate import BuildState
+from conftest import build_image
+from fecsetup import FECSetup
+from imagecreate import ImageCreate
+
+_ENCRYPTED = ('--crypt-engine', 'native', '-d', 'VERBAT/IMk/0')
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _fast_key(passcode: str, disc: str, crypt_name: str, cipher: str, size: int) -> bytes:
+    # the scrypt parameters of boot.sh take a second and a GiB per key
+    return hashlib.sha512(f'{passcode}:{disc}:{crypt_name}:{cipher}:{size}'.encode()).digest()
+
+
+def test_lookup_checks_params_and_digests(tmp_path):
+    out, file = tmp_path / 'out.bin', tmp_path / 'state.json'
+    out.write_bytes(bytes(range(256)) * 40)
+    BuildState(file).record('stage', {'tree': 'a'}, [(out, 100, None)], size=5)
+    state = BuildState(file)
+    assert state.lookup('stage', {'tree': 'a'}) == {'size': 5}
+    assert state.lookup('stage', {'tree': 'b'}) is None
+    assert state.keeps(out)
+    with out.open('r+b') as f:
+        f.truncate(5000)
+    state = BuildState(file)
+    assert state.lookup('stage', {'tree': 'a'}) is None
+    # the stage is dropped, its file no longer kept
+    assert not BuildState(file).keeps(out)
+
+
+@pytest.fixture
+def src(tmp_path, monkeypatch):
+    if not shutil.which('mksquashfs') or not shutil.which('xorriso'):
+        pytest.skip('mksquashfs or xorriso not installed')
+    pytest.importorskip('cryptography')
+    # mksquashfs and xorriso take their timestamps from it, so builds of one tree are identical
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+    monkeypatch.setattr('imagecreate.derive_key', _fast_key)
+    src = tmp_path / 'src'
+    (src / 'dir').mkdir(parents=True)
+    (src / 'dir' / 'random.bin').write_bytes(np.random.default_rng(0).bytes(3 * 1024 * 1024))
+    (src / 'text.txt').write_bytes(b'some text\n' * 10000)
+    return src
+
+
+def _build(src, output, passcode: str = 'secret', *args: str) -> int:
+    output.parent.mkdir(exist_ok=True)
+    return build_image(src, output, '-C', passcode, *_ENCRYPTED, *args)
+
+
+def _interrupt(monkeypatch, src, output, cls, name: str) -> dict:
+    """Stages the state records after a build stopped at cls.name."""
+    async def stop(*args, **kwargs):
+        raise _Interrupted
+
+    with monkeypatch.context() as m:
+        m.setattr(cls, name, stop)
+        with pytest.raises(_Interrupted):
+            _build(src, output, 'secret', '--resume')
+    return BuildState(output.with_suffix('.state.json'))._stages
+
+
+def _image(output) -> bytes:
+    # every build gives the verity superblock a new uuid
+    image = bytearray(output.read_bytes())
+    iso_sz = int(BootSh.parse_vars(bytes(image[:0x8000]))['ISO_SZ'])
+    image[iso_sz + 16:iso_sz + 32] = bytes(16)
+    return bytes(image)
+
+
+def _count_tools(monkeypatch) -> list:
+    calls = []
+    for name in ('_mksquashfs', '_mkisofs'):
+        async def counted(self, *args, _orig=getattr(ImageCreate, name), _name=name):
+            calls.append(_name)
+            return await _orig(self, *args)
+        monkeypatch.setattr(ImageCreate, name, counted)
+    return calls
+
+
+@pytest.mark.parametrize('cls, name, stages, tools', [
+    (ImageCreate, '_maybe_encrypt', {'squashfs'}, ['_mkisofs']),
+    (ImageCreate, '_mkisofs', {'squashfs', 'encrypt'}, ['_mkisofs']),
+    (FECSetup, 'formatfec', {'squashfs', 'encrypt', 'iso'}, []),
+])
+def test_resumed_build_is_identical(tmp_path, monkeypatch, src, cls, name, stages, tools):
+    ref, out = tmp_path / 'ref' / 'test.iso', tmp_path / 'out' / 'test.iso'
+    assert _build(src, ref) == 0
+    assert _interrupt(monkeypatch, src, out, cls, name).keys() == stages
+    calls = _count_tools(monkeypatch)
+    assert _build(src, out, 'secret', '--resume') == 0
+    assert calls == tools
+    assert _image(out) == _image(ref)
+    # only the image is left
+    assert os.listdir(out.parent) == ['test.iso']
+
+
+def test_resume_refuses_another_passcode(tmp_path, monkeypatch, src):
+    ref, out = tmp_path / 'ref' / 'test.iso', tmp_path / 'out' / 'test.iso'
+    assert _build(src, ref, 'other') == 0
+    _interrupt(monkeypatch, src, out, ImageCreate, '_mkisofs')
+    calls = _count_tools(monkeypatch)
+    # the kept squashfs image is encrypted with the old key, so it is built again
+    assert _build(src, out, 'other', '--resume') == 0
+    assert calls == ['_mksquashfs', '_mkisofs']
+    assert _image(out) == _image(ref)
+
+
+@pytest.mark.parametrize('cls, name, artifact, tools', [
+    (ImageCreate, '_mkisofs', 'test.rootdir/test.sqfs', ['_mksquashfs', '_mkisofs']),
+    (FECSetup, 'formatfec', 'test.iso', ['_mkisofs']),
+])
+def test_resume_detects_truncated_artifacts(tmp_path, monkeypatch, src, cls, name, artifact, tools):
+    ref, out = tmp_path / 'ref' / 'test.iso', tmp_path / 'out' / 'test.iso'
+    assert _build(src, ref) == 0
+    _interrupt(monkeypatch, src, out, cls, name)
+    with open(out.parent / artifact, 'r+b') as f:
+        f.truncate(os.fstat(f.fileno()).st_size - 4096)
+    calls = _count_tools(monkeypatch)
+    assert _build(src, out, 'secret', '--resume') == 0
+    assert calls == tools
+    assert _image(out) == _image(ref)
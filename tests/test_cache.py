@@ -0,0 +1,42 @@
+import os
+
+from cache import BuildCache
+
+
+def _age(cache: BuildCache, key: str, t: int) -> None:
+    os.utime(cache.get(key), (t, t))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BuildCache(tmp_path, 100)
+    cache.put_bytes('aa', bytes(60))
+    _age(cache, 'aa', 1000)
+    cache.put_bytes('bb', bytes(60))
+    assert cache.get('aa') is None and cache.get('bb') is not None
+
+
+def test_never_evicts_the_committed_key(tmp_path):
+    cache = BuildCache(tmp_path, 100)
+    cache.put_bytes('aa', bytes(60))
+    # larger than the whole cache, it stays until the next put
+    src = tmp_path / 'src'
+    src.write_bytes(bytes(150))
+    cache.put('bb', src)
+    assert cache.get('bb') is not None and cache.get('aa') is None
+
+
+def test_batch_evicts_once(tmp_path, monkeypatch):
+    cache = BuildCache(tmp_path, 100)
+    walks = []
+    evict = BuildCache.evict
+    monkeypatch.setattr(BuildCache, 'evict', lambda self, keep=(): walks.append(keep) or evict(self, keep))
+    keys = [f'{k:02x}' for k in range(5)]
+    for k, key in enumerate(keys):
+        cache.put_bytes(key, bytes(30), evict=False)
+        _age(cache, key, 1000 + k)
+    cache.evict(keep=keys[-2:])
+    assert len(walks) == 1
+    assert [cache.get(key) is not None for key in keys] == [False, False, True, True, True]
+    # the size is known from now on, puts below max_size do not walk the store
+    cache.put_bytes('ff', bytes(5))
+    assert cache._total == 95
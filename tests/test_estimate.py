@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import estimate
+from capacity import CompProfile
+from estimate import SquashfsEstimate
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    (tmp_path / 'random.bin').write_bytes(rng.bytes(3 * 1024 * 1024))
+    (tmp_path / 'text.txt').write_bytes(b''.join(b'line %d of some text\n' % i for i in range(100000)))
+    return tmp_path
+
+
+@pytest.mark.parametrize('comp', ['xz', 'zstd:3', 'zstd:19', 'lz4'])
+def test_samples_are_compressed_with_the_profile(data_dir, comp):
+    if comp.startswith('zstd'):
+        pytest.importorskip('zstandard')
+    elif comp == 'lz4':
+        pytest.importorskip('lz4.block')
+    est = SquashfsEstimate(data_dir, CompProfile(comp))
+    raw, size = est.sample('text.txt', (data_dir / 'text.txt').stat().st_size)
+    assert size < raw / 3
+    # one sample per 1 MiB block, all of them stored
+    assert est.sample('random.bin', 3 * 1024 * 1024) == (3 * est._SAMPLE_SZ, 3 * est._SAMPLE_SZ)
+
+
+def test_compressors_differ(data_dir):
+    pytest.importorskip('lz4.block')
+    size = (data_dir / 'text.txt').stat().st_size
+    xz = SquashfsEstimate(data_dir, CompProfile('xz')).file_size('text.txt', size)
+    lz4 = SquashfsEstimate(data_dir, CompProfile('lz4')).file_size('text.txt', size)
+    assert xz < lz4
+
+
+def test_missing_compressor_module(data_dir, monkeypatch):
+    monkeypatch.setattr(estimate, 'zstandard', None)
+    with pytest.raises(RuntimeError):
+        SquashfsEstimate(data_dir, CompProfile('zstd'))
+
+
+def test_auto_counts_incompressible_files_as_stored(data_dir):
+    est = SquashfsEstimate(data_dir, CompProfile('auto'))
+    files = sorted((p.name, p.stat().st_size) for p in data_dir.iterdir())
+    # the random file is taken as stored whole instead of from compressed samples, the text as with xz
+    assert est.sample(*files[0]) == (files[0][1], files[0][1])
+    assert est._file_sizes(files) == [files[0][1] + est._INODE_SZ, SquashfsEstimate(data_dir).file_size(*files[1])]
+    # blocks of the stored file are not compressed at all, xz leaves them as they are too
+    assert est.image_size(files, samples=8, workers=1) == SquashfsEstimate(data_dir).image_size(files, 8, 1)
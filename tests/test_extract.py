@@ -0,0 +1,73 @@
+import os
+import shutil
+import stat
+
+import numpy as np
+import pytest
+
+from conftest import build_image
+from extract import Extractor
+
+_MTIME = 1700000000
+
+
+def _tree(root):
+    rng = np.random.default_rng(0)
+    (root / 'sub' / 'deeper').mkdir(parents=True)
+    (root / 'other').mkdir()
+    (root / 'sub' / 'small.txt').write_bytes(b'a fragment sized file\n')
+    (root / 'sub' / 'deeper' / 'big.bin').write_bytes(rng.bytes(3 * 1024 * 1024 + 1000))
+    (root / 'sub' / 'run.sh').write_bytes(b'#!/bin/sh\n')
+    (root / 'sub' / 'link').symlink_to('deeper/big.bin')
+    (root / 'other' / 'selected.txt').write_bytes(b'selected too\n')
+    (root / 'other' / 'skipped.txt').write_bytes(b'not selected\n')
+    (root / 'sub' / 'run.sh').chmod(0o750)
+    (root / 'sub' / 'small.txt').chmod(0o640)
+    (root / 'sub' / 'deeper').chmod(0o700)
+    for k, p in enumerate(sorted(root.rglob('*'), key=lambda p: -len(p.parts))):
+        os.utime(p, (_MTIME + k, _MTIME + k), follow_symlinks=False)
+
+
+@pytest.mark.parametrize('squashfs', [True, False])
+def test_extract_restores_the_selected_paths(tmp_path, squashfs):
+    tool = 'mksquashfs' if squashfs else 'xorriso'
+    if not shutil.which(tool) or not shutil.which('xorriso'):
+        pytest.skip(f'{tool} not installed')
+    src, image, out = tmp_path / 'src', tmp_path / 'test.iso', tmp_path / 'out'
+    src.mkdir()
+    _tree(src)
+    assert build_image(src, image, *(['-C', ''] if squashfs else [])) == 0
+    with Extractor(image) as ext:
+        assert ext.modes
+        assert ext.extract(out, ['sub', 'other/selected.txt']) == (4, 3 * 1024 * 1024 + 1000 + 22 + 10 + 13)
+    expected = sorted(p.relative_to(src) for p in src.rglob('*') if p.name != 'skipped.txt')
+    assert sorted(p.relative_to(out) for p in out.rglob('*')) == expected
+    # other is only created as the parent of a selected file
+    for rel in expected[1:]:
+        st, ref = os.lstat(out / rel), os.lstat(src / rel)
+        if squashfs:
+            assert stat.S_IMODE(st.st_mode) == stat.S_IMODE(ref.st_mode)
+        elif not stat.S_ISLNK(ref.st_mode):
+            # xorriso -r makes everything readable, and executable for everybody or nobody
+            assert st.st_mode & 0o444 == 0o444 and bool(st.st_mode & 0o111) == bool(ref.st_mode & 0o111)
+        assert stat.S_IFMT(st.st_mode) == stat.S_IFMT(ref.st_mode)
+        assert st.st_mtime == ref.st_mtime, rel
+        if stat.S_ISLNK(ref.st_mode):
+            assert os.readlink(out / rel) == os.readlink(src / rel)
+        elif stat.S_ISREG(ref.st_mode):
+            assert (out / rel).read_bytes() == (src / rel).read_bytes()
+
+
+@pytest.mark.skipif(not shutil.which('xorriso'), reason='xorriso not installed')
+def test_extract_leaves_unrecorded_modes_alone(tmp_path, monkeypatch):
+    src, image, out = tmp_path / 'src', tmp_path / 'test.iso', tmp_path / 'out'
+    src.mkdir()
+    (src / 'file.txt').write_bytes(b'plain\n')
+    (src / 'file.txt').chmod(0o755)
+    assert build_image(src, image) == 0
+    # as a plain ISO9660 directory without Rock Ridge, which records no permissions
+    monkeypatch.setattr(Extractor, 'modes', False)
+    os.umask(umask := os.umask(0o022))
+    with Extractor(image) as ext:
+        ext.extract(out)
+    assert stat.S_IMODE(os.stat(out / 'file.txt').st_mode) == 0o600 & ~umask
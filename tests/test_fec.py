@@ -0,0 +1,89 @@
+import asyncio
+import shutil
+import subprocess
+import threading
+import uuid
+
+import numpy as np
+import pytest
+
+from bootsh import BootSh
+from capacity import FecRoots, VolID
+from conftest import BLK_SZ, build_native, encode_inputs, reference_fec, rs_parity
+from fecsetup import FECSetup
+from rsfec import FecEncoder, ReedSolomon
+from verity import HashTree
+
+
+@pytest.mark.parametrize('blocks', [700, 20000])
+@pytest.mark.parametrize('policy', ['preview', '8'])
+def test_native_fec_matches_veritysetup_layout(tmp_path, monkeypatch, blocks, policy):
+    # a single candidate is built in place in the ISO, several ones in separate files
+    image = build_native(tmp_path, monkeypatch, blocks, policy)
+    sh = BootSh.parse_vars(image[:0x8000])
+    fec_off = int(sh['ISO_SZ']) + int(sh['HASH_SZ'])
+    assert image[int(sh['ISO_SZ']) + 528] == 8
+    ref = reference_fec(image, 8)
+    assert image[fec_off:fec_off + len(ref)] == ref
+    # the rest is the cluster padding, filled with copies of the root hash
+    assert len(image) - fec_off - len(ref) < 64 * 1024
+
+
+
+def test_ask_prompts_outside_the_event_loop(tmp_path, monkeypatch):
+    # with --pipeline the roots are asked for while other stages may run on the loop
+    iso = tmp_path / 'fec.iso'
+    iso.write_bytes(bytes(700 * BLK_SZ))
+    fec = FECSetup(iso, dmid=VolID('test'), engine='native', fec_policy=FecRoots('ask'))
+    threads = []
+    monkeypatch.setattr('builtins.input', lambda _: threads.append(threading.current_thread()) or '8')
+    assert asyncio.run(fec.select_candidates()) == (8,)
+    assert threads and threading.main_thread() not in threads
+
+@pytest.mark.parametrize('roots', [2, 8, 24])
+def test_rs_encode_matches_libfec(roots):
+    data = np.random.default_rng(roots).integers(0, 256, (255 - roots, 64), dtype=np.uint8)
+    assert np.array_equal(ReedSolomon(roots).encode(data), rs_parity(data, roots))
+
+
+@pytest.mark.parametrize('roots', [2, 8, 24])
+def test_rs_decode_erasures_round_trip(roots):
+    rng = np.random.default_rng(roots)
+    rs = ReedSolomon(roots)
+    data = rng.integers(0, 256, (rs.rsn, 64), dtype=np.uint8)
+    cw = np.concatenate([data, rs.encode(data)])
+    assert not rs.syndromes(cw).any()
+    # data and parity symbols, up to roots of them
+    for k in (1, roots // 2, roots):
+        erasures = rng.choice(255, k, replace=False)
+        damaged = cw.copy()
+        damaged[erasures] = rng.integers(0, 256, (k, 64), dtype=np.uint8)
+        assert np.array_equal(rs.decode_erasures(damaged, erasures), cw)
+
+
+def _hash_tree(tmp_path, blocks: int):
+    datafile, hashfile = tmp_path / 'data.img', tmp_path / 'data.hash'
+    datafile.write_bytes(np.random.default_rng(blocks).bytes(blocks * BLK_SZ))
+    tree = HashTree(blocks)
+    tree.build(datafile, hashfile, uuid_=uuid.UUID(int=blocks), workers=1)
+    return datafile, hashfile, tree
+
+
+def test_fec_encoder_matches_reference(tmp_path):
+    datafile, hashfile, tree = _hash_tree(tmp_path, 3000)
+    FecEncoder(((datafile, 3000), (hashfile, tree.hash_blocks - 1, 1)), 8).encode(tmp_path / 'fec', workers=1)
+    inputs = datafile.read_bytes() + hashfile.read_bytes()[BLK_SZ:]
+    assert (tmp_path / 'fec').read_bytes() == encode_inputs(inputs, 8)
+
+
+@pytest.mark.skipif(not shutil.which('veritysetup'), reason='veritysetup not installed')
+@pytest.mark.parametrize('roots', [2, 8, 24])
+def test_fec_encoder_matches_veritysetup(tmp_path, roots):
+    datafile, hashfile, tree = _hash_tree(tmp_path, 3000)
+    vfecfile, vhashfile = tmp_path / 'veritysetup.fec', tmp_path / 'veritysetup.hash'
+    subprocess.run(['veritysetup', 'format', '--salt=-', '--hash=md5', f'--uuid={uuid.UUID(int=3000)}',
+                    f'--fec-roots={roots}', f'--data-block-size={BLK_SZ}', f'--hash-block-size={BLK_SZ}',
+                    f'--fec-device={vfecfile}', datafile, vhashfile], check=True, capture_output=True)
+    assert vhashfile.read_bytes() == hashfile.read_bytes()
+    FecEncoder(((datafile, 3000), (hashfile, tree.hash_blocks - 1, 1)), roots).encode(tmp_path / 'fec', workers=1)
+    assert (tmp_path / 'fec').read_bytes() == vfecfile.read_bytes()
@@ -0,0 +1,45 @@
+import fnmatch
+import re
+from typing import Tuple
+
+from imagecreate import ImageCreate
+
+
+def _unquote(expr: str) -> Tuple[str, str]:
+    # the action quoting, then the glob escapes as fnmatch classes
+    kind, arg = expr[:-2].split('("', 1)
+    arg = re.sub(r'\\(.)', r'\1', arg)
+    return kind, re.sub(r'\\(.)', r'[\1]', arg)
+
+
+def _matches(exprs, rel: str) -> bool:
+    # path() and subpathname() match the leading components of the path, name() the last one
+    for kind, pattern in map(_unquote, exprs):
+        if kind == 'name' and fnmatch.fnmatchcase(rel.rsplit('/', 1)[-1], pattern):
+            return True
+        parts = rel.split('/')
+        n = pattern.count('/') + 1
+        if kind == 'subpathname' and len(parts) > n and fnmatch.fnmatchcase('/'.join(parts[:n]), pattern):
+            return True
+        if kind == 'path' and fnmatch.fnmatchcase(rel, pattern):
+            return True
+    return False
+
+
+def test_passthrough_collapses_directories_and_extensions():
+    files = [(f'media/{k}/clip{k}.bin', 100) for k in range(50)] + \
+            [(f'docs/photo{k}.jpg', 100) for k in range(50)] + \
+            [(f'docs/text{k}.txt', 100) for k in range(50)] + \
+            [('docs/odd[1].txt', 100), ('mixed/a.bin', 100), ('mixed/b.bin', 100)]
+    incompressible = {rel for rel, _ in files if not rel.startswith('docs/text') and rel != 'mixed/b.bin'}
+    exprs = ImageCreate._passthrough_exprs(files, incompressible)
+    assert exprs == ['subpathname("media")', 'name("*.jpg")', 'path("docs/odd\\\\[1\\\\].txt")', 'path("mixed/a.bin")']
+    assert {rel for rel, _ in files if _matches(exprs, rel)} == incompressible
+
+
+def test_passthrough_caps_the_actions(monkeypatch):
+    monkeypatch.setattr(ImageCreate, '_MAX_ACTIONS', 10)
+    files = [(f'f{k}.dat', k) for k in range(100)] + [(f'g{k}.txt', 1) for k in range(100)]
+    exprs = ImageCreate._passthrough_exprs(files, {f'f{k}.dat' for k in range(0, 100, 2)} | {'g0.txt'})
+    # the largest files are kept out of the compressor
+    assert sorted(exprs) == sorted(f'path("f{k}.dat")' for k in range(80, 100, 2))
@@ -0,0 +1,44 @@
+import shlex
+import shutil
+import subprocess
+
+import pytest
+
+from imagecreate import ImageCreate
+from iso9660 import IsoReader
+
+
+def _tree(root, name_len: int):
+    long = 'n' * (name_len - 8)
+    deep = root / '/'.join(f'level{k}' for k in range(12))
+    deep.mkdir(parents=True)
+    (deep / f'{long}.deep').write_bytes(b'deep' * 1000)
+    (root / f'{long}.top').write_bytes(b'top')
+    (root / 'level0' / f'{long}.dir').mkdir()
+    (root / 'level0' / 'empty').write_bytes(b'')
+    (root / 'Mixed Case.txt').write_bytes(bytes(range(256)) * 20)
+
+
+@pytest.mark.skipif(not shutil.which('xorriso'), reason='xorriso not installed')
+@pytest.mark.parametrize('rock_ridge', [True, False])
+def test_walk_matches_the_mastered_tree(tmp_path, rock_ridge):
+    src, iso = tmp_path / 'src', tmp_path / 'test.iso'
+    # Rock Ridge names are kept whole, -joliet-long ones up to 103 characters
+    _tree(src, 200 if rock_ridge else 100)
+    opts = shlex.split(ImageCreate._MKISOFS_OPTS)
+    if not rock_ridge:
+        opts.remove('-r')
+    subprocess.run(['xorriso', *opts, '-V', 'TEST', '-o', iso, src], check=True, capture_output=True)
+    expected = {p.relative_to(src).as_posix(): p for p in src.rglob('*')}
+    with IsoReader(iso) as reader:
+        assert reader.rr == rock_ridge
+        entries = [e for e in reader.walk() if not e[0].lstrip('.').startswith('rr_moved')]
+        assert {p for p, *_ in entries} == expected.keys()
+        for p, is_dir, extents, *_ in entries:
+            assert is_dir == expected[p].is_dir()
+            if not is_dir:
+                data = b''.join(reader._read(start * IsoReader._BLK_SZ, size) for start, size in extents)
+                assert data == expected[p].read_bytes()
+        deep = next(p for p in expected if p.endswith('.deep'))
+        start, size = reader.lookup(deep)
+        assert reader._read(start * IsoReader._BLK_SZ, size) == expected[deep].read_bytes()
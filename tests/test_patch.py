@@ -0,0 +1,27 @@
+import uuid
+
+import numpy as np
+
+from conftest import BLK_SZ, build_native, reference_fec
+from fecimage import FecImage
+from verity import HashTree
+
+
+def test_patch_matches_full_rebuild(tmp_path, monkeypatch):
+    build_native(tmp_path, monkeypatch, 3000, '8')
+    img = FecImage(tmp_path / 'fec.iso')
+    rng = np.random.default_rng(0)
+    # within a block, over a block boundary and over several rounds of the fec
+    for offset, n in ((100 * BLK_SZ + 7, 300), (1500 * BLK_SZ - 5, 10), (2000 * BLK_SZ, 40 * BLK_SZ + 1)):
+        root_hash = img.patch(offset, rng.bytes(n))
+    image = img.image.read_bytes()
+
+    tree = HashTree(img.data_blocks)
+    (tmp_path / 'data').write_bytes(image[:img.iso_sz])
+    uuid_ = uuid.UUID(bytes=image[img.iso_sz + 16:img.iso_sz + 32])
+    assert tree.build(tmp_path / 'data', tmp_path / 'hash', uuid_=uuid_, workers=1) == root_hash
+    hashes = (tmp_path / 'hash').read_bytes()
+    assert image[img.iso_sz + BLK_SZ:img.iso_sz + len(hashes)] == hashes[BLK_SZ:]
+    assert image[img.iso_sz + 512:img.iso_sz + 529] == root_hash + bytes((8,))
+    ref = reference_fec(image, 8)
+    assert image[img.fec_off:img.fec_off + len(ref)] == ref
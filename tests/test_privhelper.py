@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import threading
+
+import pytest
+
+from privhelper import PrivHelper, _Server
+
+_KEY = '00' * 64
+
+
+async def _helper_calls(*calls):
+    async with PrivHelper(sudo=False, dry_run=True) as helper:
+        out = []
+        for op, args in calls:
+            try:
+                out.append(await helper.call(op, **args))
+            except subprocess.CalledProcessError as e:
+                out.append(e)
+        return out
+
+
+def _connect(sock: str, server: threading.Thread) -> socket.socket:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    while True:
+        try:
+            s.connect(sock)
+            return s
+        except (FileNotFoundError, ConnectionRefusedError):
+            server.join(0.01)
+
+
+def test_crypt_open_and_close(tmp_path, capfd):
+    img = tmp_path / 'sqfs.img'
+    img.write_bytes(bytes(4096))
+    ping, opened, closed = asyncio.run(_helper_calls(
+        ('ping', {}),
+        ('crypt_open', dict(file=os.fspath(img), name='disc_crypt', cipher='aes-xts-plain64', key=_KEY)),
+        ('crypt_close', dict(name='disc_crypt'))))
+    assert ping == {'euid': os.geteuid(), 'dry_run': True}
+    assert opened == {'device': '/dev/mapper/disc_crypt'} and closed == {}
+    err = capfd.readouterr().err.splitlines()
+    assert err == [f'cryptsetup open --type plain --hash plain --key-size 512 --key-file=- --cipher aes-xts-plain64 '
+                   f'{img} disc_crypt', f'chown {os.getuid()} /dev/mapper/disc_crypt', 'cryptsetup close disc_crypt']
+
+
+@pytest.mark.parametrize('name, cipher', [('disc', 'aes-xts-plain64'), ('../disc_crypt', 'aes-xts-plain64'),
+                                          ('-x_crypt ', 'aes-xts-plain64'), ('disc_crypt', 'aes-cbc-essiv:sha256')])
+def test_crypt_open_rejects_bad_names_and_ciphers(tmp_path, capfd, name, cipher):
+    img = tmp_path / 'sqfs.img'
+    img.write_bytes(bytes(4096))
+    e, = asyncio.run(_helper_calls(('crypt_open', dict(file=os.fspath(img), name=name, cipher=cipher, key=_KEY))))
+    assert isinstance(e, subprocess.CalledProcessError) and e.stderr == 'Bad mapping name or cipher'
+    assert not capfd.readouterr().err
+
+
+def test_rejects_unknown_operations_and_arguments():
+    unknown, extra, close = asyncio.run(_helper_calls(('rm', dict(path='/')), ('ping', dict(cmd='sh')),
+                                                      ('crypt_close', dict(name='x; sh'))))
+    assert unknown.stderr == 'Unknown operation'
+    assert isinstance(extra, subprocess.CalledProcessError)
+    assert close.stderr == 'Bad mapping name'
+
+
+def test_answers_malformed_requests(tmp_path):
+    sock = os.fspath(tmp_path / 'helper.sock')
+    server = threading.Thread(target=_Server(os.getuid(), dry_run=True).serve, args=(sock,))
+    server.start()
+    with _connect(sock, server) as s, s.makefile('rwb') as f:
+        ret = []
+        for line in (b'{"op": "ping"\n', b'\xff\n', b'["ping"]\n', b'"ping"\n', b'{"op": "ping"}\n'):
+            f.write(line)
+            f.flush()
+            ret.append(json.loads(f.readline()))
+    server.join()
+    assert ret[:-1] == [{'error': 'Bad request'}] * 4
+    # and the helper is still serving after them
+    assert ret[-1]['result']['dry_run']
+
+
+def test_crypt_open_rejects_files_of_other_users(tmp_path):
+    img = tmp_path / 'sqfs.img'
+    img.write_bytes(bytes(4096))
+    server = _Server(os.getuid() + 1, dry_run=True)
+    req = dict(file=os.fspath(img), name='disc_crypt', cipher='aes-xts-plain64', key=_KEY)
+    for file in (img, tmp_path):
+        ret = server.handle(dict(req, op='crypt_open', file=os.fspath(file)))
+        assert ret['error'].endswith('is not a regular file of the user')
+
+
+def test_rejects_other_peers(tmp_path):
+    sock = os.fspath(tmp_path / 'helper.sock')
+    ret = []
+    server = threading.Thread(target=lambda: ret.append(_Server(os.getuid() + 1, dry_run=True).serve(sock)))
+    server.start()
+    with _connect(sock, server) as s:
+        # closed without reading a request
+        assert s.recv(4096) == b''
+    server.join()
+    assert ret == [1]
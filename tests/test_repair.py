@@ -0,0 +1,34 @@
+import argparse
+
+import numpy as np
+
+import repair
+from conftest import BLK_SZ, build_native
+from fecimage import FecImage
+
+
+def test_repair_restores_data_and_hash_blocks(tmp_path, monkeypatch):
+    good = build_native(tmp_path, monkeypatch, 700, '8')
+    img = FecImage(tmp_path / 'fec.iso')
+    # one erasure in each round, the first hash block after the superblock and the superblock itself
+    damaged = bytearray(good)
+    for j in (5, 6, 7, img.data_blocks + 1):
+        damaged[j * BLK_SZ:(j + 1) * BLK_SZ] = np.random.default_rng(j).bytes(BLK_SZ)
+    damaged[img.iso_sz + 100] ^= 0xff
+    (tmp_path / 'bad.iso').write_bytes(damaged)
+    opt = argparse.Namespace(image=tmp_path / 'bad.iso', output=tmp_path / 'repaired.iso', workers=1,
+                             report=None)
+    assert repair.main(opt) == 0
+    assert (tmp_path / 'repaired.iso').read_bytes() == good
+
+
+def test_decode_round_rebuilds_hash_blocks(tmp_path, monkeypatch):
+    good = build_native(tmp_path, monkeypatch, 700, '8')
+    img = FecImage(tmp_path / 'fec.iso')
+    last = img.data_blocks + img.hash_blocks - 2
+    assert img.block_offset(last) == img.iso_sz + img.hash_sz - BLK_SZ
+    with img.image.open('r+b') as f:
+        f.seek(img.block_offset(last))
+        f.write(bytes(BLK_SZ))
+    (j, b), = img.decode_round(last % img.fec.rounds, [last])
+    assert b == good[img.block_offset(last):img.block_offset(last) + BLK_SZ]
@@ -0,0 +1,37 @@
+import asyncio
+import os
+
+import pytest
+
+from fecsetup import FECSetup
+from imagecreate import ImageCreate
+from scheduler import Resources
+
+
+async def _overlap(resources: Resources, *stages: dict, timeout: float = 5) -> None:
+    running = 0
+    all_in = asyncio.Event()
+
+    async def stage(need: dict) -> None:
+        nonlocal running
+        async with resources.hold(**need):
+            running += 1
+            if running == len(stages):
+                all_in.set()
+            await asyncio.wait_for(all_in.wait(), timeout)
+
+    await asyncio.gather(*(stage(need) for need in stages))
+
+
+def test_mksquashfs_overlaps_with_fec_stream_and_scrypt():
+    # the reservations of mksquashfs and scrypt of one build and the fec stream of another
+    ncpu = os.cpu_count() or 1
+    resources = Resources(mem=ImageCreate._MKSQUASHFS_MEM + ImageCreate._SCRYPT_MEM + FECSetup._STREAM_MEM)
+    asyncio.run(_overlap(resources, dict(cpu=ncpu, mem=ImageCreate._MKSQUASHFS_MEM),
+                         dict(cpu=ncpu, io=1, mem=FECSetup._STREAM_MEM), dict(mem=ImageCreate._SCRYPT_MEM)))
+
+
+def test_disk_streams_run_one_at_a_time():
+    resources = Resources(mem=1 << 30)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(_overlap(resources, dict(cpu=1, io=1), dict(cpu=1, io=1), timeout=0.2))
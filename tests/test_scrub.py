@@ -0,0 +1,33 @@
+from conftest import BLK_SZ, build_native
+from scrub import MediaScrub
+from verity import HashTree
+
+
+def test_scrub_finds_bad_data_and_hash_blocks(tmp_path, monkeypatch):
+    image = bytearray(build_native(tmp_path, monkeypatch, 700, '8'))
+    scrub = MediaScrub(tmp_path / 'fec.iso', tmp_path / 'fec.scrub.json', 64 * 1024, 0)
+    img = scrub.img
+    # the leaf level, its entry of block 21 is damaged as well
+    leaf = img.data_blocks + img.tree.level_block[0]
+    image[20 * BLK_SZ] ^= 0xff
+    image[leaf * BLK_SZ + 21 * img._HASH_SZ] ^= 0xff
+    (tmp_path / 'fec.iso').write_bytes(image)
+    scrub.run()
+    assert scrub.state['complete'] and scrub.bad == {20, 21, leaf}
+    # the fec numbers the hash blocks after the superblock on
+    erasures = [(j if j < img.data_blocks else j - 1) % img.fec.rounds for j in scrub.bad]
+    assert scrub.state['margin']['min'] == 8 - max(map(erasures.count, erasures))
+
+
+def test_scrub_single_block_checked_against_root_hash(tmp_path, monkeypatch):
+    image = build_native(tmp_path, monkeypatch, 700, '8')
+    scrub = MediaScrub(tmp_path / 'fec.iso', tmp_path / 'fec.scrub.json', 64 * 1024, 0)
+    # an image of one data block has no hash levels
+    scrub.img.tree = HashTree(1)
+    scrub.img.root_hash = scrub.img.tree._digest(image[:BLK_SZ])
+    scrub.hash_copy.write_bytes(bytes(BLK_SZ))
+    scrub._check_hash()
+    scrub._check(1, 0, bytearray(image[:BLK_SZ]), 1)
+    assert 0 not in scrub.bad
+    scrub._check(1, 0, bytearray(BLK_SZ), 1)
+    assert 0 in scrub.bad
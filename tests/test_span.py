@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from estimate import walk_files, walk_links
+from span import _INDEX_NAME, stage
+
+
+def _tree(root):
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'a' / 'b' / 'f').write_bytes(b'data')
+    (root / 'empty' / 'deeper').mkdir(parents=True)
+    os.symlink('b/f', root / 'a' / 'link')
+    os.symlink('../missing', root / 'a' / 'dangling')
+    os.symlink('a/b', root / 'dirlink')
+
+
+def test_stage_keeps_symlinks_and_empty_directories(tmp_path):
+    src, dest = tmp_path / 'src', tmp_path / 'dest'
+    _tree(src)
+    links, empty = walk_links(src)
+    assert sorted(links) == ['a/dangling', 'a/link', 'dirlink'] and empty == ['empty/deeper']
+    assert walk_files(src) == [('a/b/f', 4)]
+    stage(src, ['a/b/f'], dest, b'{}', links, empty)
+    assert (dest / 'a' / 'b' / 'f').read_bytes() == b'data'
+    assert all(os.readlink(dest / rel) == os.readlink(src / rel) for rel in links)
+    assert (dest / 'empty' / 'deeper').is_dir()
+    assert (dest / _INDEX_NAME).read_bytes() == b'{}'
+
+
+def test_special_files_are_refused(tmp_path):
+    os.mkfifo(tmp_path / 'fifo')
+    with pytest.raises(ValueError, match='fifo'):
+        walk_links(tmp_path)
@@ -0,0 +1,97 @@
+import os
+import shutil
+import stat
+import subprocess
+
+import numpy as np
+import pytest
+
+from conftest import BLK_SZ, build_image
+from fecimage import FecImage
+from iso9660 import IsoReader
+from manifest import read_manifest, verify_file
+from squashfs import Inode, SquashfsReader
+
+_BS = 4096
+
+
+def _tree(root):
+    rng = np.random.default_rng(0)
+    (root / 'dir' / 'empty').mkdir(parents=True)
+    (root / 'dir' / 'small.txt').write_bytes(b'fits in a fragment\n')
+    # a compressible, an incompressible and a sparse block, then a short tail
+    (root / 'multi.bin').write_bytes(b'x' * _BS + rng.bytes(_BS) + bytes(_BS) + b'tail')
+    (root / 'dir' / 'link').symlink_to('../multi.bin')
+    (root / 'dir' / 'small.txt').chmod(0o600)
+
+
+def _block(sqfs: SquashfsReader, start: int, n: int, compressed: bool) -> bytes:
+    if not n:
+        return bytes(sqfs.block_size)
+    b = sqfs._read(start, n)
+    return sqfs.decompress(b, sqfs.block_size) if compressed else b
+
+
+def _read(sqfs: SquashfsReader, ino: Inode) -> bytes:
+    blocks = sqfs.data_blocks(ino)
+    if ino.frag_index is None:
+        return b''.join(_block(sqfs, *b) for b in blocks)[:ino.size]
+    *blocks, frag = blocks
+    o = ino.frag_offset
+    return b''.join(_block(sqfs, *b) for b in blocks) + _block(sqfs, *frag)[o:o + ino.size % sqfs.block_size]
+
+
+@pytest.mark.skipif(not shutil.which('mksquashfs'), reason='mksquashfs not installed')
+def test_walk_and_data_match_the_tree(tmp_path):
+    src, image = tmp_path / 'src', tmp_path / 'test.sqfs'
+    src.mkdir()
+    _tree(src)
+    subprocess.run(['mksquashfs', src, image, '-b', str(_BS), '-noappend', '-all-root'], check=True,
+                   capture_output=True)
+    with image.open('rb') as f:
+        sqfs = SquashfsReader(f)
+        entries = dict(sqfs.walk())
+        assert entries.keys() == {p.relative_to(src).as_posix() for p in src.rglob('*')}
+        for rel, ino in entries.items():
+            ref = os.lstat(src / rel)
+            assert (ino.mode, ino.mtime) == (ref.st_mode, int(ref.st_mtime)), rel
+            if stat.S_ISLNK(ino.mode):
+                assert ino.target == os.readlink(src / rel)
+            elif stat.S_ISREG(ino.mode):
+                assert ino.size == ref.st_size
+                assert _read(sqfs, ino) == (src / rel).read_bytes(), rel
+        assert entries['dir/small.txt'].frag_index is not None
+        blocks = sqfs.data_blocks(entries['multi.bin'])
+        assert len(blocks) == 4 and blocks[2][1] == 0
+        # the extents of the manifest hold every stored block of a file
+        for ino in (entries['dir/small.txt'], entries['multi.bin']):
+            extents = sqfs.file_extents(ino)
+            for start, n, _ in sqfs.data_blocks(ino):
+                assert not n or any(s <= start and start + n <= s + length for s, length in extents)
+
+
+@pytest.mark.parametrize('squashfs', [True, False])
+def test_manifest_verifies_single_files(tmp_path, squashfs):
+    if not shutil.which('xorriso') or squashfs and not shutil.which('mksquashfs'):
+        pytest.skip('mksquashfs or xorriso not installed')
+    src, image = tmp_path / 'src', tmp_path / 'test.iso'
+    src.mkdir()
+    _tree(src)
+    assert build_image(src, image, '--manifest', *(['-C', ''] if squashfs else [])) == 0
+    img = FecImage(image)
+    with IsoReader(image) as iso:
+        manifest = read_manifest(img, iso)
+        assert {e['path'] for e in manifest['files']} == {'dir/small.txt', 'multi.bin'}
+        for entry in manifest['files']:
+            assert verify_file(img, iso, manifest, entry, sha256=True) == []
+        entry = next(e for e in manifest['files'] if e['path'] == 'multi.bin')
+        if squashfs:
+            pos = iso.lookup(manifest['container'])[0] * BLK_SZ + entry['extents'][0][0]
+        else:
+            pos = iso.lookup('multi.bin')[0] * BLK_SZ
+    with image.open('r+b') as f:
+        b = os.pread(f.fileno(), 1, pos)
+        os.pwrite(f.fileno(), bytes([b[0] ^ 1]), pos)
+    with IsoReader(image) as iso:
+        assert verify_file(img, iso, manifest, entry, sha256=False) == [pos // BLK_SZ]
+        assert all(verify_file(img, iso, manifest, e, sha256=False) == [] for e in manifest['files'] if e is not entry)
@@ -0,0 +1,22 @@
+import errno
+
+import pytest
+
+from conftest import BLK_SZ, build_native
+from verifiedimage import VerifiedImage
+
+
+def test_read_corrects_data_and_hash_blocks(tmp_path, monkeypatch):
+    good = build_native(tmp_path, monkeypatch, 3000, '8')
+    with VerifiedImage(tmp_path / 'fec.iso') as img:
+        iso_sz, leaf = img.iso_sz, img.tree.level_block[0]
+    image = bytearray(good)
+    image[100 * BLK_SZ:101 * BLK_SZ] = bytes(BLK_SZ)
+    image[iso_sz + leaf * BLK_SZ + 5] ^= 1
+    (tmp_path / 'fec.iso').write_bytes(image)
+    with VerifiedImage(tmp_path / 'fec.iso') as img:
+        assert img.read(0, iso_sz) == good[:iso_sz]
+    with VerifiedImage(tmp_path / 'fec.iso', correct=False) as img:
+        with pytest.raises(OSError) as e:
+            img.read(0, BLK_SZ)
+        assert e.value.errno == errno.EIO
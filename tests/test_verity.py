@@ -0,0 +1,71 @@
+import hashlib
+import struct
+import uuid
+
+import numpy as np
+import pytest
+
+import verity
+from verity import HashTree, map_file
+
+_BLK_SZ = 2048
+
+
+def reference_tree(data: bytes, uuid_: uuid.UUID) -> tuple:
+    """(root hash, hash device) as veritysetup format --hash=md5 --salt=- writes them with 2048-byte blocks."""
+    sb = struct.pack('<8sII16s32sIIQH', b'verity', 1, 1, uuid_.bytes, b'md5', _BLK_SZ, _BLK_SZ,
+                     len(data) // _BLK_SZ, 0).ljust(512, b'\0')
+    levels = []
+    level = data
+    while len(level) > _BLK_SZ:
+        level = b''.join(hashlib.md5(level[o:o + _BLK_SZ]).digest() for o in range(0, len(level), _BLK_SZ))
+        level = level.ljust(-(-len(level) // _BLK_SZ) * _BLK_SZ, b'\0')
+        levels.append(level)
+    # the top level comes first after the superblock
+    return hashlib.md5(level[:_BLK_SZ]).digest(), sb.ljust(_BLK_SZ, b'\0') + b''.join(reversed(levels))
+
+
+def _data(blocks: int) -> bytes:
+    rng = np.random.default_rng(blocks)
+    data = bytearray(rng.bytes(blocks * _BLK_SZ))
+    # written zeros, the sparse path gives them the zero block digest
+    data[_BLK_SZ:_BLK_SZ * min(blocks, 300)] = bytes(_BLK_SZ * max(min(blocks, 300) - 1, 0))
+    return bytes(data)
+
+
+@pytest.mark.parametrize('blocks', [1, 2, 128, 129, 128 * 128 + 1])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_build_matches_reference(tmp_path, blocks, sparse):
+    data = _data(blocks)
+    (tmp_path / 'data').write_bytes(data)
+    uuid_ = uuid.UUID(int=blocks)
+    tree = HashTree(blocks)
+    root_hash = tree.build(tmp_path / 'data', tmp_path / 'hash', uuid_=uuid_, workers=1, sparse=sparse)
+    ref_root, ref_hash = reference_tree(data, uuid_)
+    assert root_hash == ref_root
+    assert (tmp_path / 'hash').read_bytes() == ref_hash
+    assert tree.hash_blocks * _BLK_SZ == len(ref_hash)
+
+
+def test_update_matches_reference(tmp_path):
+    data = bytearray(_data(1000))
+    (tmp_path / 'data').write_bytes(data)
+    tree = HashTree(1000)
+    tree.build(tmp_path / 'data', tmp_path / 'hash', uuid_=uuid.UUID(int=0), workers=1)
+    data[500 * _BLK_SZ - 3:502 * _BLK_SZ] = bytes(2 * _BLK_SZ + 3)
+    (tmp_path / 'data').write_bytes(data)
+    root_hash = tree.update(tmp_path / 'data', tmp_path / 'hash', 499, 3)
+    assert (root_hash, (tmp_path / 'hash').read_bytes()) == reference_tree(bytes(data), uuid.UUID(int=0))
+
+
+def test_map_file_bounds_and_replaces_maps(tmp_path):
+    files = [tmp_path / f'{i}' for i in range(verity._MAX_MAPS + 2)]
+    for i, f in enumerate(files):
+        f.write_bytes(bytes([i]) * 4096)
+    maps = [map_file(f) for f in files]
+    assert len(verity._worker_maps) <= verity._MAX_MAPS
+    assert maps[0].closed and not maps[-1].closed
+    # a file replaced under the same name and size is mapped again
+    files[-1].unlink()
+    files[-1].write_bytes(bytes(4096))
+    assert map_file(files[-1])[0] == 0 and maps[-1].closed
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from xtscrypt import XtsPlain64, crypt_in_place
+
+modes = pytest.importorskip('cryptography.hazmat.primitives.ciphers.modes')
+algorithms = pytest.importorskip('cryptography.hazmat.primitives.ciphers.algorithms')
+Cipher = pytest.importorskip('cryptography.hazmat.primitives.ciphers').Cipher
+
+
+def _xts(key: bytes, data: bytes, sector: int) -> bytes:
+    # plain64 tweak of every 512-byte sector
+    out = []
+    for k in range(len(data) // 512):
+        enc = Cipher(algorithms.AES(key), modes.XTS((sector + k).to_bytes(16, 'little'))).encryptor()
+        out.append(enc.update(data[k * 512:(k + 1) * 512]) + enc.finalize())
+    return b''.join(out)
+
+
+@pytest.mark.parametrize('key_sz', [32, 64])
+@pytest.mark.parametrize('sector', [0, 1, 2 ** 32 + 7])
+def test_matches_cryptography_xts(key_sz, sector):
+    rng = np.random.default_rng(key_sz + sector)
+    key, data = rng.bytes(key_sz), rng.bytes(8 * 512)
+    xts = XtsPlain64(key)
+    assert xts.encrypt(data, sector) == _xts(key, data, sector)
+    assert xts.decrypt(xts.encrypt(data, sector), sector) == data
+
+
+def test_crypt_in_place_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    key, data = rng.bytes(64), rng.bytes(300 * 512)
+    f = tmp_path / 'sqfs.img'
+    f.write_bytes(data)
+    crypt_in_place(f, key, workers=1, chunk=64 * 512)
+    assert f.read_bytes() == _xts(key, data, 0)
+    crypt_in_place(f, key, decrypt=True, workers=1, chunk=64 * 512)
+    assert f.read_bytes() == data
@@ -0,0 +1,91 @@
+import errno
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from typing import Final
+
+from fecimage import FecImage
+
+
+class VerifiedImage(FecImage):
+    """Rootless random access reads of the ISO part of an image, every block checked against the hash tree.
+
+    Hash blocks are verified up to the root hash when first needed and kept in a LRU cache of cache_blocks."""
+    _BATCH_BLKS: Final[int] = 256
+
+    def __init__(self, image: os.PathLike, cache_blocks: int = 4096, correct: bool = True):
+        super().__init__(image)
+        self.cache_blocks = cache_blocks
+        self.correct = correct
+        self._nodes: OrderedDict = OrderedDict()
+        with self.image.open('rb') as f:
+            # st_size is 0 for a disc device
+            self.m = mmap.mmap(f.fileno(), os.lseek(f.fileno(), 0, os.SEEK_END), access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        self.m.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _level(self, blk: int) -> int:
+        return next(i for i, lb in enumerate(self.tree.level_block) if lb <= blk < lb + self.tree.level_size[i])
+
+    def _entry(self, level: int, j: int) -> bytes:
+        """Digest of the j-th block below level, from a verified hash block."""
+        b = self._node(self.tree.level_block[level] + j // self.tree._HASH_DIV)
+        o = j % self.tree._HASH_DIV * self._HASH_SZ
+        return b[o:o + self._HASH_SZ]
+
+    def _node(self, blk: int) -> bytes:
+        b = self._nodes.get(blk)
+        if b is not None:
+            self._nodes.move_to_end(blk)
+            return b
+        i = self._level(blk)
+        o = self.iso_sz + blk * self._BLK_SZ
+        b = self.m[o:o + self._BLK_SZ]
+        top = i + 1 == len(self.tree.level_size)
+        exp = self.root_hash if top else self._entry(i + 1, blk - self.tree.level_block[i])
+        if hashlib.new(self.tree._HASH_ALG, b).digest() != exp and self.correct:
+            # the fec numbers the hash blocks after the superblock on, following the data blocks
+            j = self.data_blocks + blk - 1
+            (_, b), = self.decode_round(j % self.fec.rounds, [j])
+        if hashlib.new(self.tree._HASH_ALG, b).digest() != exp:
+            raise OSError(errno.EIO, f'Hash block {blk} failed verification')
+        self._nodes[blk] = b
+        if len(self._nodes) > self.cache_blocks:
+            self._nodes.popitem(last=False)
+        return b
+
+    def _verified(self, j: int, b: bytes) -> bytes:
+        exp = self._entry(0, j) if self.tree.level_size else self.root_hash
+        if hashlib.new(self.tree._HASH_ALG, b).digest() == exp:
+            return b
+        if self.correct:
+            # a single erasure at j, good enough unless the rest of its codeword is damaged as well
+            (_, b), = self.decode_round(j % self.fec.rounds, [j])
+            if hashlib.new(self.tree._HASH_ALG, b).digest() == exp:
+                return b
+        raise OSError(errno.EIO, f'Block {j} failed verification')
+
+    def read(self, offset: int, n: int) -> bytes:
+        if offset < 0 or n < 0:
+            raise ValueError('negative offset or size')
+        n = max(min(n, self.iso_sz - offset), 0)
+        if not n:
+            return b''
+        start, end = offset // self._BLK_SZ, (offset + n - 1) // self._BLK_SZ + 1
+        out = []
+        # neighbouring blocks are sliced out of the map in batches and verified one after the other
+        for s in range(start, end, self._BATCH_BLKS):
+            e = min(s + self._BATCH_BLKS, end)
+            buf = self.m[s * self._BLK_SZ:e * self._BLK_SZ]
+            out += [self._verified(j, buf[(j - s) * self._BLK_SZ:(j - s + 1) * self._BLK_SZ]) for j in range(s, e)]
+        b = b''.join(out)
+        o = offset - start * self._BLK_SZ
+        return b[o:o + n]
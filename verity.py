@@ -0,0 +1,292 @@
+import hashlib
+import mmap
+import os
+import struct
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Final, Optional
+
+import numpy as np
+
+from bulkio import release
+
+_MAX_MAPS: Final[int] = 8
+_worker_maps = {}
+
+
+def _close_map(m: mmap.mmap) -> None:
+    try:
+        m.close()
+    except BufferError:
+        # still exported to an array, it is unmapped once that is gone
+        pass
+
+
+def map_file(file: os.PathLike, writable=False) -> mmap.mmap:
+    """mmap of the whole file, cached per process. The least recently used maps beyond _MAX_MAPS are closed."""
+    st = os.stat(file)
+    key = (os.fspath(file), writable)
+    ident, m = _worker_maps.pop(key, (None, None))
+    if ident != (st.st_dev, st.st_ino, st.st_size):
+        if m is not None:
+            _close_map(m)
+        with open(file, 'r+b' if writable else 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    _worker_maps[key] = (st.st_dev, st.st_ino, st.st_size), m
+    while len(_worker_maps) > _MAX_MAPS:
+        _close_map(_worker_maps.pop(next(iter(_worker_maps)))[1])
+    return m
+
+
+_zero_digests = {}
+
+
+def zero_digest(alg: str, blk_sz: int) -> bytes:
+    d = _zero_digests.get((alg, blk_sz))
+    if d is None:
+        d = _zero_digests[alg, blk_sz] = hashlib.new(alg, bytes(blk_sz)).digest()
+    return d
+
+
+def data_extents(file: os.PathLike, start: int, end: int) -> list:
+    """Byte ranges of [start, end) that are not holes of file. Without SEEK_DATA support it is all data."""
+    extents = []
+    with open(file, 'rb') as f:
+        pos = start
+        while pos < end:
+            try:
+                pos = os.lseek(f.fileno(), pos, os.SEEK_DATA)
+            except OSError:
+                # ENXIO, only a hole is left
+                break
+            if pos >= end:
+                break
+            hole = min(os.lseek(f.fileno(), pos, os.SEEK_HOLE), end)
+            extents.append((pos, hole))
+            pos = hole
+    return extents
+
+
+def block_mask(file: os.PathLike, start: int, count: int, blk_sz: int) -> np.ndarray:
+    """Blocks [start, start + count) of file holding data. Blocks in holes are not read at all."""
+    mask = np.zeros(count, dtype=np.bool_)
+    m = map_file(file)
+    full = len(m) // blk_sz
+    for lo, hi in data_extents(file, start * blk_sz, min((start + count) * blk_sz, len(m))):
+        b0, b1 = lo // blk_sz, (hi + blk_sz - 1) // blk_sz
+        e = min(b1, full)
+        if b0 < e:
+            words = np.frombuffer(m, dtype=np.uint64, count=(e - b0) * blk_sz // 8, offset=b0 * blk_sz)
+            mask[b0 - start:e - start] = words.reshape(e - b0, -1).any(axis=1)
+        # a partial last block is hashed as it is
+        mask[e - start:b1 - start] = True
+    release(m, start * blk_sz, count * blk_sz)
+    return mask
+
+
+def _digests(datafile, start: int, count: int, blk_sz: int, alg: str, sparse: bool) -> bytes:
+    m = map_file(datafile)
+    src = memoryview(m)
+    offsets = range(start * blk_sz, (start + count) * blk_sz, blk_sz)
+    if not sparse:
+        ret = b''.join(hashlib.new(alg, src[o:o + blk_sz]).digest() for o in offsets)
+    else:
+        zero = zero_digest(alg, blk_sz)
+        ret = b''.join(hashlib.new(alg, src[o:o + blk_sz]).digest() if d else zero
+                       for o, d in zip(offsets, block_mask(datafile, start, count, blk_sz).tolist()))
+    src.release()
+    release(m, start * blk_sz, count * blk_sz)
+    return ret
+
+
+def hash_blocks(datafile, hashfile, hash_off: int, start: int, count: int, blk_sz: int, alg: str,
+                sparse: bool = True) -> int:
+    dst = map_file(hashfile, writable=True)
+    buf = _digests(datafile, start, count, blk_sz, alg, sparse)
+    pos = hash_off + start * (len(buf) // count)
+    dst[pos:pos + len(buf)] = buf
+    return count
+
+
+def verify_blocks(datafile, digestfile, digest_off: int, start: int, count: int, blk_sz: int, alg: str) -> list:
+    got = _digests(datafile, start, count, blk_sz, alg, True)
+    dsz = len(got) // count
+    pos = digest_off + start * dsz
+    got = np.frombuffer(got, dtype=np.uint8).reshape(count, dsz)
+    exp = np.frombuffer(map_file(digestfile), dtype=np.uint8, count=count * dsz, offset=pos).reshape(count, dsz)
+    return (np.flatnonzero((got != exp).any(axis=1)) + start).tolist()
+
+
+class HashTree:
+    _BLK_SZ: Final[int] = 2048
+    _SB_SZ: Final[int] = 512
+    _HASH_SZ: Final[int] = 16
+    _HASH_DIV: Final[int] = _BLK_SZ // _HASH_SZ
+    _HASH_ALG: Final[str] = 'md5'
+    _BATCH_BLKS: Final[int] = 16 * 1024
+
+    def __init__(self, data_blocks: int):
+        self.data_blocks = data_blocks
+        self.level_size = self._level_sizes(data_blocks)
+        self.level_block = self._level_blocks(self.level_size)
+        self.hash_blocks = 1 + sum(self.level_size)
+
+    def _level_sizes(self, ds: int) -> list:
+        # leaf level first, same as veritysetup's hash_level_size[]
+        sizes = []
+        while ds > 1:
+            ds = (ds + self._HASH_DIV - 1) // self._HASH_DIV
+            sizes.append(ds)
+        return sizes
+
+    @staticmethod
+    def _level_blocks(level_size: list) -> list:
+        # the top level is stored first, right after the superblock
+        pos = 1
+        blocks = [0] * len(level_size)
+        for i in reversed(range(len(level_size))):
+            blocks[i] = pos
+            pos += level_size[i]
+        return blocks
+
+    def superblock(self, uuid_: uuid.UUID) -> bytes:
+        return struct.pack('<8sII16s32sIIQH6s256s168s', b'verity', 1, 1, uuid_.bytes, self._HASH_ALG.encode(),
+                           self._BLK_SZ, self._BLK_SZ, self.data_blocks, 0, b'', b'', b'')
+
+    def _digest(self, b) -> bytes:
+        return hashlib.new(self._HASH_ALG, b).digest()
+
+    def create(self, hashfile: os.PathLike, uuid_: Optional[uuid.UUID] = None, hash_blocks: int = 0,
+               hash_off: int = 0) -> None:
+        """With hash_off the hash area is placed inside an existing file, which must already be zeroed there."""
+        with open(hashfile, 'r+b' if hash_off else 'wb') as f:
+            f.seek(hash_off)
+            f.write(self.superblock(uuid_ or uuid.uuid4()))
+            size = hash_off + max(self.hash_blocks, hash_blocks) * self._BLK_SZ
+            if f.seek(0, os.SEEK_END) < size:
+                f.truncate(size)
+
+    def hash_leaves(self, pool: Executor, datafile: os.PathLike, hashfile: os.PathLike, start: int = 0,
+                    count: Optional[int] = None, hash_off: int = 0, sparse: bool = True) -> list:
+        """With sparse, holes and all zero blocks get the precomputed zero block digest."""
+        if not self.level_size:
+            return []
+        end = self.data_blocks if count is None else start + count
+        args = (os.fspath(datafile), os.fspath(hashfile), hash_off + self.level_block[0] * self._BLK_SZ)
+        return [pool.submit(hash_blocks, *args, s, min(self._BATCH_BLKS, end - s), self._BLK_SZ, self._HASH_ALG,
+                            sparse) for s in range(start, end, self._BATCH_BLKS)]
+
+    def verify_leaves(self, pool: Executor, datafile: os.PathLike, hashfile: os.PathLike, hash_off: int = 0,
+                      start: int = 0, count: Optional[int] = None) -> list:
+        if not self.level_size:
+            return []
+        end = self.data_blocks if count is None else start + count
+        args = (os.fspath(datafile), os.fspath(hashfile), hash_off + self.level_block[0] * self._BLK_SZ)
+        return [pool.submit(verify_blocks, *args, s, min(self._BATCH_BLKS, end - s), self._BLK_SZ, self._HASH_ALG)
+                for s in range(start, end, self._BATCH_BLKS)]
+
+    def verify_levels(self, hashfile: os.PathLike, root_hash: bytes, hash_off: int = 0) -> np.ndarray:
+        """Mask of hash blocks (relative to the superblock) whose digest differs from the one stored above them.
+
+        A digest match is trusted even below a damaged block, corruption does not produce matching md5 digests."""
+        bad = np.zeros(self.hash_blocks, dtype=np.bool_)
+        m = map_file(hashfile)
+        for i in reversed(range(len(self.level_size))):
+            blk, n = self.level_block[i], self.level_size[i]
+            got = np.frombuffer(b''.join(self._digest(m[o:o + self._BLK_SZ]) for o in range(
+                hash_off + blk * self._BLK_SZ, hash_off + (blk + n) * self._BLK_SZ, self._BLK_SZ)), dtype=np.uint8)
+            got = got.reshape(n, self._HASH_SZ)
+            if i + 1 == len(self.level_size):
+                bad[blk] = got.tobytes() != root_hash
+                continue
+            pblk = self.level_block[i + 1]
+            exp = np.frombuffer(m, dtype=np.uint8, count=n * self._HASH_SZ, offset=hash_off + pblk * self._BLK_SZ)
+            bad[blk:blk + n] = (got != exp.reshape(n, self._HASH_SZ)).any(axis=1)
+        return bad
+
+    def finish(self, datafile: os.PathLike, hashfile: os.PathLike, hash_off: int = 0) -> bytes:
+        if not self.level_size:
+            with open(datafile, 'rb') as f:
+                return self._digest(f.read(self._BLK_SZ))
+        with open(hashfile, 'r+b') as f, mmap.mmap(f.fileno(), 0) as m:
+            for i in range(1, len(self.level_size)):
+                src, dst = (hash_off + self.level_block[i - 1] * self._BLK_SZ,
+                            hash_off + self.level_block[i] * self._BLK_SZ)
+                for j in range(self.level_size[i - 1]):
+                    o = src + j * self._BLK_SZ
+                    m[dst + j * self._HASH_SZ:dst + (j + 1) * self._HASH_SZ] = self._digest(m[o:o + self._BLK_SZ])
+            top = hash_off + self.level_block[-1] * self._BLK_SZ
+            return self._digest(m[top:top + self._BLK_SZ])
+
+    def path_blocks(self, start: int, count: int) -> list:
+        """(first block, blocks) of every level holding the digests of data blocks [start, start + count)."""
+        ranges = []
+        lo, hi = start, start + count
+        for i in range(len(self.level_size)):
+            lo, hi = lo // self._HASH_DIV, (hi - 1) // self._HASH_DIV + 1
+            ranges.append((self.level_block[i] + lo, hi - lo))
+        return ranges
+
+    def update(self, datafile: os.PathLike, hashfile: os.PathLike, start: int, count: int, hash_off: int = 0) -> bytes:
+        """Rehash data blocks [start, start + count) and only the hash blocks on their path to the root."""
+        if not self.level_size:
+            return self.finish(datafile, hashfile, hash_off)
+        hash_blocks(datafile, hashfile, hash_off + self.level_block[0] * self._BLK_SZ, start, count, self._BLK_SZ,
+                    self._HASH_ALG)
+        m = map_file(hashfile, writable=True)
+        for (lo, n), i in zip(self.path_blocks(start, count), range(1, len(self.level_size))):
+            lo -= self.level_block[i - 1]
+            src, dst = (hash_off + self.level_block[i - 1] * self._BLK_SZ,
+                        hash_off + self.level_block[i] * self._BLK_SZ)
+            for j in range(lo, lo + n):
+                o = src + j * self._BLK_SZ
+                m[dst + j * self._HASH_SZ:dst + (j + 1) * self._HASH_SZ] = self._digest(m[o:o + self._BLK_SZ])
+        top = hash_off + self.level_block[-1] * self._BLK_SZ
+        return self._digest(m[top:top + self._BLK_SZ])
+
+    def verify_range(self, image: os.PathLike, start: int, count: int, root_hash: bytes, hash_off: int = 0,
+                     batch: int = 4096) -> list:
+        """Data blocks of [start, start + count) that don't verify, reading only them and their path to the root.
+
+        All blocks of the range are reported when a hash block on the path is damaged."""
+        with open(image, 'rb') as f:
+            def read(blk: int, n: int) -> bytes:
+                return os.pread(f.fileno(), n * self._BLK_SZ, blk * self._BLK_SZ)
+
+            if not self.level_size:
+                return [] if self._digest(read(0, 1)) == root_hash else [0]
+            hashes = {}
+            for lo, n in self.path_blocks(start, count):
+                b = os.pread(f.fileno(), n * self._BLK_SZ, hash_off + lo * self._BLK_SZ)
+                hashes.update((lo + k, b[k * self._BLK_SZ:(k + 1) * self._BLK_SZ]) for k in range(n))
+
+            def entry(level: int, j: int) -> bytes:
+                # digest of the j-th block (data or hash) below level, as stored in level
+                b = hashes[self.level_block[level] + j // self._HASH_DIV]
+                o = j % self._HASH_DIV * self._HASH_SZ
+                return b[o:o + self._HASH_SZ]
+
+            top = len(self.level_size) - 1
+            for i in range(top + 1):
+                for blk in range(self.level_block[i], self.level_block[i] + self.level_size[i]):
+                    if blk not in hashes:
+                        continue
+                    exp = root_hash if i == top else entry(i + 1, blk - self.level_block[i])
+                    if self._digest(hashes[blk]) != exp:
+                        return list(range(start, start + count))
+            bad = []
+            for s in range(start, start + count, batch):
+                n = min(batch, start + count - s)
+                b = read(s, n)
+                bad += [s + k for k in range(n)
+                        if self._digest(b[k * self._BLK_SZ:(k + 1) * self._BLK_SZ]) != entry(0, s + k)]
+            return bad
+
+    def build(self, datafile: os.PathLike, hashfile: os.PathLike, uuid_: Optional[uuid.UUID] = None,
+              workers: Optional[int] = None, sparse: bool = True) -> bytes:
+        assert os.path.getsize(datafile) >= self.data_blocks * self._BLK_SZ
+        self.create(hashfile, uuid_)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futs = self.hash_leaves(pool, datafile, hashfile, sparse=sparse)
+            assert sum(f.result() for f in futs) == (self.data_blocks if self.level_size else 0)
+        return self.finish(datafile, hashfile)
@@ -0,0 +1,89 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final, Optional
+
+import numpy as np
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+from verity import map_file
+
+
+class XtsPlain64:
+    """aes-xts-plain64 with 512-byte sectors, as set up by cryptsetup open --type plain."""
+    _SECTOR_SZ: Final[int] = 512
+    _AES_BLK: Final[int] = 16
+    _GF128_POLY: Final[int] = 0x87
+
+    def __init__(self, key: bytes):
+        if Cipher is None:
+            raise RuntimeError('python3-cryptography is required for the native crypt engine')
+        assert len(key) in (32, 64)
+        half = len(key) // 2
+        self._data_key = Cipher(algorithms.AES(key[:half]), modes.ECB())
+        self._tweak_key = Cipher(algorithms.AES(key[half:]), modes.ECB())
+
+    def _tweaks(self, sector: int, count: int) -> np.ndarray:
+        # plain64: the little endian sector number, zero padded to the block size
+        iv = np.zeros((count, 2), dtype='<u8')
+        iv[:, 0] = np.arange(sector, sector + count, dtype=np.uint64)
+        enc = self._tweak_key.encryptor()
+        t = np.frombuffer(enc.update(iv.tobytes()) + enc.finalize(), dtype='<u8').reshape(count, 2).copy()
+        out = np.empty((count, self._SECTOR_SZ // self._AES_BLK, 2), dtype='<u8')
+        for j in range(out.shape[1]):
+            out[:, j] = t
+            # multiply by x in GF(2^128)
+            carry = t[:, 1] >> np.uint64(63)
+            t[:, 1] = (t[:, 1] << np.uint64(1)) | (t[:, 0] >> np.uint64(63))
+            t[:, 0] = (t[:, 0] << np.uint64(1)) ^ (carry * np.uint64(self._GF128_POLY))
+        return out
+
+    def _crypt(self, data, sector: int, decrypt: bool) -> bytes:
+        assert len(data) % self._SECTOR_SZ == 0
+        t = self._tweaks(sector, len(data) // self._SECTOR_SZ).reshape(-1)
+        x = np.frombuffer(data, dtype='<u8') ^ t
+        c = self._data_key.decryptor() if decrypt else self._data_key.encryptor()
+        y = np.frombuffer(c.update(x.tobytes()) + c.finalize(), dtype='<u8') ^ t
+        return y.tobytes()
+
+    def encrypt(self, data, sector: int = 0) -> bytes:
+        return self._crypt(data, sector, False)
+
+    def decrypt(self, data, sector: int = 0) -> bytes:
+        return self._crypt(data, sector, True)
+
+
+def derive_key(passcode: str, disc: str, crypt_name: str, cipher: str, size: int) -> bytes:
+    """The key boot.sh passes to cryptsetup, size is the length of the mapping in bytes."""
+    h = hashlib.new('sm3')
+    h.update(disc.encode())
+    h.update(crypt_name.encode())
+    h.update(cipher.encode())
+    h.update(size.to_bytes((size.bit_length() + 7) // 8, byteorder='little'))
+    return hashlib.scrypt(passcode.encode(), salt=h.digest(), n=2 ** 20, r=8, p=1, maxmem=2 ** 31 - 1, dklen=64)
+
+
+def crypt_range(file: os.PathLike, key: bytes, start: int, count: int, decrypt: bool = False) -> int:
+    """En/decrypt sectors [start, start + count) of file in place."""
+    m = map_file(file, writable=True)
+    sz = XtsPlain64._SECTOR_SZ
+    xts = XtsPlain64(key)
+    m[start * sz:(start + count) * sz] = xts._crypt(memoryview(m)[start * sz:(start + count) * sz], start, decrypt)
+    return count
+
+
+def crypt_in_place(file: os.PathLike, key: bytes, decrypt: bool = False, workers: Optional[int] = None,
+                   chunk: int = 8 * 1024 * 1024) -> int:
+    size = os.path.getsize(file)
+    sz = XtsPlain64._SECTOR_SZ
+    assert size % sz == 0
+    sectors, step = size // sz, chunk // sz
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futs = [pool.submit(crypt_range, os.fspath(file), key, s, min(step, sectors - s), decrypt)
+                for s in range(0, sectors, step)]
+        assert sum(f.result() for f in futs) == sectors
+    return size